@@ -1,223 +1,551 @@
 # Librerias Para API
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
 import uvicorn
 
-# Libreria para moodle
+# Libreria para moodle (y sitios Moodle atendidos por este proceso)
 import tools.moodle as moodle
+import tools.sites as sites
 
 # IA
 import tools.IA as IA
+from tools.prompts import build_course_prefix, assemble_system_prompt
+from tools.lexical import BM25Index, multi_search
+import requests
+
+# Clasificacion de la intencion de la consulta (local, con el LLM solo si hay dudas)
+import tools.intent as intent_classifier
+
+# Estado por discusion (seguimientos incrementales)
+import tools.sessions as sessions
+
+# Indices de los cursos y estado guardado entre reinicios
+import tools.course_index as course_index
+import tools.course_model as course_model
+import tools.warm_state as warm_state
+
+# Descarte temprano de eventos del webhook (sin llamadas externas)
+import tools.triage as triage
+
+# Afinidad de cursos entre nodos (cada curso se atiende siempre en el mismo proceso/servidor)
+import tools.routing as routing
+
+# Sincronizacion incremental de foros
+from tools.sync import WatermarkStore, FailureCounter, get_discussions_since, initial_watermark, sync_lock
+import os
 
 # para evitar deadlock de webhooks
 import asyncio
 
+# Trazas por respuesta y presupuesto de tokens por curso
+import tools.trace as trace
+import tools.usage as usage
+
+# Profiling bajo demanda
+import tools.profiler as profiler
+
+# Plazo maximo por respuesta
+import tools.deadline as deadline
+
 
 # Crear APP
 app = FastAPI()
 
-# Recibir eventos por webhook
+# Cada cuantos minutos se buscan discusiones que no llegaron por webhook (0 = desactivado)
+SYNC_INTERVAL_MINUTES = float(os.getenv("SYNC_INTERVAL_MINUTES", "0"))
+watermarks = WatermarkStore()
+sync_failures = FailureCounter()
+
+# Token para los endpoints de administracion (/admin/...)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Fragmentos del contenido del curso que se incluyen por busqueda (ver CHUNK_TOKENS en tools/course_index.py)
+CONTENT_TOP_N = int(os.getenv("CONTENT_TOP_N", "4"))
+
+# Parte del plazo de la respuesta que se reserva para generar y publicar la respuesta (segundos).
+# Juntar contexto (indice, embeddings, actividades) usa solo el resto
+ANSWER_RESERVE_SECONDS = float(os.getenv("ANSWER_RESERVE_SECONDS", "60"))
+# Parte reservada solo para publicar en el foro (si la generacion se pasa, se publica la respuesta de respaldo)
+POST_RESERVE_SECONDS = float(os.getenv("POST_RESERVE_SECONDS", "10"))
+
+# Respuesta cuando no se llega a generar una dentro del plazo (vacio = no responder)
+REPLY_FALLBACK_MESSAGE = os.getenv(
+    "REPLY_FALLBACK_MESSAGE",
+    "Hola! En este momento no pude preparar una respuesta a tu consulta. Un docente la va a revisar a la brevedad."
+)
+
+# Recibir eventos por webhook (sitio por defecto)
 @app.post("/webhook")
 async def moodle_webhook_listener(request: Request):
+    return await site_webhook_listener(sites.DEFAULT_SITE_ID, request)
+
+
+# Recibir eventos por webhook de un sitio Moodle registrado en files/sites.json
+@app.post("/webhook/{site_id}")
+async def site_webhook_listener(site_id: str, request: Request):
+    try:
+        site = sites.get_site(site_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Sitio desconocido: {site_id}")
+
+    data = await request.json()
+    return await dispatch_event(site, data, forward=True)
+
+
+# Eventos reenviados por otro nodo (el curso se atiende en este nodo)
+@app.post("/internal/webhook/{site_id}")
+async def cluster_webhook_listener(site_id: str, request: Request):
+    if not routing.is_cluster_request(request.headers.get("X-Cluster-Token")):
+        raise HTTPException(status_code=403)
+
+    try:
+        site = sites.get_site(site_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Sitio desconocido: {site_id}")
+
     data = await request.json()
+    return await dispatch_event(site, data, forward=False)
+
+
+async def dispatch_event(site: sites.Site, data: dict, forward: bool) -> dict:
+    """
+    Triage del evento y, si corresponde, respuesta en este nodo o reenvio al nodo que atiende el curso.
+    """
+    # Triage: descartar sin llamadas a Moodle los mensajes del asistente, de docentes y de cursos ajenos
+    token = sites.current_site.set(site)
+    try:
+        reason = triage.triage(data)
+    finally:
+        sites.current_site.reset(token)
+
+    if reason:
+        triage.count(reason, site.id)
+        return {"status": "ok", "ignored": reason}
+
+    # Afinidad: el curso se responde en su nodo (si no responde, se procesa aca)
+    if forward:
+        node = routing.owner(site.id, int(data["courseid"]))
+        if node is not None and await asyncio.to_thread(routing.forward, node, site.id, data):
+            triage.count(triage.FORWARDED, site.id)
+            return {"status": "ok", "forwarded": node}
+
+    triage.count(triage.ACCEPTED, site.id)
 
     if data["eventname"] == "\\mod_forum\\event\\post_created":
-        asyncio.create_task(respond_discussion(data['other']['discussionid'], int(data["courseid"])))
+        asyncio.create_task(respond_discussion(data['other']['discussionid'], int(data["courseid"]), site.id))
 
     elif data["eventname"] == "\\mod_forum\\event\\discussion_created":
-        asyncio.create_task(respond_discussion(data['objectid'], int(data["courseid"])))
+        asyncio.create_task(respond_discussion(data['objectid'], int(data["courseid"]), site.id))
+
+    return {"status": "ok"}
+
+
+# Sincronizar foros manualmente (por si se perdieron webhooks)
+@app.post("/sync")
+async def forum_sync_listener():
+    asyncio.create_task(sync_forums())
+    return {"status": "ok"}
 
 
+# Eventos del webhook descartados por el triage (por sitio y motivo)
+@app.get("/admin/triage")
+async def triage_listener(request: Request):
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403)
 
+    return await asyncio.to_thread(triage.counters)
+
+
+# Perfilar las proximas N respuestas (de todos los cursos o de uno)
+@app.post("/admin/profile")
+async def profile_listener(request: Request):
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403)
+
+    data = await request.json()
+    course_id = data.get("course_id")
+    profiler.request_profiling(int(data.get("runs", 1)), int(course_id) if course_id is not None else None)
     return {"status": "ok"}
 
 
-async def respond_discussion(discussion_id: int, course_id: int = None):
+@app.on_event("startup")
+async def start_profiling():
+    profiler.init_from_env()
+
+
+@app.on_event("startup")
+async def load_warm_state():
+    # En un hilo aparte: el worker puede recibir webhooks mientras se carga
+    asyncio.create_task(asyncio.to_thread(warm_state.load))
+
+
+@app.on_event("startup")
+async def start_forum_sync():
+    if SYNC_INTERVAL_MINUTES > 0:
+        asyncio.create_task(sync_forums_periodically())
+
+
+async def sync_forums_periodically():
+    while True:
+        try:
+            await sync_forums()
+        except Exception as e:
+            print(f"**********Error al sincronizar foros: {e}**********\n")
+        await asyncio.sleep(SYNC_INTERVAL_MINUTES * 60)
+
+
+async def sync_forums():
     """
-    Responder a una discusion utilizando IA y todos los contenidos del curso.
-    Esta funcion sponde SI y SOLO SI el usuario registrado con el Token esta dentro del curso, y tiene los permisos necesarios.
+    Busca en todos los foros de los cursos del asistente (en cada sitio) las discusiones modificadas
+    despues del ultimo watermark guardado, y las pasa por el mismo flujo que los webhooks (respond_discussion).
+    Solo un worker sincroniza a la vez.
     """
+    with sync_lock() as acquired:
+        if not acquired:
+            print("**********Ya hay una sincronizacion en curso**********\n")
+            return
+
+        for site in sites.all_sites():
+            try:
+                await sync_site_forums(site)
+            except Exception as e:
+                print(f"**********Error al sincronizar el sitio {site.id}: {e}**********\n")
+
+
+async def sync_site_forums(site: sites.Site):
+    token = sites.current_site.set(site)
+    try:
+        user_id = (await asyncio.to_thread(warm_state.get_identity))["userid"]
+
+        for course in await asyncio.to_thread(warm_state.get_courses, user_id):
+            for forum in await asyncio.to_thread(moodle.get_course_forums, course["id"]):
+                since = watermarks.get(forum["id"]) or initial_watermark()
+                try:
+                    discussions = await asyncio.to_thread(get_discussions_since, forum["id"], since)
+                except Exception as e:
+                    print(f"**********Error al leer el foro {forum['id']} del curso {course['id']} ({site.id}): {e}**********\n")
+                    continue
+
+                if discussions:
+                    print(f"Sincronizando foro {forum['id']} del curso {course['id']} ({site.id}): {len(discussions)} discusiones nuevas")
+
+                node = routing.owner(site.id, course["id"])
+
+                for discussion in discussions:
+                    # Cursos de otro nodo: se le reenvia la discusion como si fuera un evento del webhook
+                    event = {
+                        "eventname": "\\mod_forum\\event\\discussion_created",
+                        "objectid": discussion["discussion"],
+                        "courseid": course["id"],
+                        "userid": discussion.get("usermodified", discussion.get("userid"))
+                    }
+                    try:
+                        if node is None or not await asyncio.to_thread(routing.forward, node, site.id, event):
+                            await respond_discussion(discussion["discussion"], course["id"], site.id)
+                    except Exception as e:
+                        # Se reintenta en la proxima sincronizacion; el resto del foro espera (el watermark no puede saltearla).
+                        # Despues de SYNC_MAX_FAILURES intentos se saltea para no trabar el foro
+                        if not sync_failures.record(discussion["discussion"], discussion["timemodified"]):
+                            print(f"**********Error al sincronizar la discusion {discussion['discussion']} (foro {forum['id']}, {site.id}): {e}**********\n")
+                            break
+                        print(f"**********La discusion {discussion['discussion']} (foro {forum['id']}, {site.id}) fallo {sync_failures.max_failures} veces, se saltea: {e}**********\n")
+                    else:
+                        sync_failures.clear(discussion["discussion"], discussion["timemodified"])
+                    # El watermark avanza solo despues de procesar (o entregar) la discusion
+                    watermarks.set(forum["id"], discussion["timemodified"], discussion["discussion"])
+    finally:
+        sites.current_site.reset(token)
 
-    print(f"1. Nuevo mensaje de la discusion: {discussion_id}\nPerteneciente al curso: {course_id}")
 
-    user_id = moodle.get_self_id()["userid"]
-    courses = moodle.get_user_courses(user_id)
+def chat_interaction(message: dict) -> dict:
+    """
+    Mensaje del chat (para el LLM) a partir de un post de la conversacion: los docentes hablan como 'assistant'.
+    """
+    if 'teacher' in message['user_roles'] or 'editingteacher' in message['user_roles']:
+        return {"role": "assistant", "content": f"mensaje del profesor {message['user_name']:}{message['text']}"}
 
-    if any(course["id"] == course_id for course in courses):
-        print("2. El asistente si esta en el curso")
+    return {"role": "user", "content": f"mensaje del alumno {message['user_name']}:{message['text']}"}
 
-        conversations = moodle.get_discussion_posts(discussion_id)
-        conversations = moodle.get_conversations(conversations['posts'][0], course_id)
 
-        for conversation in conversations:
-            print("3. analizando conversacion...")
+async def respond_discussion(discussion_id: int, course_id: int = None, site_id: str = sites.DEFAULT_SITE_ID):
+    """
+    Responder a una discusion utilizando IA y todos los contenidos del curso.
+    Esta funcion sponde SI y SOLO SI el usuario registrado con el Token esta dentro del curso, y tiene los permisos necesarios.
+    Todas las llamadas a Moodle (y los caches) usan el sitio 'site_id'.
+    Todo el proceso tiene un plazo de REPLY_DEADLINE_SECONDS (ver tools/deadline.py).
+    Cada ejecucion deja una traza estructurada en files/logs/traces.<pid>.jsonl (ver tools/trace.py).
+    """
+    sites.current_site.set(sites.get_site(site_id))
+    usage.current_course.set(course_id)
+    with trace.start_trace(site=site_id, course_id=course_id, discussion_id=discussion_id), profiler.maybe_profile(course_id, discussion_id), deadline.deadline(deadline.REPLY_DEADLINE_SECONDS):
+        await _respond_discussion(discussion_id, course_id)
 
-            if conversation['id_user'] != user_id:
-                teacher = False
-                print("4. El utimo mensaje no fue del asistente")
 
-                for rol in conversation["content"][-1]["user_roles"]:
-                    if rol['shortname'] in ('teacher', 'editingteacher'):
-                        teacher = True
+async def reply_fallback(post_id: int, error: Exception):
+    """
+    Publica REPLY_FALLBACK_MESSAGE cuando se agoto el plazo antes de tener una respuesta.
+    La publicacion tiene su propio plazo (POST_RESERVE_SECONDS) aunque el de la respuesta ya haya vencido.
+    Sin mensaje de respaldo configurado se propaga el error.
+    """
+    if not REPLY_FALLBACK_MESSAGE:
+        raise error
 
-                if not teacher:
-                    print("5. El utimo mensaje no fue de un profesor")
+    trace.set_attributes(outcome="respuesta de respaldo", error=repr(error))
+    with deadline.extend(POST_RESERVE_SECONDS):
+        await asyncio.to_thread(moodle.reply_to_post, post_id, REPLY_FALLBACK_MESSAGE)
 
-                    # Chat history
-                    print("**********Obteniendo historial del chat**********\n")
-                    chat = []
-                    for message in conversation["content"]:
-                        interaction = {}
 
-                        if 'teacher' in message['user_roles'] or 'editingteacher' in message['user_roles']:
-                            interaction['role'] = 'assistant'
-                            message_user = f"mensaje del profesor {message['user_name']:}"
+def read_discussion(discussion_id: int, course_id: int) -> list[dict]:
+    """Conversaciones de la discusion (posts, autores y roles). Bloquea: se llama en un hilo."""
+    posts = moodle.get_discussion_posts(discussion_id)
+    return moodle.get_conversations(posts['posts'][0], course_id, warm_state.get_course_roster(course_id))
 
-                        else:
-                            interaction['role'] = 'user'
-                            message_user = f"mensaje del alumno {message['user_name']}:"
-                        
-                        interaction["content"] = f"{message_user}{message['text']}" 
-                        chat.append(interaction)
 
+async def _respond_discussion(discussion_id: int, course_id: int = None):
+    # Todo lo que puede ir a Moodle, a OpenAI o al disco corre en un hilo: el event loop atiende
+    # los webhooks y las demas respuestas del worker mientras tanto
+    user_id = (await asyncio.to_thread(warm_state.get_identity))["userid"]
+    courses = await asyncio.to_thread(warm_state.get_courses, user_id)
 
-                    # Determine intent of the conversation
-                    print("**********Determinando intención**********\n")
-                    tags = [{"name": "consulta de actividad", "description": "Preguntas relacionadas con actividades del curso (cuestionarios, trabajos practicos-TP, ejercicios, et.)."},
-                            {"name": "Consulta de contenido", "description": "Preguntas relacionadas con el contenido del curso, pero no con una actividad."},
-                            {"name": "consulta general", "description": "Preguntas generales sobre el curso."}]
-                    intent = IA.get_tag(conversation['content'][0]['text'], tags=tags)
+    if any(course["id"] == course_id for course in courses):
+        trace.event("el asistente esta en el curso")
 
-                    if any(tag['name'] in intent for tag in tags):
-                        print(f"Intención detectada: {intent}")
+        # Presupuesto diario del curso: define el modelo y cuanto contexto se usa
+        plan = await asyncio.to_thread(usage.get_budget_plan, course_id)
+        trace.set_attributes(budget_level=plan.level, budget_used=plan.used_tokens, budget=plan.budget)
 
-                    else:
-                        print(f"Intención no reconocida: {intent}")
+        if plan.level == "agotado":
+            trace.set_attributes(outcome="presupuesto diario agotado")
+            return
 
+        try:
+            with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                conversations = await asyncio.to_thread(read_discussion, discussion_id, course_id)
+        except requests.exceptions.Timeout as e:
+            # Sin los mensajes no hay a que post responder (ni con la respuesta de respaldo)
+            trace.set_attributes(outcome="plazo agotado al leer la discusion", error=repr(e))
+            return
 
+        # Lo ya procesado de esta discusion (historial, embeddings, intencion, ultima busqueda)
+        session = sessions.get_session(discussion_id)
+        session.prune([message for conversation in conversations for message in conversation["content"]])
 
-                    # Get course content
-                    print("**********Obteniendo contenido del curso**********\n")
-                    course_name = next((course["fullname"] for course in courses if course["id"] == course_id), "None")
+        for conversation in conversations:
+            trace.event("analizando conversacion", last_post=conversation['content'][-1]['id_post'])
 
-                    general_info = f"\n###Informacion General del Curso llamado {course_name}\n"
-                    course_general_content = "###Contenido General del Curso:\n"
-                    course_content_embedding = []
-                    course_activities = []
+            if conversation['id_user'] != user_id:
+                teacher = False
 
+                for rol in conversation["content"][-1]["user_roles"]:
+                    if rol in ('teacher', 'editingteacher'):
+                        teacher = True
 
-                    # Get course content embeding
-                    course_content = moodle.get_course_contents(course_id)
+                if not teacher:
+                    messages = conversation["content"]
+
+                    # Chat history (solo se arman los mensajes nuevos de la discusion)
+                    chat = session.chat_history(messages, chat_interaction)
+
+
+                    # Embeddings de los posts nuevos (una sola request). Con ellos se obtienen los de la ultima
+                    # pregunta, el mensaje inicial y la conversacion (promedio de los ultimos mensajes), que se
+                    # usan para clasificar la consulta y para buscar contenido relacionado
+                    conversation_text = " ".join([message["text"] for message in messages[-sessions.CONVERSATION_WINDOW:]])
+                    question_text = messages[-1]["text"]
+                    opening_text = messages[0]["text"]
+                    conversation_embedding = question_embedding = opening_embedding = None
+                    try:
+                        missing = session.missing_embeddings(messages)
+                        if missing:
+                            with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                                session.add_embeddings(missing, await IA.embedding_service.embed_many([message["text"] for message in missing]))
+                        trace.event("embeddings de la discusion", new_posts=len(missing), cached_posts=len(session.embeddings) - len(missing))
+
+                        question_embedding = session.embedding(messages[-1])
+                        opening_embedding = session.embedding(messages[0])
+                        conversation_embedding = session.conversation_embedding(messages)
+
+                    except requests.exceptions.RequestException as e:
+                        # Si la API de embeddings falla, se clasifica con el LLM y se busca solo con BM25
+                        trace.event("embeddings no disponibles, usando busqueda lexica", error=repr(e))
+
+
+                    # Determine intent of the conversation (se clasifica el mensaje inicial, una vez por discusion)
+                    tags = intent_classifier.TAGS
+                    if session.intent and session.intent[0] == messages[0]["id_post"]:
+                        intent = session.intent[1]
+                        trace.event("intencion de la sesion")
+                    else:
+                        try:
+                            with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                                # En un hilo: puede calcular los centroides o consultar al LLM
+                                intent = await asyncio.to_thread(intent_classifier.classify, opening_text, opening_embedding, tags, model=plan.model)
+                            session.intent = (messages[0]["id_post"], intent)
+                        except requests.exceptions.Timeout as e:
+                            # Sin tiempo para clasificar: se trata como consulta de contenido
+                            intent = "Consulta de contenido"
+                            trace.event("plazo agotado al clasificar la consulta", error=repr(e))
 
+                    trace.event("intencion", intent=intent, recognized=any(tag['name'] in intent for tag in tags))
 
-                    for section in course_content:
-                        print(f"\n📚 Sección: {section['name']}")
-                        course_general_content += f"\nSección: {section['name']}\n"
 
-                        for module in section.get("modules", []):
-                            print(f"  📄 Recurso: {module['name']} - tipo: {module['modname']}")
-                            course_general_content += f"* Archivo/Actividad: {module['name']}\n"
 
-                            match module["modname"]:
-                                case "resource":
-                                    for content in module.get("contents", []):
-                                        if "mimetype" in content and content["mimetype"] == "application/pdf":
-                                            download = moodle.download_file(content["fileurl"], content["mimetype"])
+                    # Get course content
+                    course_name = next((course["fullname"] for course in courses if course["id"] == course_id), "None")
 
-                                            if section['name'].lower() == "informacion general":
-                                                general_info += f"\nFuente de la informacion (nombre del archivo): {module['name']}\nContenido del archivo:\n{download}\n"
+                    general_info = f"\n###Informacion General del Curso llamado {course_name}\n"
+                    course_activities = []
+                    course_activities_info = ""
+
+
+                    # Modelo del curso (secciones, modulos y archivos): se arma una vez por version del contenido.
+                    # En un hilo: las respuestas simultaneas del mismo curso comparten el pedido (single-flight)
+                    try:
+                        with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                            model = await asyncio.to_thread(course_model.get_course_model, course_id)
+                    except requests.exceptions.Timeout as e:
+                        # Sin tiempo para pedir el contenido: el ultimo modelo en memoria, o la respuesta de respaldo
+                        model = course_model.get_cached_model(course_id)
+                        trace.event("plazo agotado al pedir el contenido del curso", stale_model=model is not None, error=repr(e))
+                        if model is None:
+                            await reply_fallback(conversation['content'][-1]['id_post'], e)
+                            continue
+                    course_general_content = model.outline
+
+                    # Get course content embeding (solo los PDF de los recursos, se reutiliza mientras no cambien)
+                    try:
+                        with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                            index = await asyncio.to_thread(course_index.get_course_index, course_id, model)
+                    except requests.exceptions.Timeout as e:
+                        # Sin tiempo para (re)construir el indice: el ultimo que haya en memoria, o ninguno
+                        index = course_index.get_cached_index(course_id)
+                        trace.event("plazo agotado al preparar el indice del curso", stale_index=index is not None, error=repr(e))
+
+                    lexical_index = BM25Index()
+                    course_content_embedding = None
+                    if index is not None:
+                        general_info += index.general_info
+                        lexical_index = index.lexical_index
+                        course_content_embedding = index.embedding_store
 
-                                            else:
-                                                course_content_embedding.append({"source": module['name'], "text": download, "embedding": None})
-                        
-                    
                     # Get course activities embeding
                     if "consulta de actividad" in intent:
-                        print("**********Obteniendo actividades del curso**********\n")
-                        assignments = moodle.get_course_assignaments(course_id)
+                        try:
+                            with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                                assignments = await asyncio.to_thread(moodle.get_course_assignaments, course_id)
+                        except requests.exceptions.Timeout as e:
+                            assignments = []
+                            trace.event("plazo agotado al pedir las actividades del curso", error=repr(e))
 
                         for assignment in assignments:
-                            section_name = next((section["name"] for section in course_content if any(module["id"] == assignment["cmid"] for module in section["modules"])), "Unknown Section")
+                            section_name = model.section_name(assignment["cmid"])
                             assignment_info = f"\nActividad: {assignment['name']}\nSección: {section_name}\nDescripción: {assignment.get('intro', 'Sin descripción')}\n"
-                            course_general_content += f"\n{assignment_info}"
-
-                            print(assignment_info)
+                            course_activities_info += f"\n{assignment_info}"
 
                             # Check for downloadable content in the assignment
                             if "introattachments" in assignment:
                                 for attachment in assignment["introattachments"]:
                                     if "mimetype" in attachment and attachment["mimetype"] == "application/pdf":
-                                        download = moodle.download_file(attachment["fileurl"], attachment["mimetype"])
+                                        try:
+                                            with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                                                download = await asyncio.to_thread(moodle.download_file, attachment["fileurl"], attachment["mimetype"])
+                                        except requests.exceptions.Timeout:
+                                            trace.event("plazo agotado al descargar adjuntos de actividades")
+                                            continue
                                         course_activities.append({"source": assignment['name'], "text": download})
 
 
                     # search related content
-                    print("**********Vectorizando**********\n")
-                    conversation_text = " ".join([message["text"] for message in conversation["content"][-5:]])
-                    conversation_embedding = IA.get_embedding(conversation_text)
-                    question_embedding = IA.get_embedding(conversation["content"][-1]["text"])
-
-                    print("**********Buscando contenido relacionado**********\n")
-                    course_content_embedding = IA.get_embeding_list(course_content_embedding)
-                    question_related_content = IA.find_similar_content(question_embedding, course_content_embedding)
-                    conversation_realted_content = IA.find_similar_content(conversation_embedding, course_content_embedding)
+                    # Pregunta y conversacion en una sola busqueda: un ranking fusionado, sin fragmentos repetidos
+                    queries = [question_text, conversation_text][:plan.max_searches]
+                    query_embeddings = None
+                    if question_embedding is not None and conversation_embedding is not None:
+                        query_embeddings = [question_embedding, conversation_embedding][:plan.max_searches]
+
+                    related_chunks = session.cached_search(index.version, queries) if index is not None else None
+                    if related_chunks is not None:
+                        trace.event("busqueda de la sesion", results=len(related_chunks))
+                    elif index is None and session.last_search:
+                        # Sin indice (plazo agotado): lo que se encontro para el mensaje anterior de la discusion
+                        related_chunks = session.last_search[2]
+                        trace.event("sin indice, usando la ultima busqueda de la sesion", results=len(related_chunks))
+                    else:
+                        with trace.span("search.multi", queries=len(queries), vector=query_embeddings is not None) as info:
+                            try:
+                                # En un hilo: con cursos grandes puede usar el indice aproximado (ver tools/ann.py)
+                                related_chunks = await asyncio.to_thread(multi_search, queries, query_embeddings, lexical_index, course_content_embedding, top_n=CONTENT_TOP_N * len(queries))
+                            except ValueError as e:
+                                # Embeddings del indice incompatibles con los de la consulta (ej. indice viejo de otro
+                                # proveedor de embeddings): solo busqueda lexica
+                                trace.event("embeddings del indice incompatibles, usando busqueda lexica", error=repr(e))
+                                query_embeddings = None
+                                related_chunks = await asyncio.to_thread(multi_search, queries, None, lexical_index, None, top_n=CONTENT_TOP_N * len(queries))
+                            info["results"] = len(related_chunks)
+                        if index is not None and query_embeddings is not None:
+                            session.last_search = (index.version, queries, related_chunks)
 
                     # search related activities
                     question_related_activities = ""
-                    if course_activities:
-                        print("**********Buscando actividades relacionadas**********\n")
+                    left = deadline.remaining()
+                    if course_activities and plan.activity_selection and (left is None or left > ANSWER_RESERVE_SECONDS):
                         prompt = "Las siguientes son las actividades del curso, busca la que puedan ser mas util para responder la pregunta. devuelve el nombre (source) y el texto (text) de la actividad. sin agregar o modificar nada\n"
 
                         for activity in course_activities:
                             prompt += f"\n ### Source: {activity['source']} ###\n{activity['text']}\n"
 
-                        question_related_activities = IA.generate_response(conversation['content'][-1]['text'], prompt, chat)
+                        try:
+                            with deadline.reserve(ANSWER_RESERVE_SECONDS):
+                                question_related_activities = await asyncio.to_thread(IA.generate_response, conversation['content'][-1]['text'], prompt, chat, model=plan.model, prompt_cache_key=f"actividades-{course_id}", stage="activity_selection")
+                        except requests.exceptions.Timeout as e:
+                            trace.event("plazo agotado al seleccionar actividades", error=repr(e))
 
 
 
 
-                    # system prompt
-                    with open(r"files/system_prompts/Forum_Respond.txt", "r") as file:
-                        # Read the system prompt template
-                        system_prompt = file.read()
+                    # system prompt: prefijo fijo del curso (template + informacion general + estructura)
+                    # y al final todo lo que depende de la pregunta, para aprovechar el cache de prompts
+                    course_prefix = build_course_prefix("Forum_Respond", general_info, course_general_content)
+                    sections = []
 
-                    # include general information
-                    system_prompt += f"{general_info}"
-                    system_prompt += f"{course_general_content}"
+                    # include course activities
+                    if "consulta de actividad" in intent:
+                        sections.append(course_activities_info)
 
                     # include course content
                     if "consulta general" not in intent:
-                        system_prompt += "\n###Contenido del curso que podria ser util para responder (no es todo el contenido). Intenta no desviarte mucho de este contenido en tus respuestas"
-                        for content in question_related_content:
-                            system_prompt += f"\nFuente de la informacion (nombre del archivo): {content['source']}:\n{content['text']}\n"
+                        related_content = "\n###Contenido del curso que podria ser util para responder (no es todo el contenido). Intenta no desviarte mucho de este contenido en tus respuestas"
+                        for content in related_chunks:
+                            related_content += f"\nFuente de la informacion (nombre del archivo): {content['source']}:\n{content['text']}\n"
 
-                        if conversation_realted_content:
-                            for content in conversation_realted_content:
-                                if content['text'] not in system_prompt:
-                                    system_prompt += f"\nFuente de la informacion (nombre del archivo): {content['source']}:\n{content['text']}\n"
+                        sections.append(related_content)
 
-                    # include course activities
+                    # include related activities
                     if "consulta de actividad" in intent:
                         if question_related_activities:
-                            system_prompt += "\n###Contenido de acividades que podria ser util para responder."
-                            system_prompt += f"\n{question_related_activities}\n"
+                            sections.append(f"\n###Contenido de acividades que podria ser util para responder.\n{question_related_activities}\n")
 
+                    system_prompt = assemble_system_prompt(course_prefix, sections)
+                    trace.event("prompt armado", prefix_chars=len(course_prefix), prompt_chars=len(system_prompt))
 
 
-                    # response
-                    print("**********Respondiendo**********\n")
-                    await asyncio.to_thread(
-                        moodle.reply_to_post,
-                        conversation['content'][-1]['id_post'],
-                        IA.generate_response(conversation['content'][-1]['text'], system_prompt, chat)
-                    )
+                    # response (si no se llega a generar dentro del plazo, se publica la respuesta de respaldo)
+                    try:
+                        with deadline.reserve(POST_RESERVE_SECONDS):
+                            answer = await asyncio.to_thread(IA.generate_response, conversation['content'][-1]['text'], system_prompt, chat, model=plan.model, prompt_cache_key=f"curso-{course_id}")
+                        trace.set_attributes(outcome="respondida")
+
+                    except requests.exceptions.Timeout as e:
+                        await reply_fallback(conversation['content'][-1]['id_post'], e)
+                        continue
+
+                    await asyncio.to_thread(moodle.reply_to_post, conversation['content'][-1]['id_post'], answer)
 
                 
                 else:
-                    print("**********El utimo mensaje fue de un profesor**********\n")
+                    trace.event("el ultimo mensaje fue de un profesor")
             else:
-                print("**********El utimo mensaje fue del asistente**********\n")
+                trace.event("el ultimo mensaje fue del asistente")
     else:
-        print("**********El asistente no esta en el curso**********\n")
+        trace.set_attributes(outcome="el asistente no esta en el curso")
 
 
     
@@ -232,7 +560,7 @@ async def respond_discussion_test(discussion_id: int, course_id: int = None):
         print("2. El asistente si esta en el curso")
 
         conversations = moodle.get_discussion_posts(discussion_id)
-        conversations = moodle.get_conversations(conversations['posts'][0], course_id)
+        conversations = moodle.get_conversations(conversations['posts'][0], course_id, warm_state.get_course_roster(course_id))
 
         for conversation in conversations:
             print("3. analizando conversacion...")
@@ -242,7 +570,7 @@ async def respond_discussion_test(discussion_id: int, course_id: int = None):
                 print("4. El utimo mensaje no fue del asistente")
 
                 for rol in conversation["content"][-1]["user_roles"]:
-                    if rol['shortname'] in ('teacher', 'editingteacher'):
+                    if rol in ('teacher', 'editingteacher'):
                         teacher = True
 
                 if not teacher:
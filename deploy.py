@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import secrets
 import signal
 import subprocess
 import sys
@@ -11,10 +12,10 @@ BASE_DIR = Path(__file__).parent.resolve()
 def mostrar_help():
     texto = f"""
 Uso:
-  python3 deploy.py activar --nombre NOMBRE --archivo ARCHIVO [--obj OBJ] [--puerto PUERTO]
+  python3 deploy.py activar --nombre NOMBRE --archivo ARCHIVO [--obj OBJ] [--puerto PUERTO] [--nodos N]
   python3 deploy.py desactivar --pid PID
   python3 deploy.py listar
-  python3 deploy.py reiniciar --nombre NOMBRE --archivo ARCHIVO [--obj OBJ] [--puerto PUERTO]
+  python3 deploy.py reiniciar --nombre NOMBRE --archivo ARCHIVO [--obj OBJ] [--puerto PUERTO] [--nodos N]
   python3 deploy.py help
 
 Notas:
@@ -22,6 +23,8 @@ Notas:
 - El entorno virtual debe estar en: {BASE_DIR}/env
 - --archivo es el .py relativo a esta carpeta (ej. main.py o api/main.py).
 - --obj es el nombre del objeto ASGI dentro del archivo (default: app).
+- --nodos N levanta N procesos de un worker (puertos PUERTO..PUERTO+N-1) que se reparten los cursos
+  (cada curso se atiende siempre en el mismo nodo). Sin --nodos se levanta un proceso con 4 workers.
 
 Ejemplo:
   python3 deploy.py activar --nombre app --archivo main.py --puerto 8765
@@ -38,7 +41,7 @@ def _to_import_path(archivo: str) -> str:
     rel = file_path.relative_to(BASE_DIR).with_suffix("")
     return ".".join(rel.parts)
 
-def levantar_uvicorn_bg(nombre: str, puerto: int, archivo: str, obj: str):
+def levantar_uvicorn_bg(nombre: str, puerto: int, archivo: str, obj: str, workers: int = 4, env_extra: dict | None = None):
     venv_path = BASE_DIR / "env"
     if not (venv_path / "bin" / "uvicorn").exists():
         raise FileNotFoundError(f"No se encontró uvicorn en el venv: {venv_path}")
@@ -53,7 +56,7 @@ def levantar_uvicorn_bg(nombre: str, puerto: int, archivo: str, obj: str):
         target,
         "--host", "0.0.0.0",
         "--port", str(puerto),
-        "--workers", "4",
+        "--workers", str(workers),
     ]
 
     log_file = BASE_DIR / f"{nombre}.log"
@@ -61,6 +64,7 @@ def levantar_uvicorn_bg(nombre: str, puerto: int, archivo: str, obj: str):
 
     env = os.environ.copy()
     env["PYTHONUNBUFFERED"] = "1"
+    env.update(env_extra or {})
 
     with open(log_file, "a") as log:
         proceso = subprocess.Popen(
@@ -101,17 +105,35 @@ def listar_servicios():
             pid = "N/A"
         print(f"{nombre:<20} {pid:<10} {estado:<10}")
 
-def reiniciar_servicio(nombre: str, puerto: int, archivo: str, obj: str):
-    pid_file = BASE_DIR / f"{nombre}.pid"
-    if pid_file.exists():
-        try:
-            pid = int(pid_file.read_text().strip())
-            detener_por_pid(pid)
-        except ValueError:
-            print(f"PID inválido en {pid_file}")
+def levantar_nodos_bg(nombre: str, puerto: int, archivo: str, obj: str, nodos: int):
+    """Levanta 'nodos' procesos de un worker, cada uno con su NODE_URL y la lista de todos los nodos."""
+    urls = [f"http://127.0.0.1:{puerto + i}" for i in range(nodos)]
+    token = os.getenv("CLUSTER_TOKEN") or secrets.token_hex(16)
+
+    for i, url in enumerate(urls):
+        env_extra = {"NODE_URL": url, "CLUSTER_NODES": ",".join(urls), "CLUSTER_TOKEN": token}
+        levantar_uvicorn_bg(f"{nombre}-{i}", puerto + i, archivo, obj, workers=1, env_extra=env_extra)
+
+def _detener_por_pid_file(pid_file: Path):
+    try:
+        pid = int(pid_file.read_text().strip())
+        detener_por_pid(pid)
+    except ValueError:
+        print(f"PID inválido en {pid_file}")
+
+def reiniciar_servicio(nombre: str, puerto: int, archivo: str, obj: str, nodos: int | None = None):
+    pid_files = [BASE_DIR / f"{nombre}.pid"] + sorted(BASE_DIR.glob(f"{nombre}-*.pid"))
+    pid_files = [pid_file for pid_file in pid_files if pid_file.exists()]
+    if pid_files:
+        for pid_file in pid_files:
+            _detener_por_pid_file(pid_file)
     else:
         print(f"No se encontró PID file para '{nombre}'")
-    levantar_uvicorn_bg(nombre, puerto, archivo, obj)
+
+    if nodos:
+        levantar_nodos_bg(nombre, puerto, archivo, obj, nodos)
+    else:
+        levantar_uvicorn_bg(nombre, puerto, archivo, obj)
 
 def parse_args():
     parser = argparse.ArgumentParser(add_help=False)
@@ -121,6 +143,7 @@ def parse_args():
     parser.add_argument("--pid", type=int, help="PID a detener (para desactivar)")
     parser.add_argument("--archivo", help="Archivo Python relativo a la carpeta base (ej. main.py o api/main.py)")
     parser.add_argument("--obj", default="app", help="Nombre del objeto ASGI dentro del archivo (default: app)")
+    parser.add_argument("--nodos", type=int, help="Cantidad de nodos de un worker con afinidad de cursos")
 
     args = parser.parse_args()
 
@@ -144,13 +167,16 @@ def main():
     args = parse_args()
 
     if args.operacion == "activar":
-        levantar_uvicorn_bg(args.nombre, args.puerto, args.archivo, args.obj)
+        if args.nodos:
+            levantar_nodos_bg(args.nombre, args.puerto, args.archivo, args.obj, args.nodos)
+        else:
+            levantar_uvicorn_bg(args.nombre, args.puerto, args.archivo, args.obj)
     elif args.operacion == "desactivar":
         detener_por_pid(args.pid)
     elif args.operacion == "listar":
         listar_servicios()
     elif args.operacion == "reiniciar":
-        reiniciar_servicio(args.nombre, args.puerto, args.archivo, args.obj)
+        reiniciar_servicio(args.nombre, args.puerto, args.archivo, args.obj, args.nodos)
 
 if __name__ == "__main__":
     main()
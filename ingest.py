@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Ingesta masiva (offline) del contenido de los cursos.
+
+Recorre todos los cursos del asistente (de cada sitio Moodle), descarga y extrae sus archivos en
+paralelo en un pool de procesos, los divide en fragmentos, calcula los embeddings y deja los
+snapshots en files/snapshots/ listos para que los workers los carguen al iniciar.
+Conviene correrlo antes de empezar el cuatrimestre o despues de subir mucho material, asi la primera
+pregunta de cada curso no paga la ingesta.
+
+Es reanudable: los cursos cuyo snapshot ya corresponde a la version actual del contenido se saltean,
+y el texto de cada archivo ya extraido se reutiliza (files/snapshots/extracted/).
+
+Uso:
+  python3 ingest.py [--procesos N] [--sitio ID ...] [--cursos ID ...] [--forzar]
+"""
+import argparse
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+
+import tools.moodle as moodle
+import tools.sites as sites
+import tools.IA as IA
+import tools.usage as usage
+import tools.course_index as course_index
+import tools.course_model as course_model
+
+
+@dataclass(slots=True)
+class CourseJob:
+    site_id: str
+    course_id: int
+    name: str
+    files: list[moodle.CourseFile]
+    version: str
+    texts: list = field(default_factory=list)
+    pending: int = 0
+    failed: bool = False
+
+
+def _extract_job(site_id: str, file: moodle.CourseFile) -> str:
+    """
+    Corre en un proceso del pool: descarga y extrae el texto de un archivo (o lo lee de files/snapshots/extracted/).
+    """
+    sites.current_site.set(sites.get_site(site_id))
+    return course_index.extract_file(file)
+
+
+def _finish_course(job: CourseJob) -> tuple[int, int]:
+    """
+    Corre en el proceso principal (un solo limitador de la API de embeddings para toda la ingesta):
+    fragmenta, vectoriza y guarda el snapshot. Devuelve (fragmentos, tokens vectorizados).
+    """
+    sites.current_site.set(sites.get_site(job.site_id))
+    usage.current_course.set(job.course_id)
+
+    index = course_index.assemble_course_index(job.course_id, job.files, job.texts, job.version)
+    if index.embedding_store is None:
+        raise RuntimeError("la API de embeddings no estuvo disponible")
+
+    course_index.save_snapshot(index)
+    tokens = sum(IA.count_tokens(record["text"], course_index.EMBEDDING_MODEL) for record in index.records)
+    return len(index.records), tokens
+
+
+def plan_jobs(site_ids: list[str], course_ids: set[int] | None, force: bool) -> list[CourseJob]:
+    """
+    Lista los cursos a procesar: los que no tienen snapshot de la version actual de su contenido (o todos con --forzar).
+    """
+    jobs = []
+    for site_id in site_ids:
+        sites.current_site.set(sites.get_site(site_id))
+        user_id = moodle.get_self_id()["userid"]
+
+        for course in moodle.get_user_courses(user_id):
+            if course_ids and course["id"] not in course_ids:
+                continue
+
+            files = course_model.get_course_model(course["id"]).files()
+            version = course_index.content_version(files)
+
+            snapshot = course_index.load_snapshot(course["id"])
+            if not force and snapshot and snapshot.version == version and snapshot.embedding_store is not None:
+                # Con otras dimensiones de embeddings: se recorta si se puede, si no se vuelve a vectorizar
+                if course_index.migrate_dimensions(snapshot) is not None:
+                    print(f"= {site_id} curso {course['id']} ({course['fullname']}): snapshot al dia")
+                    continue
+
+            jobs.append(CourseJob(site_id, course["id"], course["fullname"], files, version, [None] * len(files), len(files)))
+
+    return jobs
+
+
+def run(jobs: list[CourseJob], processes: int):
+    started = time.time()
+    total_files = sum(len(job.files) for job in jobs)
+    done_files = 0
+    done_tokens = 0
+    done_courses = 0
+
+    def report(job: CourseJob, chunks: int, tokens: int):
+        elapsed = max(time.time() - started, 1e-9)
+        print(
+            f"[{done_courses}/{len(jobs)}] {job.site_id} curso {job.course_id} ({job.name}): "
+            f"{len(job.files)} archivos, {chunks} fragmentos, {tokens} tokens | "
+            f"total {done_files}/{total_files} archivos, {done_files / elapsed:.2f} archivos/s, {done_tokens / elapsed:.0f} tokens/s"
+        )
+
+    # spawn: los procesos no heredan las conexiones HTTP abiertas del proceso principal
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool, ThreadPoolExecutor(max_workers=1) as embedder:
+        extractions = {}
+        for job in jobs:
+            for i, file in enumerate(job.files):
+                extractions[pool.submit(_extract_job, job.site_id, file)] = (job, i)
+
+        finishing = {}
+        for job in jobs:
+            if not job.files:
+                finishing[embedder.submit(_finish_course, job)] = job
+
+        # Los cursos se vectorizan apenas terminan de extraerse sus archivos, mientras siguen las descargas
+        pending = set(extractions) | set(finishing)
+        while pending:
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in completed:
+                if future in extractions:
+                    job, i = extractions[future]
+                    job.pending -= 1
+                    done_files += 1
+
+                    try:
+                        job.texts[i] = future.result()
+                    except Exception as e:
+                        if not job.failed:
+                            print(f"x {job.site_id} curso {job.course_id}: error al extraer {job.files[i].filename}: {e}")
+                        job.failed = True
+
+                    if job.pending == 0 and not job.failed:
+                        finish = embedder.submit(_finish_course, job)
+                        finishing[finish] = job
+                        pending.add(finish)
+
+                else:
+                    job = finishing[future]
+                    try:
+                        chunks, tokens = future.result()
+                    except Exception as e:
+                        print(f"x {job.site_id} curso {job.course_id}: {e}")
+                        continue
+
+                    done_courses += 1
+                    done_tokens += tokens
+                    report(job, chunks, tokens)
+
+    elapsed = max(time.time() - started, 1e-9)
+    print(
+        f"\nIngesta terminada en {elapsed:.1f}s: {done_courses}/{len(jobs)} cursos, {done_files} archivos "
+        f"({done_files / elapsed:.2f} archivos/s), {done_tokens} tokens ({done_tokens / elapsed:.0f} tokens/s)"
+    )
+    if done_courses < len(jobs):
+        print("Algunos cursos fallaron: volver a correr el comando retoma solo los pendientes.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Construye en paralelo los indices (snapshots) de todos los cursos del asistente.")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 4, help="Procesos para descargar y extraer archivos (default: cantidad de CPUs)")
+    parser.add_argument("--sitio", nargs="+", help="Sitios a procesar (default: todos)")
+    parser.add_argument("--cursos", nargs="+", type=int, help="Ids de cursos a procesar (default: todos)")
+    parser.add_argument("--forzar", action="store_true", help="Reconstruir aunque el snapshot este al dia")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    site_ids = args.sitio or [site.id for site in sites.all_sites()]
+
+    jobs = plan_jobs(site_ids, set(args.cursos) if args.cursos else None, args.forzar)
+    if not jobs:
+        print("Todos los cursos estan al dia.")
+        return
+
+    print(f"Procesando {len(jobs)} cursos ({sum(len(job.files) for job in jobs)} archivos) con {args.procesos} procesos...\n")
+    run(jobs, args.procesos)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,351 @@
+from __future__ import annotations
+
 import os
+import re
+import time
+import base64
+import asyncio
+import threading
 import requests
+from functools import lru_cache
+
+# Librerias pesadas: se cargan recien cuando se usan (ver tools.tools.LazyModule)
+from tools.tools import lazy_import
+
+# Los encodings de tiktoken se guardan junto al snapshot de arranque, asi un worker nuevo no los descarga
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "files", "snapshots", "tiktoken"))
 
 # Calcular Tokens
-import tiktoken
+tiktoken = lazy_import("tiktoken")
 
 # Busqueda por similitud de embedings (diferencia de cocenos)
-import faiss
-import numpy as np
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
+
+# Trazas por respuesta y registro de uso de tokens
+import tools.trace as trace
+import tools.usage as usage
+
+# Timeouts derivados del plazo de la respuesta
+import tools.deadline as deadline
+
+# Indices aproximados (HNSW, IVF) para almacenes grandes
+import tools.ann as ann
+
+# Proveedores de chat y embeddings (OpenAI, servidor local compatible, modelo en CPU)
+import tools.providers as providers
+
+
+# Limites de la cuenta (se corrigen solos con los headers x-ratelimit-* de cada respuesta)
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "30000"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
 
+# Dimensiones de los embeddings (parametro 'dimensions' de la API). 0 = las del modelo (1536 en text-embedding-3-small).
+# Al cambiarlo, los indices guardados se migran solos (ver course_index.migrate_dimensions)
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))
 
-# Variables de entorno
-API_KEY = os.getenv("OPENAI_API_KEY")
-API_URL = "https://api.openai.com/v1/chat/completions"
+# Dimensiones completas de cada modelo de embeddings
+MODEL_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536
+}
 
+# Modelos que aceptan 'dimensions' (sus vectores se pueden recortar y volver a normalizar)
+SHORTENABLE_MODELS = ("text-embedding-3-small", "text-embedding-3-large")
 
-def generate_response(prompt: str, system_prompt: str = "", chat_history: list[dict] = [], model: str = "gpt-4.1") -> str:
+# Formato en el que se guardan los vectores en memoria: float32 | float16 | int8
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float32")
+
+# Limites de /v1/embeddings por request
+EMBEDDING_MAX_INPUTS = 2048
+EMBEDDING_MAX_TOKENS_PER_REQUEST = 300000
+EMBEDDING_MAX_TOKENS_PER_INPUT = 8191
+
+# Cuanto espera el servicio de embeddings para juntar pedidos de distintas tareas en una sola request
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "10"))
+
+# Tokens que reservamos para la respuesta del modelo (OpenAI tambien los cuenta en el TPM)
+COMPLETION_TOKENS_ESTIMATE = 1000
+
+
+def _parse_reset(value: str | None) -> float:
+    """
+    Convierte los tiempos de reset que manda OpenAI ("1s", "6m0s", "20ms", "1h2m3.5s") a segundos.
     """
-    Función para realizar solicitud con contexto
+    if not value:
+        return 0.0
+
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        amount = float(amount)
+        match unit:
+            case "ms":
+                seconds += amount / 1000
+            case "s":
+                seconds += amount
+            case "m":
+                seconds += amount * 60
+            case "h":
+                seconds += amount * 3600
+    return seconds
+
+
+class RateLimiter:
+    """
+    Limitador del lado del cliente para la API de OpenAI (un token bucket por requests y otro por tokens).
+
+    - Antes de cada llamada se reserva 1 request y los tokens estimados (con tiktoken).
+      Si no alcanza, la llamada espera en cola hasta que el bucket se recargue.
+    - Despues de cada respuesta se leen los headers x-ratelimit-* para corregir los limites
+      y el saldo real que informa la API.
+    - La concurrencia se adapta (AIMD): sube de a 1 mientras sobre cuota, y se reduce a la mitad ante un 429.
     """
 
-    url = API_URL
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
+    def __init__(self, requests_per_minute: int = OPENAI_RPM, tokens_per_minute: int = OPENAI_TPM, max_concurrency: int = OPENAI_MAX_CONCURRENCY):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._available_requests = min(self.requests_per_minute, self._available_requests + elapsed * self.requests_per_minute / 60)
+        self._available_tokens = min(self.tokens_per_minute, self._available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int):
+        """
+        Bloquea hasta que haya cupo para una request de 'tokens' tokens. No falla, solo espera,
+        salvo que se agote el plazo de la respuesta antes de conseguir cupo (deadline.DeadlineExceeded).
+        """
+        # Una request mas grande que el limite por minuto nunca entraria en el bucket
+        tokens = min(tokens, self.tokens_per_minute)
+
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._in_flight >= self.concurrency:
+                    wait = None  # Esperar a que termine otra llamada
+                elif self._available_requests < 1:
+                    wait = (1 - self._available_requests) * 60 / self.requests_per_minute
+                elif self._available_tokens < tokens:
+                    wait = (tokens - self._available_tokens) * 60 / self.tokens_per_minute
+                else:
+                    self._available_requests -= 1
+                    self._available_tokens -= tokens
+                    self._in_flight += 1
+                    return
+
+                left = deadline.remaining()
+                if left is not None:
+                    if left <= 0:
+                        raise deadline.DeadlineExceeded("Se agoto el plazo esperando cupo de la API de OpenAI")
+                    wait = left if wait is None else min(wait, left)
+
+                self._condition.wait(timeout=wait)
+
+    def release(self, status_code: int | None = None, headers: dict | None = None, refund_tokens: int = 0):
+        """
+        Libera el lugar de la llamada y ajusta limites y concurrencia segun la respuesta.
+        Si no hubo respuesta (error de conexion o timeout) se pasan los tokens reservados en 'refund_tokens':
+        vuelven al bucket junto con la request (si la API los llego a contar, los headers de la proxima respuesta corrigen el saldo).
+        """
+        headers = headers or {}
+
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            self._refill(now)
+
+            if refund_tokens:
+                self._available_requests = min(self.requests_per_minute, self._available_requests + 1)
+                self._available_tokens = min(self.tokens_per_minute, self._available_tokens + min(refund_tokens, self.tokens_per_minute))
+
+            # Limites reales de la cuenta
+            if headers.get("x-ratelimit-limit-requests"):
+                self.requests_per_minute = int(headers["x-ratelimit-limit-requests"])
+            if headers.get("x-ratelimit-limit-tokens"):
+                self.tokens_per_minute = int(headers["x-ratelimit-limit-tokens"])
+
+            # Saldo real (puede ser menor al nuestro si hay otros procesos usando la misma key)
+            if headers.get("x-ratelimit-remaining-requests"):
+                self._available_requests = min(self._available_requests, float(headers["x-ratelimit-remaining-requests"]))
+            if headers.get("x-ratelimit-remaining-tokens"):
+                self._available_tokens = min(self._available_tokens, float(headers["x-ratelimit-remaining-tokens"]))
+
+            if status_code == 429:
+                # Nos pasamos: reducir concurrencia y pausar hasta el reset
+                self.concurrency = max(1, self.concurrency // 2)
+                retry_after = headers.get("retry-after")
+                pause = float(retry_after) if retry_after else max(
+                    _parse_reset(headers.get("x-ratelimit-reset-requests")),
+                    _parse_reset(headers.get("x-ratelimit-reset-tokens")),
+                    1.0
+                )
+                self._blocked_until = max(self._blocked_until, now + pause)
+
+            elif status_code is not None and status_code < 400:
+                remaining = headers.get("x-ratelimit-remaining-tokens")
+                if remaining is not None and float(remaining) < self.tokens_per_minute * 0.1:
+                    self.concurrency = max(1, self.concurrency - 1)
+                elif self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+
+            self._condition.notify_all()
+
+
+# Un limitador por modelo (OpenAI aplica los limites por modelo)
+_rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            _rate_limiters[model] = RateLimiter()
+        return _rate_limiters[model]
+
+
+def report_usage(data: dict, model: str, stage: str) -> dict:
+    """
+    Lee el bloque 'usage' de una respuesta de chat, lo guarda en el registro de uso
+    y muestra cuantos tokens del prompt salieron del cache.
+    Devuelve {"prompt_tokens", "completion_tokens", "cached_tokens"}.
+    """
+    reported = data.get("usage") or {}
+    details = reported.get("prompt_tokens_details") or {}
+    counts = {
+        "prompt_tokens": reported.get("prompt_tokens", 0),
+        "completion_tokens": reported.get("completion_tokens", 0),
+        "cached_tokens": details.get("cached_tokens", 0)
     }
+    print(f"Tokens: prompt {counts['prompt_tokens']} (cacheados {counts['cached_tokens']}), respuesta {counts['completion_tokens']}")
+    usage.record(model, stage, **counts)
+    return counts
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """
+    Encoding de tiktoken del modelo, o None si no se pudo cargar (el fallo tambien queda en cache,
+    para no reintentar la descarga del encoding en cada conteo).
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"No se pudo cargar el encoding de tiktoken para {model}: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-4.1") -> int:
+    """
+    Cuenta los tokens de un texto con tiktoken. Si no se puede cargar el encoding, estima ~4 caracteres por token.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _count_message_tokens(messages: list[dict], model: str) -> int:
+    # ~4 tokens extra por mensaje por el formato del chat
+    return sum(count_tokens(message["content"] or "", model) + 4 for message in messages) + 3
+
+
+def _retry_after(headers) -> float | None:
+    """Segundos de espera que pide el servidor (header retry-after), o None."""
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _post_openai(url: str, body: dict, tokens: int, provider: "providers.HTTPProvider | None" = None) -> requests.Response:
+    """
+    Realiza una llamada a la API de OpenAI (o a un servidor compatible, ver tools/providers.py) pasando
+    por el limitador del modelo. Los servidores locales no pasan por el limitador.
+    Los 429 (y errores transitorios del servidor) se reintentan esperando lo que indique la API;
+    la llamada queda en cola, no falla, salvo que se agote el plazo de la respuesta (deadline.DeadlineExceeded).
+    Sin limitador, despues de 5 respuestas 429 seguidas se devuelve la ultima.
+    """
+    provider = provider or providers.chat()
+    limiter = get_rate_limiter(body["model"]) if provider.rate_limited else None
+    headers = provider.headers()
+
+    server_errors = rate_limited = 0
+    while True:
+        if limiter:
+            limiter.acquire(tokens)
+        else:
+            deadline.check()
+        response = error = None
+        try:
+            response = requests.post(url, headers=headers, json=body, timeout=deadline.timeout(deadline.OPENAI_READ_TIMEOUT))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = e
+        finally:
+            # El lugar se libera siempre (cualquier error, ej. ChunkedEncodingError); sin respuesta se devuelven los tokens
+            if limiter:
+                if response is None:
+                    limiter.release(refund_tokens=tokens)
+                else:
+                    limiter.release(response.status_code, response.headers)
+
+        if response is None:
+            server_errors += 1
+            if server_errors > 5:
+                raise error
+            deadline.sleep(min(2 ** server_errors, 30))
+            continue
+
+        if response.status_code == 429:
+            # Sin saldo en la cuenta no es un limite temporal: no tiene sentido reintentar
+            if "insufficient_quota" in response.text:
+                return response
+            print(f"429 de {provider.name}: esperando cupo para reintentar...")
+            trace.event("openai 429", model=body["model"], concurrency=limiter.concurrency if limiter else None)
+            if not limiter:
+                # Sin limitador (servidor local) no hay pausa hasta el reset: se espera aca, con un maximo de intentos
+                rate_limited += 1
+                if rate_limited > 5:
+                    return response
+                deadline.sleep(_retry_after(response.headers) or min(2 ** rate_limited, 30))
+            continue
+
+        if response.status_code in (500, 502, 503, 504) and server_errors < 5:
+            server_errors += 1
+            deadline.sleep(min(2 ** server_errors, 30))
+            continue
+
+        return response
+
+
+def generate_response(prompt: str, system_prompt: str = "", chat_history: list[dict] = [], model: str = "gpt-4.1", prompt_cache_key: str | None = None, stage: str = "answer") -> str:
+    """
+    Función para realizar solicitud con contexto.
+    prompt_cache_key agrupa las llamadas que comparten prefijo (ej. por curso) para que OpenAI reutilice su cache.
+    stage identifica la etapa en el registro de uso de tokens (answer, activity_selection, etc.).
+    El proveedor (OpenAI o un servidor local) se elige con CHAT_PROVIDER.
+    """
+
+    provider = providers.chat()
+    url = provider.chat_url
 
     messages = [{"role": "system", "content": system_prompt}]   # Cargar system prompt
     messages.extend(chat_history)                               # Cargar mensajes previos
@@ -31,16 +353,25 @@ def generate_response(prompt: str, system_prompt: str = "", chat_history: list[d
 
     # Cargar el contenido de la conversacion al body
     body = {
-        "model": model,
+        "model": provider.chat_model_for(model),
         "messages": messages
     }
+    if prompt_cache_key and provider.name == "openai":
+        body["prompt_cache_key"] = prompt_cache_key
 
     # realizamos la solicitud y guardamos una respuesta
-    response = requests.post(url, headers=headers, json=body)
+    tokens = _count_message_tokens(messages, model) + COMPLETION_TOKENS_ESTIMATE
+    with trace.span("openai.chat", provider=provider.name, model=body["model"], stage=stage, estimated_tokens=tokens) as info:
+        response = _post_openai(url, body, tokens, provider)
+        info["status"] = response.status_code
+
+        if response.status_code == 200:
+            # Extraemos el texto de la respuesta y lo devolvemos
+            data = response.json()
+            info.update(report_usage(data, model, stage))
+            info["cache"] = "hit" if info["cached_tokens"] else "miss"
 
     if response.status_code == 200:
-        # Extraemos el texto de la respuesta y lo devolvemos
-        data = response.json()
         reply = data["choices"][0]["message"]["content"]
         return reply
     else:
@@ -63,11 +394,8 @@ def get_tag(prompt: str, tags: list[dict], system_prompt: str = "", chat_history
         list[str]: Lista de nombres de tags asignados.
     """
 
-    url = API_URL
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
+    provider = providers.chat()
+    url = provider.chat_url
 
     # Crear un mensaje con la lista de tags formateada
     tags_description = "\n".join([f"- {tag['name']}: {tag['description']}" for tag in tags])
@@ -79,16 +407,22 @@ def get_tag(prompt: str, tags: list[dict], system_prompt: str = "", chat_history
 
     # Cargar el contenido de la conversación al body
     body = {
-        "model": model,
+        "model": provider.chat_model_for(model),
         "messages": messages
     }
 
     # Realizamos la solicitud y guardamos una respuesta
-    response = requests.post(url, headers=headers, json=body)
+    tokens = _count_message_tokens(messages, model) + COMPLETION_TOKENS_ESTIMATE
+    with trace.span("openai.tag", provider=provider.name, model=body["model"], estimated_tokens=tokens) as info:
+        response = _post_openai(url, body, tokens, provider)
+        info["status"] = response.status_code
+
+        if response.status_code == 200:
+            data = response.json()
+            info.update(report_usage(data, model, "tag"))
 
     if response.status_code == 200:
         # Extraemos el texto de la respuesta y lo devolvemos como lista de tags
-        data = response.json()
         reply = data["choices"][0]["message"]["content"]
         try:
             assigned_tags = eval(reply)  # Convertir la respuesta en lista
@@ -106,32 +440,107 @@ def get_tag(prompt: str, tags: list[dict], system_prompt: str = "", chat_history
         return []
 
 
-def get_embedding(text: str, model: str = "text-embedding-3-small") -> list:
+def embedding_dimensions(model: str = "text-embedding-3-small") -> int | None:
+    """
+    Dimensiones con las que se piden los embeddings de 'model' (EMBEDDING_DIMENSIONS, o las del modelo).
+    None si el modelo no es conocido y no se configuro EMBEDDING_DIMENSIONS, o si los embeddings
+    no vienen de OpenAI (las dimensiones las define el modelo del proveedor).
+    """
+    if providers.embeddings().name != "openai":
+        return None
+    native = MODEL_DIMENSIONS.get(model)
+    if EMBEDDING_DIMENSIONS and model in SHORTENABLE_MODELS:
+        return min(EMBEDDING_DIMENSIONS, native)
+    return native
+
+
+def embedding_id(model: str = "text-embedding-3-small") -> str:
+    """Proveedor y modelo de los embeddings (vectores de distinto origen no se pueden comparar)."""
+    return providers.embeddings().embedding_id(model)
+
+
+def fit_dimensions(vectors, dim: int) -> np.ndarray:
+    """
+    Recorta vectores de text-embedding-3 a sus primeras 'dim' dimensiones y los vuelve a normalizar
+    (equivale a pedirlos con dimensions=dim). No se puede ampliar: para mas dimensiones hay que volver a pedirlos.
+    """
+    vectors = np.array(vectors, dtype=np.float32, copy=True)
+    if vectors.shape[-1] < dim:
+        raise ValueError(f"No se pueden ampliar embeddings de {vectors.shape[-1]} a {dim} dimensiones.")
+    vectors = np.ascontiguousarray(vectors[..., :dim])
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _post_embeddings(texts: list[str], model: str = "text-embedding-3-small", courses: list[int | None] | None = None) -> np.ndarray:
+    """
+    Pide los embeddings de una lista de textos en una sola request.
+    Los vectores se piden en base64 y se decodifican directo a un array float32 (n x dim),
+    sin pasar por listas de floats de Python (si el servidor devuelve listas de floats, tambien se aceptan).
+    Si la request junta textos de varios cursos, 'courses' indica el curso de cada texto
+    para repartir los tokens en el registro de uso.
+    Con EMBEDDING_DIMENSIONS los vectores vienen recortados por la API (dim = embedding_dimensions(model)).
+    El proveedor se elige con EMBEDDING_PROVIDER; con el modelo en CPU no hay request (ni uso de tokens que registrar).
+    """
+    provider = providers.embeddings()
+    if isinstance(provider, providers.CPUEmbeddingProvider):
+        with trace.span("cpu.embeddings", inputs=len(texts)):
+            return provider.embed(texts)
+
+    data = {
+        "input": texts,
+        "model": provider.embedding_model_for(model),
+        "encoding_format": "base64"
+    }
+    dimensions = embedding_dimensions(model)
+    if dimensions and dimensions != MODEL_DIMENSIONS.get(model):
+        data["dimensions"] = dimensions
+    token_counts = [count_tokens(text, model) for text in texts]
+    tokens = sum(token_counts)
+    with trace.span("openai.embeddings", provider=provider.name, model=data["model"], inputs=len(texts), dimensions=dimensions, estimated_tokens=tokens) as info:
+        response = _post_openai(provider.embeddings_url, data, tokens, provider)
+        info["status"] = response.status_code
+        info["bytes"] = len(response.content)
+        response.raise_for_status()  # Lanza excepción si hubo error
+
+        result = response.json()
+        info["prompt_tokens"] = result.get("usage", {}).get("prompt_tokens", 0)
+
+    if courses is None:
+        usage.record(model, "embeddings", prompt_tokens=info["prompt_tokens"])
+    else:
+        # Repartir los tokens reales en proporcion a los estimados de cada texto
+        per_course = {}
+        for course_id, count in zip(courses, token_counts):
+            per_course[course_id] = per_course.get(course_id, 0) + count
+        for course_id, count in per_course.items():
+            usage.record(model, "embeddings", prompt_tokens=round(info["prompt_tokens"] * count / max(tokens, 1)), course_id=course_id)
+
+    items = sorted(result["data"], key=lambda item: item["index"])
+    return np.vstack([_decode_embedding(item["embedding"]) for item in items])
+
+
+def _decode_embedding(embedding) -> np.ndarray:
+    # Algunos servidores compatibles ignoran encoding_format y devuelven la lista de floats
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def get_embedding(text: str, model: str = "text-embedding-3-small") -> np.ndarray:
     """
     Genera un embedding para un texto dado usando la API de OpenAI.
 
     Parámetros:
         text (str): El texto a convertir en embedding.
-        api_key (str): Tu clave de API de OpenAI.
         model (str): Modelo de embedding (por defecto: text-embedding-3-small).
 
     Retorna:
-        list: Vector embedding (lista de floats).
+        np.ndarray: Vector embedding (float32).
     """
 
-    url = "https://api.openai.com/v1/embeddings"
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "input": text,
-        "model": model
-    }
-
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()  # Lanza excepción si hubo error
-    return response.json()["data"][0]["embedding"]
+    return _post_embeddings([text], model)[0]
 
 
 def get_embeding_list(records, model: str = "text-embedding-3-small", skip_existing: bool = True, batch_size: int | None = None):
@@ -149,8 +558,9 @@ def get_embeding_list(records, model: str = "text-embedding-3-small", skip_exist
                                Si int -> procesa en lotes de ese tamaño.
 
     Retorna:
-        La misma estructura 'records' con el campo "embedding" agregado/actualizado.
+        La misma estructura 'records' con el campo "embedding" (np.ndarray float32) agregado/actualizado.
         (Modifica en sitio y también lo devuelve por conveniencia).
+        Para busquedas conviene usar 'build_embedding_store', que no arma un vector por dict.
     """
 
     # Permitir pasar un único dict y normalizar a lista
@@ -167,84 +577,436 @@ def get_embeding_list(records, model: str = "text-embedding-3-small", skip_exist
     if not indices_to_embed:
         return records[0] if single_input else records  # Nada que hacer
 
-    def _post_embeddings(texts_chunk: list[str]) -> list[list[float]]:
-        url = "https://api.openai.com/v1/embeddings"
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
-        data = {
-            "input": texts_chunk,
-            "model": model
-        }
-        resp = requests.post(url, headers=headers, json=data)
-        resp.raise_for_status()
-        return [data["embedding"] for data in resp.json()["data"]]
-
     # Armar textos en el orden de indices_to_embed
     texts = [records[i]["text"] for i in indices_to_embed]
+    vectors = embed_texts(texts, model, batch_size)
+
+    for idx, vec in zip(indices_to_embed, vectors):
+        records[idx]["embedding"] = vec
+
+    return records[0] if single_input else records
+
+
+def _split_embedding_batches(token_counts: list[int], max_inputs: int = EMBEDDING_MAX_INPUTS, max_tokens: int = EMBEDDING_MAX_TOKENS_PER_REQUEST) -> list[list[int]]:
+    """
+    Agrupa indices de textos en lotes que respetan los limites de /v1/embeddings
+    (cantidad de inputs y tokens por request). Un texto que supera el limite por input
+    va solo en su lote, asi si la API lo rechaza no arrastra al resto.
+    """
+    batches = []
+    current, current_tokens = [], 0
+
+    for i, tokens in enumerate(token_counts):
+        if tokens > EMBEDDING_MAX_TOKENS_PER_INPUT:
+            batches.append([i])
+            continue
+
+        if current and (len(current) >= max_inputs or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+
+        current.append(i)
+        current_tokens += tokens
 
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def embed_texts(texts: list[str], model: str = "text-embedding-3-small", batch_size: int | None = None) -> np.ndarray:
+    """
+    Devuelve los embeddings de 'texts' como una unica matriz float32 (n x dim), en el mismo orden.
+    Si batch_size es None se usan las menos requests posibles dentro de los limites de la API,
+    si no, una request por lote de batch_size textos.
+    """
     if batch_size is None:
-        # UNA SOLA REQUEST
-        vectors = _post_embeddings(texts)
-        for idx, vec in zip(indices_to_embed, vectors):
-            records[idx]["embedding"] = vec
+        batches = _split_embedding_batches([count_tokens(text, model) for text in texts])
     else:
-        # En lotes (por si alguna vez lo necesitás)
-        start = 0
-        while start < len(texts):
-            end = start + batch_size
-            chunk = texts[start:end]
-            chunk_indices = indices_to_embed[start:end]
-            vectors = _post_embeddings(chunk)
-            for i, vec in zip(chunk_indices, vectors):
-                records[i]["embedding"] = vec
-            start = end
+        batches = [list(range(start, min(start + batch_size, len(texts)))) for start in range(0, len(texts), batch_size)]
 
-    return records[0] if single_input else records
+    if len(batches) == 1:
+        return _post_embeddings(texts, model)
+
+    vectors = None
+    for batch in batches:
+        batch_vectors = _post_embeddings([texts[i] for i in batch], model)
+        if vectors is None:
+            vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+        vectors[batch] = batch_vectors
+
+    return vectors
 
 
-def find_similar_content(query_embedding: list[float], documents: list[dict], top_n: int = 1) -> list[dict]:
+class EmbeddingBatcher:
     """
-    Encuentra los `top_n` documentos más similares a un embedding de consulta, utilizando FAISS
-    con **similitud coseno** (producto interno sobre vectores normalizados).
+    Servicio de embeddings compartido por todas las tareas en curso del worker.
+
+    Los pedidos que llegan dentro de una ventana de unos milisegundos se juntan y se mandan
+    en una sola llamada a /v1/embeddings (respetando los limites de inputs y tokens por request);
+    despues cada llamador recibe solo su vector. Textos repetidos se piden una sola vez.
+    """
+
+    def __init__(self, model: str = "text-embedding-3-small", window_ms: float = EMBEDDING_BATCH_WINDOW_MS):
+        self.model = model
+        self.window = window_ms / 1000
+        self._pending: dict[str, list[asyncio.Future]] = {}
+        self._courses: dict[str, int | None] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    async def embed(self, text: str) -> np.ndarray:
+        """
+        Devuelve el embedding de 'text' (float32), compartiendo la request con los demas pedidos de la ventana.
+        No espera mas alla del plazo del llamador (deadline.DeadlineExceeded); la request compartida sigue para los demas.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(text, []).append(future)
+        self._courses.setdefault(text, usage.current_course.get())
+
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_later())
+
+        left = deadline.remaining()
+        if left is None:
+            return await future
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(left, 0))
+        except asyncio.TimeoutError:
+            raise deadline.DeadlineExceeded("Se agoto el plazo esperando embeddings")
+
+    async def embed_many(self, texts: list[str]) -> np.ndarray:
+        """
+        Igual que embed, para varios textos a la vez. Devuelve una matriz (n x dim) en el mismo orden.
+        """
+        return np.vstack(await asyncio.gather(*(self.embed(text) for text in texts)))
+
+    async def _flush_later(self):
+        # Con el modelo en CPU no hay request que ahorrar: solo se juntan los pedidos del mismo ciclo del loop
+        await asyncio.sleep(0 if isinstance(providers.embeddings(), providers.CPUEmbeddingProvider) else self.window)
+
+        pending, self._pending = self._pending, {}
+        courses, self._courses = self._courses, {}
+        self._flush_task = None
+
+        texts = list(pending)
+        batches = _split_embedding_batches([count_tokens(text, self.model) for text in texts])
+
+        # La tarea copio el contexto del primer llamador: la request compartida no usa su plazo sino uno propio
+        # (cada llamador deja de esperar al vencer el suyo, ver embed)
+        with deadline.extend(deadline.SHARED_DEADLINE_SECONDS):
+            await asyncio.gather(*(self._send([texts[i] for i in batch], pending, courses) for batch in batches))
+
+    async def _send(self, texts: list[str], pending: dict[str, list[asyncio.Future]], courses: dict[str, int | None]):
+        try:
+            vectors = await asyncio.to_thread(_post_embeddings, texts, self.model, [courses[text] for text in texts])
+        except Exception as e:
+            for text in texts:
+                for future in pending[text]:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for text, vector in zip(texts, vectors):
+            for future in pending[text]:
+                if not future.done():
+                    future.set_result(vector)
+
+
+# Servicio de embeddings compartido por el worker
+embedding_service = EmbeddingBatcher()
+
+
+class EmbeddingStore:
+    """
+    Almacen compacto de embeddings para busqueda por similitud coseno.
+
+    Los vectores viven en un unico array NumPy contiguo (n x dim), ya normalizados (L2 = 1),
+    y la metadata (source, text) en listas paralelas. Asi la busqueda no tiene que
+    reconstruir la matriz en cada consulta.
+    Con muchos vectores (ver tools.ann) 'search' usa un indice aproximado que se arma la primera vez
+    que se busca y no se guarda en el snapshot.
+    Todos los vectores tienen la dimension del almacen ('dim'). Una consulta con mas dimensiones se
+    recorta a 'dim' (text-embedding-3); nunca se comparan vectores de distinta dimension.
+
+    dtype:
+        - "float32": sin perdida (4 bytes por dimension).
+        - "float16": la mitad de memoria, perdida despreciable para coseno.
+        - "int8":    un cuarto de memoria, cuantizacion por fila (escala = max|x| / 127).
+    """
+
+    DTYPES = ("float32", "float16", "int8")
+
+    # Filas que se descomprimen a float32 por vez al buscar sobre float16/int8
+    BLOCK_SIZE = 4096
+
+    def __init__(self, dim: int, dtype: str = "float32"):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"dtype de embeddings no soportado: {dtype}. Opciones: {self.DTYPES}")
+
+        self.dim = dim
+        self.dtype = dtype
+        self.vectors = np.empty((0, dim), dtype=np.int8 if dtype == "int8" else dtype)
+        self.scales = np.empty(0, dtype=np.float32)     # Solo se usa con int8
+        self.sources: list[str] = []
+        self.texts: list[str] = []
+        self._ann = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_ann"] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        state.setdefault("_ann", None)
+        self.__dict__.update(state)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria ocupada por los vectores (sin contar los textos)."""
+        return self.vectors.nbytes + self.scales.nbytes
+
+    def add(self, vectors: np.ndarray, sources: list[str], texts: list[str]):
+        """
+        Agrega vectores (n x dim) con su metadata. Los vectores se normalizan y se convierten al dtype del almacen.
+        """
+        vectors = np.array(vectors, dtype=np.float32, copy=True).reshape(-1, self.dim)
+        if not (len(vectors) == len(sources) == len(texts)):
+            raise ValueError("La cantidad de vectores, sources y textos no coincide.")
+
+        faiss.normalize_L2(vectors)
+
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            codes = np.round(vectors / scales[:, None]).astype(np.int8)
+            self.vectors = np.concatenate([self.vectors, codes])
+            self.scales = np.concatenate([self.scales, scales.astype(np.float32)])
+        else:
+            self.vectors = np.concatenate([self.vectors, vectors.astype(self.dtype)])
+
+        self.sources.extend(sources)
+        self.texts.extend(texts)
+        self._ann = None
+
+    def truncated(self, dim: int) -> "EmbeddingStore":
+        """
+        Copia del almacen con los vectores recortados a 'dim' dimensiones y normalizados (migracion de dimensiones).
+        """
+        store = EmbeddingStore(dim=dim, dtype=self.dtype)
+        for start in range(0, len(self), self.BLOCK_SIZE):
+            end = start + self.BLOCK_SIZE
+            store.add(fit_dimensions(self.dense(start, end), dim), self.sources[start:end], self.texts[start:end])
+        return store
+
+    def _fit_queries(self, query_embeddings) -> np.ndarray:
+        queries = np.array(query_embeddings, dtype=np.float32, copy=True).reshape(-1, np.shape(query_embeddings)[-1])
+        if queries.shape[1] > self.dim:
+            queries = fit_dimensions(queries, self.dim)
+        elif queries.shape[1] < self.dim:
+            raise ValueError("Dimensión de embeddings inconsistente entre documentos y/o query.")
+        faiss.normalize_L2(queries)
+        return queries
+
+    def dense(self, start: int = 0, end: int | None = None) -> np.ndarray:
+        """Vectores normalizados en float32 (filas start:end)."""
+        block = self.vectors[start:end].astype(np.float32)
+        if self.dtype == "int8":
+            block *= self.scales[start:end, None]
+        return block
+
+    def prepare_ann(self) -> bool:
+        """
+        Construye ahora el indice aproximado si el almacen lo va a usar (ver tools.ann), para que no se
+        construya en la primera busqueda de una respuesta. Devuelve True si lo usa.
+        """
+        if not ann.use_ann(len(self)):
+            return False
+        self._ann_index()
+        return True
+
+    def _ann_index(self) -> "ann.VectorIndex":
+        if self._ann is None:
+            with trace.span("ann.build", backend=ann.ANN_BACKEND, vectors=len(self)):
+                vectors = np.vstack([self.dense(start, start + self.BLOCK_SIZE) for start in range(0, len(self), self.BLOCK_SIZE)])
+                self._ann = ann.build_index(vectors)
+        return self._ann
+
+    def _scores(self, query: np.ndarray) -> np.ndarray:
+        # float32: un solo producto matriz-vector sobre el array contiguo
+        if self.dtype == "float32":
+            return self.vectors @ query
+
+        # float16/int8: se descomprime por bloques para no duplicar toda la matriz en memoria
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), self.BLOCK_SIZE):
+            end = start + self.BLOCK_SIZE
+            block = self.vectors[start:end].astype(np.float32)
+            scores[start:end] = block @ query
+            if self.dtype == "int8":
+                scores[start:end] *= self.scales[start:end]
+        return scores
+
+    def scores(self, query_embedding) -> np.ndarray:
+        """
+        Devuelve la similitud coseno de 'query_embedding' contra cada documento del almacen.
+        """
+        return self._scores(self._fit_queries(query_embedding)[0])
+
+    def _rows(self, ids: np.ndarray) -> np.ndarray:
+        """Vectores normalizados en float32 de las filas 'ids'."""
+        rows = self.vectors[ids].astype(np.float32)
+        if self.dtype == "int8":
+            rows *= self.scales[ids, None]
+        return rows
+
+    def scores_many(self, query_embeddings, top_k: int | None = None) -> np.ndarray:
+        """
+        Similitud coseno de varias consultas a la vez: un solo producto matriz-matriz sobre el almacen.
+        Devuelve una matriz (documentos x consultas).
+        Con 'top_k' y un almacen grande (ver tools.ann) solo se calcula el coseno exacto de los
+        top_k * ANN_RERANK_FACTOR candidatos del indice aproximado de cada consulta; el resto queda con el
+        puntaje del peor candidato.
+        """
+        queries = self._fit_queries(query_embeddings)
+
+        if top_k is not None and ann.use_ann(len(self)):
+            _, ids = self._ann_index().search(queries, top_k * ann.ANN_RERANK_FACTOR)
+            scores = np.empty((len(self), len(queries)), dtype=np.float32)
+            for column, row in enumerate(ids):
+                candidates = row[row >= 0]
+                exact = self._rows(candidates) @ queries[column]
+                # Los que no son candidatos se parecen a lo sumo como el peor candidato (cota para la fusion con BM25)
+                scores[:, column] = exact.min() if len(exact) else 0
+                scores[candidates, column] = exact
+            return scores
+
+        if self.dtype == "float32":
+            return self.vectors @ queries.T
+
+        scores = np.empty((len(self), len(queries)), dtype=np.float32)
+        for start in range(0, len(self), self.BLOCK_SIZE):
+            end = start + self.BLOCK_SIZE
+            block = self.vectors[start:end].astype(np.float32)
+            scores[start:end] = block @ queries.T
+            if self.dtype == "int8":
+                scores[start:end] *= self.scales[start:end, None]
+        return scores
+
+    def search(self, query_embedding, top_n: int = 1) -> list[dict]:
+        """
+        Devuelve los top_n documentos mas similares (coseno) a 'query_embedding', con el mismo formato que find_similar_content.
+        """
+        if len(self) == 0:
+            return []
+
+        # Asegurar límites de top_n
+        top_n = max(1, min(top_n, len(self)))
+
+        if ann.use_ann(len(self)):
+            # Candidatos del indice aproximado, reordenados con el coseno exacto
+            query = self._fit_queries(query_embedding)
+            _, ids = self._ann_index().search(query, top_n * ann.ANN_RERANK_FACTOR)
+            candidates = ids[0][ids[0] >= 0]
+            exact = self._rows(candidates) @ query[0]
+            order = np.argsort(-exact)[:top_n]
+            best, best_scores = candidates[order], exact[order]
+        else:
+            scores = self.scores(query_embedding)
+            best = np.argpartition(-scores, top_n - 1)[:top_n]
+            best = best[np.argsort(-scores[best])]
+            best_scores = scores[best]
+
+        return [
+            {
+                "rank": rank,
+                "similarity_score": float(score),           # coseno (más alto = mejor)
+                "source": self.sources[idx],
+                "text": self.texts[idx]
+            }
+            for rank, (idx, score) in enumerate(zip(best, best_scores), start=1)
+        ]
+
+
+def build_embedding_store(records: list[dict], model: str = "text-embedding-3-small", dtype: str = EMBEDDING_STORAGE_DTYPE, batch_size: int | None = None) -> EmbeddingStore:
+    """
+    Vectoriza una lista de registros {"source", "text"} y los guarda en un EmbeddingStore.
+    Los embeddings decodificados van directo al array del almacen, sin pasar por los dicts.
+    Si algun registro ya trae "embedding" (con al menos las dimensiones configuradas), se reutiliza recortado.
+    """
+    if not records:
+        return EmbeddingStore(dim=0, dtype=dtype)
+
+    dim = embedding_dimensions(model)
+    reusable = [
+        i for i, rec in enumerate(records)
+        if rec.get("embedding") is not None and (dim is None or len(rec["embedding"]) >= dim)
+    ]
+    if dim is None and reusable:
+        dim = min(len(records[i]["embedding"]) for i in reusable)
+
+    reused = set(reusable)
+    missing = [i for i in range(len(records)) if i not in reused]
+    vectors = None
+    if missing:
+        new_vectors = embed_texts([records[i]["text"] for i in missing], model, batch_size)
+        dim = new_vectors.shape[1]
+        vectors = np.empty((len(records), dim), dtype=np.float32)
+        vectors[missing] = new_vectors
+    else:
+        vectors = np.empty((len(records), dim), dtype=np.float32)
+
+    for i in reusable:
+        vectors[i] = fit_dimensions(records[i]["embedding"], dim)
+
+    store = EmbeddingStore(dim=vectors.shape[1], dtype=dtype)
+    store.add(vectors, [rec.get("source", "desconocido") for rec in records], [rec["text"] for rec in records])
+    return store
+
+
+def find_similar_content(query_embedding, documents: "EmbeddingStore | list[dict]", top_n: int = 1) -> list[dict]:
+    """
+    Encuentra los `top_n` documentos más similares a un embedding de consulta, utilizando
+    **similitud coseno** (producto interno sobre vectores normalizados).
 
     Parámetros:
-        query_embedding (list[float]): Vector de embedding de la consulta del usuario.
-        documents (list[dict]): Lista de documentos, cada uno con:
+        query_embedding (np.ndarray | list[float]): Vector de embedding de la consulta del usuario.
+        documents (EmbeddingStore | list[dict]): Almacen de embeddings, o lista de documentos, cada uno con:
             {
                 "text": str,
                 "source": str,
-                "embedding": list[float]
+                "embedding": np.ndarray | list[float]
             }
         top_n (int): Cantidad de documentos más similares a retornar.
 
     Retorna:
         list[dict]: Lista de los top_n documentos más relevantes con su score de similitud (coseno).
     """
+    if isinstance(documents, EmbeddingStore):
+        return documents.search(query_embedding, top_n)
+
     if not documents:
         return []
 
-    # Paso 1: Convertir embeddings de los documentos a matriz NumPy float32
-    embedding_dim = len(documents[0]["embedding"])
-    doc_vectors = np.array([doc["embedding"] for doc in documents], dtype="float32")
-
-    # Validación simple de dimensiones (opcional)
-    if doc_vectors.shape[1] != embedding_dim or len(query_embedding) != embedding_dim:
+    # Paso 1: Convertir embeddings de los documentos a matriz NumPy float32.
+    # Si hay vectores de distintas dimensiones (ej. durante una migracion) todos se recortan a la menor
+    embedding_dim = min(len(doc["embedding"]) for doc in documents)
+    if len(query_embedding) < embedding_dim:
         raise ValueError("Dimensión de embeddings inconsistente entre documentos y/o query.")
+    doc_vectors = np.vstack([fit_dimensions(doc["embedding"], embedding_dim) for doc in documents])
 
     # Paso 2: Normalizar documentos (L2 = 1) para que IP == coseno
     faiss.normalize_L2(doc_vectors)
 
-    # Paso 3: Crear índice FAISS basado en producto interno (equivale a coseno con vectores normalizados)
-    index = faiss.IndexFlatIP(embedding_dim)
-
-    # Paso 4: Agregar los vectores al índice
-    index.add(doc_vectors)
+    # Paso 3 y 4: Crear el índice FAISS por producto interno (equivale a coseno con vectores normalizados)
+    # con los vectores. Exacto salvo que haya muchos documentos y ANN_BACKEND indique uno aproximado
+    index = ann.build_index(doc_vectors, ann.ANN_BACKEND if ann.use_ann(len(documents)) else "flat")
 
     # Paso 5: Convertir y normalizar el embedding de la query a matriz 2D (1 x embedding_dim)
-    query_vector = np.array(query_embedding, dtype="float32").reshape(1, -1)
-    faiss.normalize_L2(query_vector)
+    query_vector = fit_dimensions(np.reshape(query_embedding, (1, -1)), embedding_dim)
 
     # Asegurar límites de top_n
     top_n = max(1, min(top_n, len(documents)))
@@ -255,6 +1017,8 @@ def find_similar_content(query_embedding: list[float], documents: list[dict], to
     # Paso 7: Devolver los resultados ordenados con sus scores
     results = []
     for i, (idx, score) in enumerate(zip(indices[0], scores[0]), start=1):
+        if idx < 0:
+            break
         doc = documents[idx]
         results.append({
             "rank": i,
@@ -0,0 +1,272 @@
+# Indices de vecinos cercanos (ANN) para la busqueda por embeddings
+#
+# Para un curso alcanza con la busqueda exacta (un producto matriz-vector sobre el EmbeddingStore).
+# Con indices grandes (varios cursos, todo un campus) conviene un indice aproximado de FAISS:
+#   - flat:  exacto (IndexFlatIP). Referencia para medir recall.
+#   - hnsw:  grafo HNSW. Muy rapido y con buen recall, ocupa mas memoria que los vectores.
+#   - ivf:   listas invertidas (k-means). Se busca solo en las ANN_IVF_NPROBE listas mas cercanas.
+#   - ivfpq: listas invertidas con product quantization. Ocupa una fraccion de la memoria (recall menor).
+# El backend se elige con ANN_BACKEND; por debajo de ANN_MIN_VECTORS se usa siempre la busqueda exacta.
+#
+# Benchmark (tiempo de construccion, memoria, latencia y recall@k contra la busqueda exacta):
+#   python -m tools.ann --sintetico 200000 --dim 1536
+#   python -m tools.ann --snapshots
+from __future__ import annotations
+
+import os
+import glob
+import math
+import time
+import pickle
+import argparse
+
+from tools.tools import lazy_import
+
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOTS_DIR = os.path.join(BASE_DIR, "files", "snapshots")
+
+BACKENDS = ("flat", "hnsw", "ivf", "ivfpq")
+
+ANN_BACKEND = os.getenv("ANN_BACKEND", "flat")
+
+# Con menos vectores que esto la busqueda exacta es igual de rapida y no hay que construir nada
+ANN_MIN_VECTORS = int(os.getenv("ANN_MIN_VECTORS", "20000"))
+
+# Candidatos por resultado que se piden al indice aproximado y se reordenan con el coseno exacto
+ANN_RERANK_FACTOR = int(os.getenv("ANN_RERANK_FACTOR", "4"))
+
+# Parametros de cada backend
+ANN_HNSW_M = int(os.getenv("ANN_HNSW_M", "32"))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv("ANN_HNSW_EF_CONSTRUCTION", "80"))
+ANN_HNSW_EF_SEARCH = int(os.getenv("ANN_HNSW_EF_SEARCH", "64"))
+ANN_IVF_NLIST = int(os.getenv("ANN_IVF_NLIST", "0"))        # 0 = 4 * sqrt(n)
+ANN_IVF_NPROBE = int(os.getenv("ANN_IVF_NPROBE", "16"))
+ANN_PQ_M = int(os.getenv("ANN_PQ_M", "0"))                  # 0 = dim / 16 (subvectores de 16 dimensiones)
+ANN_PQ_BITS = 8
+
+# Vectores usados para entrenar k-means / PQ (entrenar con todo no mejora y tarda mucho mas)
+ANN_MAX_TRAIN = 100000
+
+
+class VectorIndex:
+    """
+    Indice FAISS por producto interno sobre vectores ya normalizados (producto interno == coseno).
+    Los ids son las posiciones de los vectores en el orden en que se agregaron (igual que en el EmbeddingStore).
+    """
+
+    backend = "flat"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.index = None
+
+    def _create(self, vectors: np.ndarray):
+        return faiss.IndexFlatIP(self.dim)
+
+    def build(self, vectors: np.ndarray) -> "VectorIndex":
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.index = self._create(vectors)
+        if not self.index.is_trained:
+            train = vectors
+            if len(vectors) > ANN_MAX_TRAIN:
+                train = vectors[np.random.default_rng(0).choice(len(vectors), ANN_MAX_TRAIN, replace=False)]
+            self.index.train(train)
+        self.index.add(vectors)
+        return self
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Devuelve (scores, ids), cada uno de (consultas x k). Los ids faltantes vienen como -1.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        return self.index.search(queries, min(k, self.index.ntotal))
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria aproximada del indice (tamanio serializado)."""
+        return int(faiss.serialize_index(self.index).nbytes)
+
+    def __len__(self) -> int:
+        return 0 if self.index is None else self.index.ntotal
+
+
+class HNSWIndex(VectorIndex):
+    backend = "hnsw"
+
+    def _create(self, vectors: np.ndarray):
+        index = faiss.IndexHNSWFlat(self.dim, ANN_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ANN_HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = ANN_HNSW_EF_SEARCH
+        return index
+
+
+class IVFIndex(VectorIndex):
+    backend = "ivf"
+
+    def _nlist(self, n: int) -> int:
+        nlist = ANN_IVF_NLIST or int(4 * math.sqrt(n))
+        # k-means necesita varios puntos por centroide
+        return max(1, min(nlist, n // 39))
+
+    def _create(self, vectors: np.ndarray):
+        self.quantizer = faiss.IndexFlatIP(self.dim)
+        index = faiss.IndexIVFFlat(self.quantizer, self.dim, self._nlist(len(vectors)), faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = ANN_IVF_NPROBE
+        return index
+
+
+class IVFPQIndex(IVFIndex):
+    backend = "ivfpq"
+
+    def _create(self, vectors: np.ndarray):
+        m = ANN_PQ_M or max(1, self.dim // 16)
+        while self.dim % m:
+            m -= 1
+
+        self.quantizer = faiss.IndexFlatIP(self.dim)
+        index = faiss.IndexIVFPQ(self.quantizer, self.dim, self._nlist(len(vectors)), m, ANN_PQ_BITS, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = ANN_IVF_NPROBE
+        return index
+
+
+_BACKEND_CLASSES = {cls.backend: cls for cls in (VectorIndex, HNSWIndex, IVFIndex, IVFPQIndex)}
+
+
+def build_index(vectors: np.ndarray, backend: str | None = None) -> VectorIndex:
+    """
+    Construye el indice del backend pedido (por defecto ANN_BACKEND) sobre vectores normalizados (n x dim).
+    IVF-PQ necesita al menos 2^ANN_PQ_BITS vectores para entrenar; con menos se usa el indice exacto.
+    """
+    backend = backend or ANN_BACKEND
+    if backend not in _BACKEND_CLASSES:
+        raise ValueError(f"Backend de ANN no soportado: {backend}. Opciones: {BACKENDS}")
+
+    if backend == "ivfpq" and len(vectors) < 2 ** ANN_PQ_BITS:
+        backend = "flat"
+
+    return _BACKEND_CLASSES[backend](vectors.shape[1]).build(vectors)
+
+
+def use_ann(n: int) -> bool:
+    """True si con 'n' vectores conviene el indice aproximado configurado."""
+    return ANN_BACKEND != "flat" and n >= ANN_MIN_VECTORS
+
+
+# === Benchmark ===
+
+def _synthetic(n: int, dim: int, queries: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectores agrupados alrededor de centros aleatorios (parecido a fragmentos de muchos documentos).
+    Las consultas son vectores del corpus con ruido.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 100), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+
+    sample = vectors[rng.integers(0, n, queries)] + 0.3 * rng.standard_normal((queries, dim)).astype(np.float32)
+    sample = sample.astype(np.float32)
+    faiss.normalize_L2(sample)
+    return vectors, sample
+
+
+def _recorded(queries: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray] | None:
+    """
+    Vectores de todos los snapshots de cursos (files/snapshots/*_course_*.pkl). Las consultas son
+    fragmentos del corpus con ruido (no se guardan las consultas reales).
+    """
+    from tools.IA import EmbeddingStore
+
+    blocks = []
+    for path in sorted(glob.glob(os.path.join(SNAPSHOTS_DIR, "*_course_*.pkl"))):
+        try:
+            with open(path, "rb") as file:
+                store = getattr(pickle.load(file), "embedding_store", None)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"No se pudo leer {path}: {e}")
+            continue
+        if isinstance(store, EmbeddingStore) and len(store):
+            if blocks and store.dim != blocks[0].shape[1]:
+                print(f"Se omite {path}: dimension {store.dim} distinta de {blocks[0].shape[1]}")
+                continue
+            blocks.append(store.dense())
+
+    if not blocks:
+        return None
+
+    vectors = np.vstack(blocks)
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.integers(0, len(vectors), queries)] + 0.05 * rng.standard_normal((queries, vectors.shape[1])).astype(np.float32)
+    sample = sample.astype(np.float32)
+    faiss.normalize_L2(sample)
+    return vectors, sample
+
+
+def benchmark(vectors: np.ndarray, queries: np.ndarray, k: int = 10, backends: tuple[str, ...] = BACKENDS) -> list[dict]:
+    """
+    Mide cada backend: construccion, memoria, latencia por consulta (de a una, como en una respuesta)
+    y recall@k contra la busqueda exacta.
+    """
+    exact = VectorIndex(vectors.shape[1]).build(vectors)
+    _, truth = exact.search(queries, k)
+
+    results = []
+    for backend in backends:
+        start = time.perf_counter()
+        index = _BACKEND_CLASSES[backend](vectors.shape[1]).build(vectors)
+        build_seconds = time.perf_counter() - start
+
+        latencies, hits = [], 0
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            _, ids = index.search(query, k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(set(ids[0].tolist()) & set(truth[i].tolist()))
+
+        latencies.sort()
+        results.append({
+            "backend": backend,
+            "build_s": build_seconds,
+            "memory_mb": index.nbytes / 1e6,
+            "p50_ms": 1000 * latencies[len(latencies) // 2],
+            "p95_ms": 1000 * latencies[int(len(latencies) * 0.95)],
+            "recall": hits / (len(queries) * min(k, len(vectors)))
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los indices de busqueda por embeddings.")
+    parser.add_argument("--sintetico", type=int, metavar="N", help="Corpus sintetico de N vectores")
+    parser.add_argument("--dim", type=int, default=1536, help="Dimension del corpus sintetico (default: 1536)")
+    parser.add_argument("--snapshots", action="store_true", help="Usar los embeddings de los snapshots de cursos")
+    parser.add_argument("--consultas", type=int, default=200, help="Cantidad de consultas (default: 200)")
+    parser.add_argument("--k", type=int, default=10, help="Resultados por consulta para recall@k (default: 10)")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    args = parser.parse_args()
+
+    corpora = []
+    if args.sintetico:
+        corpora.append((f"sintetico ({args.sintetico} x {args.dim})", _synthetic(args.sintetico, args.dim, args.consultas)))
+    if args.snapshots:
+        recorded = _recorded(args.consultas)
+        if recorded is None:
+            print("No hay snapshots de cursos con embeddings en files/snapshots/")
+        else:
+            corpora.append((f"snapshots ({len(recorded[0])} x {recorded[0].shape[1]})", recorded))
+    if not args.sintetico and not args.snapshots:
+        parser.error("Indicar --sintetico N y/o --snapshots")
+
+    for name, (vectors, queries) in corpora:
+        print(f"\nCorpus {name}, {len(queries)} consultas, recall@{args.k}")
+        print(f"{'Backend':<8} {'Construccion':>13} {'Memoria':>10} {'p50':>9} {'p95':>9} {'Recall':>8}")
+        for row in benchmark(vectors, queries, args.k, tuple(args.backends)):
+            print(f"{row['backend']:<8} {row['build_s']:>12.2f}s {row['memory_mb']:>8.1f}MB {row['p50_ms']:>7.2f}ms {row['p95_ms']:>7.2f}ms {row['recall']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+# Indice del contenido de un curso (PDF de los recursos, embeddings e indice lexico)
+#
+# Se construye una vez por version del contenido del curso y se guarda en memoria y en
+# files/snapshots/, asi las siguientes preguntas (y los workers que recien arrancan) no vuelven
+# a descargar, parsear ni vectorizar los mismos archivos.
+#
+# El texto de cada archivo se divide en fragmentos (chunks) de ~CHUNK_TOKENS tokens con un pequeño
+# solapamiento: el buscador devuelve el fragmento relevante y no el archivo completo.
+# El texto extraido de cada archivo tambien se guarda (files/snapshots/extracted/), asi un cambio en
+# un archivo solo vuelve a descargar ese archivo.
+import os
+import pickle
+import hashlib
+import threading
+from dataclasses import dataclass
+
+import requests
+
+import tools.moodle as moodle
+import tools.sites as sites
+import tools.course_model as course_model
+import tools.IA as IA
+import tools.trace as trace
+import tools.normalize as normalize
+from tools.lexical import BM25Index
+from tools.singleflight import SingleFlight
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOTS_DIR = os.path.join(BASE_DIR, "files", "snapshots")
+EXTRACTED_DIR = os.path.join(SNAPSHOTS_DIR, "extracted")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Tamaño de los fragmentos y solapamiento entre fragmentos consecutivos (tokens)
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "800"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "100"))
+
+# Seccion cuyos archivos van completos al prompt en lugar de al buscador
+GENERAL_INFO_SECTION = "informacion general"
+
+
+@dataclass(slots=True)
+class CourseIndex:
+    """
+    Contenido procesado de un curso:
+        -site_id         -> sitio Moodle del curso (los ids de curso se repiten entre sitios)
+        -version         -> hash de los archivos del curso (cambia si se agrega/modifica un archivo)
+        -general_info    -> texto de los archivos de la seccion "Informacion General"
+        -records         -> fragmentos del resto de los archivos ({"id": "<module_id>:<n>", "source", "text"})
+        -embedding_store -> embeddings de 'records' (None si la API de embeddings no estaba disponible)
+        -lexical_index   -> indice BM25 de 'records'
+    """
+    site_id: str
+    course_id: int
+    version: str
+    general_info: str
+    records: list[dict]
+    embedding_store: "IA.EmbeddingStore | None"
+    lexical_index: BM25Index
+
+
+# (site_id, course_id) -> CourseIndex
+_indexes: dict[tuple[str, int], CourseIndex] = {}
+_indexes_lock = threading.Lock()
+
+# Respuestas simultaneas del mismo curso comparten la extraccion de cada archivo y la construccion del indice
+_extract_flights = SingleFlight("extraccion de archivo")
+_build_flights = SingleFlight("indice del curso")
+
+
+def content_version(files: list[moodle.CourseFile]) -> str:
+    """
+    Version del contenido: cambia si se agrega, quita o modifica cualquier archivo del curso
+    (o si cambia el tamaño de los fragmentos, la normalizacion del texto o el proveedor de embeddings).
+    """
+    digest = hashlib.sha1()
+    digest.update(f"chunks:{CHUNK_TOKENS}:{CHUNK_OVERLAP_TOKENS}\n".encode())
+    digest.update(f"normalize:{normalize.NORMALIZATION_VERSION}\n".encode())
+    # Embeddings de otro proveedor o modelo (ver tools/providers.py) no se pueden comparar con los guardados
+    embedding_id = IA.embedding_id(EMBEDDING_MODEL)
+    if embedding_id != f"openai:{EMBEDDING_MODEL}":
+        digest.update(f"embeddings:{embedding_id}\n".encode())
+    for file in files:
+        digest.update(f"{file.module_id}|{file.fileurl}|{file.timemodified}|{file.section_name}\n".encode())
+    return digest.hexdigest()
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS) -> list[str]:
+    """
+    Divide un texto en fragmentos de hasta 'max_tokens' tokens, cortando entre lineas.
+    Cada fragmento repite las ultimas lineas del anterior (hasta 'overlap' tokens) para no perder
+    el contexto de una idea que quedo partida. Las lineas mas largas que max_tokens se cortan por palabras.
+    """
+    pieces = []     # (linea, tokens)
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        tokens = IA.count_tokens(line, EMBEDDING_MODEL)
+        if tokens <= max_tokens:
+            pieces.append((line, tokens))
+            continue
+
+        words = line.split()
+        step = max(1, len(words) * max_tokens // tokens)
+        for start in range(0, len(words), step):
+            part = " ".join(words[start:start + step])
+            pieces.append((part, IA.count_tokens(part, EMBEDDING_MODEL)))
+
+    chunks = []
+    current, current_tokens = [], 0
+    for piece, tokens in pieces:
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(line for line, _ in current))
+
+            # Solapamiento: las ultimas lineas del fragmento anterior
+            kept, kept_tokens = [], 0
+            for line, line_tokens in reversed(current):
+                if kept_tokens + line_tokens > overlap:
+                    break
+                kept.insert(0, (line, line_tokens))
+                kept_tokens += line_tokens
+            current, current_tokens = kept, kept_tokens
+
+        current.append((piece, tokens))
+        current_tokens += tokens
+
+    if current:
+        chunks.append("\n".join(line for line, _ in current))
+
+    return chunks
+
+
+def _extracted_path(file: moodle.CourseFile) -> str:
+    key = f"{sites.current().id}|{file.module_id}|{file.fileurl}|{file.timemodified}|normalize:{normalize.NORMALIZATION_VERSION}"
+    key = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(EXTRACTED_DIR, f"{key}.txt")
+
+
+def extract_file(file: moodle.CourseFile) -> str:
+    """
+    Texto de un archivo del curso. Se descarga y parsea solo si no se extrajo antes esta misma version del archivo
+    (y una sola vez aunque lo pidan varias tareas a la vez).
+    """
+    path = _extracted_path(file)
+    return _extract_flights.do(path, lambda: _extract_file(file, path))
+
+
+def _extract_file(file: moodle.CourseFile, path: str) -> str:
+    try:
+        with open(path, "r", encoding="utf-8") as cached:
+            return cached.read()
+    except FileNotFoundError:
+        pass
+
+    text = moodle.download_file(file.fileurl, file.mimetype)
+
+    os.makedirs(EXTRACTED_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as cached:
+        cached.write(text)
+    os.replace(tmp_path, path)
+
+    return text
+
+
+def build_course_index(course_id: int, files: list[moodle.CourseFile], version: str) -> CourseIndex:
+    """
+    Descarga y procesa los archivos del curso: la seccion "Informacion General" va como texto,
+    el resto se indexa (BM25 y embeddings).
+    """
+    texts = [extract_file(file) for file in files]
+    return assemble_course_index(course_id, files, texts, version)
+
+
+def assemble_course_index(course_id: int, files: list[moodle.CourseFile], texts: list[str], version: str) -> CourseIndex:
+    """
+    Arma el indice a partir del texto ya extraido de cada archivo (texts[i] es el texto de files[i]).
+    """
+    general_info = ""
+    records = []
+
+    for file, text in zip(files, texts):
+        if file.section_name.lower() == GENERAL_INFO_SECTION:
+            general_info += f"\nFuente de la informacion (nombre del archivo): {file.module_name}\nContenido del archivo:\n{text}\n"
+
+        else:
+            for n, chunk in enumerate(chunk_text(text)):
+                records.append({"id": f"{file.module_id}:{n}", "source": file.module_name, "text": chunk})
+
+    # Indice lexico del contenido (no depende de la API de embeddings)
+    with trace.span("bm25.build", documents=len(records)):
+        lexical_index = BM25Index.from_records(records)
+
+    try:
+        with trace.span("embeddings.store", documents=len(records)):
+            embedding_store = IA.build_embedding_store(records, EMBEDDING_MODEL)
+    except requests.exceptions.RequestException as e:
+        # Se guarda sin embeddings: se responde con busqueda lexica y se reintenta en la proxima pregunta
+        trace.event("embeddings no disponibles al indexar el curso", error=repr(e))
+        embedding_store = None
+
+    return CourseIndex(sites.current().id, course_id, version, general_info, records, embedding_store, lexical_index)
+
+
+def get_course_index(course_id: int, model: course_model.CourseModel | None = None) -> CourseIndex:
+    """
+    Devuelve el indice del curso, reconstruyendolo solo si cambio la version del contenido
+    (o si la vez anterior no se pudieron calcular los embeddings).
+    Si ya se tiene el modelo del curso (course_model) se usa para no volver a pedir el contenido a Moodle.
+    Si otra tarea ya esta construyendo esta misma version, se espera ese indice en lugar de construirlo de nuevo.
+    """
+    if model is None:
+        model = course_model.get_course_model(course_id)
+    files = model.files()
+    version = content_version(files)
+    key = (sites.current().id, course_id)
+
+    cached = _cached_current(key, version)
+    if cached is not None:
+        trace.event("indice del curso en cache", version=version[:8], dimensions=cached.embedding_store.dim)
+        return cached
+
+    return _build_flights.do((key, version), lambda: _build_and_store(key, course_id, files, version))
+
+
+def _cached_current(key: tuple[str, int], version: str) -> CourseIndex | None:
+    """Indice en memoria de esta version, con embeddings en las dimensiones configuradas (o None)."""
+    with _indexes_lock:
+        cached = _indexes.get(key)
+
+    if cached and cached.version == version and cached.embedding_store is not None:
+        return migrate_dimensions(cached)
+    return None
+
+
+def _build_and_store(key: tuple[str, int], course_id: int, files: list[moodle.CourseFile], version: str) -> CourseIndex:
+    # Una construccion que termino justo antes de tomar la clave ya dejo el indice en memoria
+    cached = _cached_current(key, version)
+    if cached is not None:
+        return cached
+
+    trace.event("construyendo indice del curso", version=version[:8])
+    index = build_course_index(course_id, files, version)
+
+    if index.embedding_store is not None:
+        # El indice aproximado (si corresponde) se arma aca, no en la primera busqueda
+        index.embedding_store.prepare_ann()
+
+    with _indexes_lock:
+        _indexes[key] = index
+
+    if index.embedding_store is not None:
+        save_snapshot(index)
+
+    return index
+
+
+def migrate_dimensions(index: CourseIndex) -> CourseIndex | None:
+    """
+    Deja los embeddings del indice en las dimensiones configuradas (IA.embedding_dimensions).
+    Si tiene mas dimensiones se recortan sin llamar a la API (y se guarda el snapshot); si tiene
+    menos no se pueden recuperar y devuelve None (hay que volver a calcular los embeddings).
+    """
+    store = index.embedding_store
+    dim = IA.embedding_dimensions(EMBEDDING_MODEL)
+    if store is None or dim is None or len(store) == 0 or store.dim == dim:
+        return index
+    if store.dim < dim:
+        return None
+
+    with trace.span("embeddings.migrate", documents=len(store), old_dimensions=store.dim, dimensions=dim):
+        migrated = CourseIndex(index.site_id, index.course_id, index.version, index.general_info, index.records, store.truncated(dim), index.lexical_index)
+
+    with _indexes_lock:
+        # Solo si nadie lo reemplazo mientras tanto (ej. una reconstruccion por cambio de contenido)
+        if _indexes.get((index.site_id, index.course_id)) is index:
+            _indexes[(index.site_id, index.course_id)] = migrated
+    save_snapshot(migrated)
+    return migrated
+
+
+def prepare_ann_all() -> int:
+    """
+    Construye el indice aproximado de los indices en memoria que lo usan (ver tools.ann).
+    Se corre en segundo plano al arrancar. Devuelve cuantos se construyeron.
+    """
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    return sum(1 for index in indexes if index.embedding_store is not None and index.embedding_store.prepare_ann())
+
+
+def migrate_all_dimensions() -> int:
+    """
+    Migra a las dimensiones configuradas todos los indices en memoria que se puedan recortar.
+    Se corre en segundo plano al arrancar; mientras tanto las consultas se recortan a la dimension de
+    cada indice, asi nunca se comparan vectores de distinta dimension. Devuelve cuantos se migraron.
+    """
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+
+    migrated = 0
+    for index in indexes:
+        store = index.embedding_store
+        dim = IA.embedding_dimensions(EMBEDDING_MODEL)
+        if store is None or dim is None or len(store) == 0 or store.dim <= dim:
+            continue
+        try:
+            migrate_dimensions(index)
+            migrated += 1
+        except Exception as e:
+            print(f"No se pudo migrar el indice del curso {index.course_id} ({index.site_id}): {e}")
+    return migrated
+
+
+def get_cached_index(course_id: int) -> CourseIndex | None:
+    """
+    Ultimo indice del curso en memoria, aunque el contenido haya cambiado despues (None si no hay).
+    Sirve para responder igual cuando no hay tiempo de reconstruirlo. Si tiene mas dimensiones que las
+    configuradas se migra (recorte, sin llamar a la API); con menos, las consultas se recortan al buscar.
+    """
+    with _indexes_lock:
+        index = _indexes.get((sites.current().id, course_id))
+    if index is None:
+        return None
+    return migrate_dimensions(index) or index
+
+
+def _snapshot_path(site_id: str, course_id: int) -> str:
+    return os.path.join(SNAPSHOTS_DIR, f"{site_id}_course_{course_id}.pkl")
+
+
+def save_snapshot(index: CourseIndex):
+    """
+    Guarda el indice en files/snapshots/<sitio>_course_<id>.pkl (escritura atomica).
+    """
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    path = _snapshot_path(index.site_id, index.course_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "wb") as file:
+        pickle.dump(index, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(course_id: int) -> CourseIndex | None:
+    """
+    Indice guardado del curso (del sitio actual), o None si no hay snapshot o no se puede leer.
+    """
+    try:
+        with open(_snapshot_path(sites.current().id, course_id), "rb") as file:
+            return pickle.load(file)
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError, TypeError, AttributeError):
+        return None
+
+
+def load_snapshots() -> int:
+    """
+    Carga en memoria todos los indices guardados en files/snapshots/. Devuelve cuantos se cargaron.
+    """
+    if not os.path.isdir(SNAPSHOTS_DIR):
+        return 0
+
+    loaded = 0
+    for name in os.listdir(SNAPSHOTS_DIR):
+        # Solo <sitio>_course_<id>.pkl (los course_<id>.pkl anteriores no tienen sitio y se reconstruyen)
+        if not ("_course_" in name and name.endswith(".pkl")):
+            continue
+
+        try:
+            with open(os.path.join(SNAPSHOTS_DIR, name), "rb") as file:
+                index = pickle.load(file)
+        except Exception as e:
+            print(f"No se pudo cargar el snapshot {name}: {e}")
+            continue
+
+        with _indexes_lock:
+            _indexes[(index.site_id, index.course_id)] = index
+        loaded += 1
+
+    return loaded
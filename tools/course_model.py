@@ -0,0 +1,159 @@
+# Modelo del curso (secciones, modulos y archivos) armado una sola vez a partir de core_course_get_contents
+#
+# En lugar de recorrer el JSON crudo en cada paso (estructura para el prompt, archivos a indexar,
+# seccion de cada actividad), se arma un modelo compacto con indices por cmid, seccion, tipo de
+# modulo y contenthash. Se reutiliza mientras no cambie el contenido del curso.
+import json
+import hashlib
+import threading
+from dataclasses import dataclass
+
+import tools.moodle as moodle
+import tools.sites as sites
+import tools.trace as trace
+from tools.singleflight import SingleFlight
+
+
+@dataclass(slots=True, frozen=True)
+class CourseModule:
+    cmid: int
+    name: str
+    modname: str                            # resource, assign, forum, url, etc.
+    section_id: int
+    section_name: str
+    files: tuple[moodle.CourseFile, ...]
+
+
+@dataclass(slots=True, frozen=True)
+class CourseSection:
+    id: int
+    name: str
+    modules: tuple[CourseModule, ...]
+
+
+@dataclass(slots=True, frozen=True)
+class CourseModel:
+    """
+    Contenido de un curso con indices para las consultas frecuentes:
+        -version         -> hash de la respuesta de core_course_get_contents (cambia con cualquier modificacion)
+        -outline         -> estructura del curso (secciones y modulos) ya renderizada para el prompt
+        -by_cmid         -> cmid -> modulo
+        -by_section      -> id de seccion -> modulos
+        -by_modname      -> tipo de modulo -> modulos
+        -by_contenthash  -> contenthash -> archivo (una entrada por archivo distinto)
+    """
+    course_id: int
+    version: str
+    sections: tuple[CourseSection, ...]
+    outline: str
+    by_cmid: dict[int, CourseModule]
+    by_section: dict[int, tuple[CourseModule, ...]]
+    by_modname: dict[str, tuple[CourseModule, ...]]
+    by_contenthash: dict[str, moodle.CourseFile]
+
+    def section_name(self, cmid: int, default: str = "Unknown Section") -> str:
+        module = self.by_cmid.get(cmid)
+        return module.section_name if module else default
+
+    def files(self, modname: str = "resource", mimetype: str | None = "application/pdf") -> list[moodle.CourseFile]:
+        """
+        Archivos de los modulos de tipo 'modname' (por defecto, los PDF de los recursos), en el orden del curso.
+        """
+        return [
+            file
+            for module in self.by_modname.get(modname, ())
+            for file in module.files
+            if not mimetype or file.mimetype == mimetype
+        ]
+
+
+# (site_id, course_id) -> CourseModel
+_models: dict[tuple[str, int], CourseModel] = {}
+_models_lock = threading.Lock()
+
+# Respuestas simultaneas del mismo curso comparten el pedido del contenido a Moodle
+_flights = SingleFlight("contenido del curso")
+
+
+def build_course_model(course_id: int, contents: list[dict], version: str) -> CourseModel:
+    """
+    Arma el modelo a partir de la respuesta de core_course_get_contents (con contenidos).
+    """
+    sections = []
+    by_modname: dict[str, list[CourseModule]] = {}
+    by_contenthash = {}
+    outline = ["###Contenido General del Curso:\n"]
+
+    for section in contents:
+        outline.append(f"\nSección: {section['name']}\n")
+        modules = []
+
+        for module in section.get("modules", []):
+            files = tuple(
+                moodle.CourseFile(
+                    section_name=section["name"],
+                    module_id=module["id"],
+                    module_name=module["name"],
+                    filename=content.get("filename", ""),
+                    fileurl=content["fileurl"],
+                    mimetype=content.get("mimetype", ""),
+                    timemodified=content.get("timemodified", 0),
+                    contenthash=content.get("contenthash", "")
+                )
+                for content in module.get("contents", [])
+                if content.get("type") == "file"
+            )
+
+            course_module = CourseModule(module["id"], module["name"], module.get("modname", ""), section["id"], section["name"], files)
+            modules.append(course_module)
+            by_modname.setdefault(course_module.modname, []).append(course_module)
+            for file in files:
+                if file.contenthash:
+                    by_contenthash.setdefault(file.contenthash, file)
+
+            outline.append(f"* Archivo/Actividad: {module['name']}\n")
+
+        sections.append(CourseSection(section["id"], section["name"], tuple(modules)))
+
+    return CourseModel(
+        course_id=course_id,
+        version=version,
+        sections=tuple(sections),
+        outline="".join(outline),
+        by_cmid={module.cmid: module for section in sections for module in section.modules},
+        by_section={section.id: section.modules for section in sections},
+        by_modname={modname: tuple(modules) for modname, modules in by_modname.items()},
+        by_contenthash=by_contenthash
+    )
+
+
+def get_course_model(course_id: int) -> CourseModel:
+    """
+    Modelo del curso (del sitio actual). Se pide el contenido a Moodle (una llamada) y el modelo
+    solo se vuelve a armar si la respuesta cambio. Si otra tarea ya lo esta pidiendo, se espera ese resultado.
+    """
+    key = (sites.current().id, course_id)
+    return _flights.do(key, lambda: _load_course_model(key, course_id))
+
+
+def get_cached_model(course_id: int) -> CourseModel | None:
+    """Ultimo modelo armado del curso (del sitio actual), sin pedir nada a Moodle. None si no hay."""
+    with _models_lock:
+        return _models.get((sites.current().id, course_id))
+
+
+def _load_course_model(key: tuple[str, int], course_id: int) -> CourseModel:
+    contents = moodle.get_course_contents(course_id)
+    version = hashlib.sha1(json.dumps(contents, sort_keys=True).encode()).hexdigest()
+
+    with _models_lock:
+        cached = _models.get(key)
+    if cached and cached.version == version:
+        return cached
+
+    with trace.span("course_model.build", sections=len(contents)):
+        model = build_course_model(course_id, contents, version)
+
+    with _models_lock:
+        _models[key] = model
+    return model
@@ -0,0 +1,164 @@
+# Plazos (deadlines) por respuesta
+#
+# Cada respuesta tiene un tiempo maximo (REPLY_DEADLINE_SECONDS). El plazo viaja en un ContextVar,
+# asi cada llamada externa (Moodle, OpenAI) calcula su timeout con lo que queda del plazo y ninguna
+# llamada colgada puede retener la tarea para siempre.
+#
+#   with deadline.deadline(120):
+#       response = session.get(url, timeout=deadline.timeout(MOODLE_READ_TIMEOUT))
+#
+# Las lecturas idempotentes pueden usar hedged(): si la primera llamada tarda mas de lo normal se
+# lanza una segunda igual y se usa la que termine primero.
+import os
+import time
+import functools
+import contextvars
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+
+# Plazo total para responder una discusion (segundos)
+REPLY_DEADLINE_SECONDS = float(os.getenv("REPLY_DEADLINE_SECONDS", "120"))
+
+# Plazo del trabajo compartido entre varias respuestas (ej. una request de embeddings con los pedidos de
+# varias tareas): no depende del plazo de ninguna de ellas, cada una espera el resultado con el suyo
+SHARED_DEADLINE_SECONDS = float(os.getenv("SHARED_DEADLINE_SECONDS", str(REPLY_DEADLINE_SECONDS)))
+
+# Timeouts maximos de cada llamada (se acortan si queda menos plazo)
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "5"))
+MOODLE_READ_TIMEOUT = float(os.getenv("MOODLE_READ_TIMEOUT", "30"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "90"))
+
+# Despues de cuanto tiempo sin respuesta se lanza la segunda llamada de una lectura (segundos)
+HEDGE_AFTER_SECONDS = float(os.getenv("HEDGE_AFTER_SECONDS", "2"))
+DOWNLOAD_HEDGE_AFTER_SECONDS = float(os.getenv("DOWNLOAD_HEDGE_AFTER_SECONDS", "15"))
+
+# Instante (time.monotonic) en que vence el plazo de la tarea actual. None = sin plazo
+_deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+# Hilos para las llamadas duplicadas de hedged()
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_MAX_THREADS", "16")), thread_name_prefix="hedge")
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Se acabo el plazo de la respuesta. Hereda de requests Timeout, asi los caminos que ya toleran
+    errores de red (ej. responder solo con busqueda lexica) tambien toleran el plazo vencido.
+    """
+
+
+@contextmanager
+def deadline(seconds: float):
+    """
+    Fija un plazo de 'seconds' segundos para el bloque. Un plazo anidado nunca extiende al de afuera.
+    """
+    expires = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        expires = min(expires, outer)
+
+    token = _deadline.set(expires)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def extend(seconds: float):
+    """
+    Plazo nuevo de 'seconds' segundos aunque el actual ya haya vencido o sea mas corto
+    (para publicar la respuesta de respaldo, o para trabajo compartido con otras respuestas).
+    """
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def reserve(seconds: float):
+    """
+    Plazo para el bloque dejando 'seconds' segundos del plazo actual para lo que viene despues
+    (ej. juntar contexto sin comerse el tiempo de generar y publicar la respuesta).
+    """
+    left = remaining()
+    if left is None:
+        yield
+        return
+
+    with deadline(max(left - seconds, 0)):
+        yield
+
+
+def remaining() -> float | None:
+    """
+    Segundos que quedan del plazo actual (None si no hay plazo).
+    """
+    expires = _deadline.get()
+    if expires is None:
+        return None
+    return expires - time.monotonic()
+
+
+def check():
+    """
+    DeadlineExceeded si ya vencio el plazo.
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("Se agoto el plazo de la respuesta")
+
+
+def timeout(read: float, connect: float = CONNECT_TIMEOUT) -> tuple[float, float]:
+    """
+    Timeout (connect, read) para requests, recortado a lo que queda del plazo.
+    """
+    check()
+    left = remaining()
+    if left is None:
+        return (connect, read)
+    return (min(connect, left), min(read, left))
+
+
+def sleep(seconds: float):
+    """
+    time.sleep que no pasa del plazo (DeadlineExceeded si no alcanza para esperar).
+    """
+    left = remaining()
+    if left is not None and left < seconds:
+        raise DeadlineExceeded("Se agoto el plazo de la respuesta")
+    time.sleep(seconds)
+
+
+def hedged(call, after: float = HEDGE_AFTER_SECONDS):
+    """
+    Ejecuta 'call' (una lectura idempotente, sin argumentos). Si no termino despues de 'after' segundos
+    se lanza una segunda ejecucion y se devuelve el resultado de la primera que termine bien.
+    Solo si fallan las dos se propaga el error.
+    Cada ejecucion se envia como functools.partial(contexto.run, call), igual que asyncio.to_thread
+    (asi el profiler reconoce a que respuesta pertenece el hilo, ver tools/profiler.py).
+    """
+    left = remaining()
+    if left is not None and left <= after:
+        return call()
+
+    first = _hedge_executor.submit(functools.partial(contextvars.copy_context().run, call))
+    done, _ = wait([first], timeout=after)
+    if done:
+        return first.result()
+
+    second = _hedge_executor.submit(functools.partial(contextvars.copy_context().run, call))
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
@@ -0,0 +1,238 @@
+# Clasificacion local de la intencion de una consulta
+#
+# En lugar de pedirle a un LLM que elija el tag (IA.get_tag), se compara el embedding de la consulta
+# (que ya se calcula para la busqueda) con el "centroide" de cada tag: el promedio de los embeddings
+# de su descripcion y de ejemplos etiquetados (files/intent_examples.json).
+# Solo si el tag ganador no se separa lo suficiente de los demas se le pregunta al LLM; esas
+# decisiones se registran en files/state/intent_decisions.jsonl y se suman como ejemplos al refrescar:
+#   python -m tools.intent --refrescar
+# Los workers en marcha toman los centroides refrescados sin reiniciar (se recarga el snapshot si cambia).
+from __future__ import annotations
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import threading
+
+import tools.IA as IA
+import tools.trace as trace
+from tools.tools import lazy_import
+
+np = lazy_import("numpy")
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES_PATH = os.path.join(BASE_DIR, "files", "intent_examples.json")
+DECISIONS_PATH = os.path.join(BASE_DIR, "files", "state", "intent_decisions.jsonl")
+CENTROIDS_PATH = os.path.join(BASE_DIR, "files", "snapshots", "intent_centroids.pkl")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Intenciones posibles de una consulta del foro
+TAGS = [
+    {"name": "consulta de actividad", "description": "Preguntas relacionadas con actividades del curso (cuestionarios, trabajos practicos-TP, ejercicios, et.)."},
+    {"name": "Consulta de contenido", "description": "Preguntas relacionadas con el contenido del curso, pero no con una actividad."},
+    {"name": "consulta general", "description": "Preguntas generales sobre el curso."}
+]
+
+# Diferencia minima de similitud entre el mejor tag y el segundo para no consultar al LLM
+INTENT_MIN_MARGIN = float(os.getenv("INTENT_MIN_MARGIN", "0.05"))
+
+# Decisiones del LLM que se usan como ejemplos por tag (las mas recientes)
+MAX_LOGGED_EXAMPLES = int(os.getenv("INTENT_MAX_LOGGED_EXAMPLES", "200"))
+
+# {"key", "names", "centroids"} de los tags actuales, y la fecha de modificacion del snapshot del que salieron
+_centroids: dict | None = None
+_centroids_mtime: int | None = None
+_centroids_lock = threading.Lock()
+
+# (fecha de modificacion, ejemplos, hash) de files/intent_examples.json: se vuelve a leer solo si cambia
+_examples: tuple[int | None, dict, str] | None = None
+_examples_lock = threading.Lock()
+
+
+def _mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _load_examples() -> tuple[dict[str, list[str]], str]:
+    """Ejemplos etiquetados y su hash."""
+    global _examples
+    mtime = _mtime(EXAMPLES_PATH)
+
+    with _examples_lock:
+        if _examples is None or _examples[0] != mtime:
+            examples = {}
+            if mtime is not None:
+                try:
+                    with open(EXAMPLES_PATH, "r", encoding="utf-8") as file:
+                        examples = json.load(file)
+                except FileNotFoundError:
+                    pass
+            _examples = (mtime, examples, hashlib.sha1(json.dumps(examples, sort_keys=True).encode()).hexdigest())
+        return _examples[1], _examples[2]
+
+
+def _read_examples() -> dict[str, list[str]]:
+    return _load_examples()[0]
+
+
+def _read_decisions() -> dict[str, list[str]]:
+    """
+    Textos clasificados por el LLM, por tag (hasta MAX_LOGGED_EXAMPLES por tag, los mas recientes).
+    """
+    decisions = {}
+    try:
+        with open(DECISIONS_PATH, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    decision = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                decisions.setdefault(decision["tag"], []).append(decision["text"])
+    except FileNotFoundError:
+        pass
+
+    return {tag: texts[-MAX_LOGGED_EXAMPLES:] for tag, texts in decisions.items()}
+
+
+def _key(tags: list[dict]) -> str:
+    """
+    Cambia si cambian los tags, los ejemplos etiquetados o el proveedor/dimensiones de los embeddings
+    (y entonces se reconstruyen los centroides). Las decisiones registradas no cambian la clave:
+    se suman al refrescar (--refrescar), y los workers recargan el snapshot nuevo (ver get_centroids).
+    """
+    digest = hashlib.sha1(json.dumps(tags, sort_keys=True).encode())
+    digest.update(_load_examples()[1].encode())
+    digest.update(f"dimensions:{IA.embedding_dimensions(EMBEDDING_MODEL)}|{IA.embedding_id(EMBEDDING_MODEL)}".encode())
+    return digest.hexdigest()
+
+
+def build_centroids(tags: list[dict]) -> dict:
+    """
+    Calcula el centroide de cada tag: promedio (normalizado) de los embeddings de su descripcion,
+    sus ejemplos y las decisiones registradas del LLM. Guarda el resultado en files/snapshots/.
+    """
+    examples = _read_examples()
+    decisions = _read_decisions()
+
+    texts, owners = [], []
+    for i, tag in enumerate(tags):
+        tag_texts = [f"{tag['name']}: {tag['description']}"] + examples.get(tag["name"], []) + decisions.get(tag["name"], [])
+        texts.extend(tag_texts)
+        owners.extend([i] * len(tag_texts))
+
+    with trace.span("intent.centroids", tags=len(tags), examples=len(texts)):
+        vectors = IA.embed_texts(texts, EMBEDDING_MODEL)
+
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    owners = np.array(owners)
+    centroids = np.vstack([vectors[owners == i].mean(axis=0) for i in range(len(tags))])
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    state = {"key": _key(tags), "names": [tag["name"] for tag in tags], "centroids": centroids.astype(np.float32)}
+
+    os.makedirs(os.path.dirname(CENTROIDS_PATH), exist_ok=True)
+    tmp_path = f"{CENTROIDS_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, CENTROIDS_PATH)
+
+    return state
+
+
+def get_centroids(tags: list[dict]) -> dict:
+    """
+    Centroides de los tags: de memoria, del snapshot, o calculados si cambiaron los tags o los ejemplos.
+    Si el snapshot cambio desde que se cargo (ej. python -m tools.intent --refrescar) se vuelve a cargar.
+    """
+    global _centroids, _centroids_mtime
+    key = _key(tags)
+    mtime = _mtime(CENTROIDS_PATH)
+
+    with _centroids_lock:
+        if _centroids is not None and _centroids["key"] == key and _centroids_mtime == mtime:
+            return _centroids
+
+        try:
+            with open(CENTROIDS_PATH, "rb") as file:
+                saved = pickle.load(file)
+            if saved["key"] == key:
+                _centroids, _centroids_mtime = saved, mtime
+                return saved
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError, KeyError):
+            pass
+
+        _centroids = build_centroids(tags)
+        _centroids_mtime = _mtime(CENTROIDS_PATH)
+        return _centroids
+
+
+def _log_decision(text: str, tag: str):
+    os.makedirs(os.path.dirname(DECISIONS_PATH), exist_ok=True)
+    with open(DECISIONS_PATH, "a", encoding="utf-8") as file:
+        file.write(json.dumps({"ts": time.time(), "tag": tag, "text": text}, ensure_ascii=False) + "\n")
+
+
+def classify(text: str, embedding, tags: list[dict] = TAGS, model: str = "gpt-4.1") -> list[str]:
+    """
+    Devuelve los tags de la consulta (mismo formato que IA.get_tag).
+    Usa los centroides si el mejor tag supera al segundo por INTENT_MIN_MARGIN; si no (o si no hay
+    embedding de la consulta) consulta al LLM y registra su decision.
+    """
+    if embedding is not None:
+        try:
+            state = get_centroids(tags)
+        except Exception as e:
+            # Sin centroides (ej. API de embeddings caida) se clasifica con el LLM
+            trace.event("centroides de intencion no disponibles", error=repr(e))
+            state = None
+
+        if state is not None and len(state["centroids"][0]) <= len(embedding):
+            query = IA.fit_dimensions(embedding, len(state["centroids"][0]))
+            similarities = state["centroids"] @ query
+            order = np.argsort(-similarities)
+            margin = float(similarities[order[0]] - similarities[order[1]]) if len(order) > 1 else 1.0
+
+            if margin >= INTENT_MIN_MARGIN:
+                trace.event("intencion local", similarity=round(float(similarities[order[0]]), 3), margin=round(margin, 3))
+                return [state["names"][order[0]]]
+
+            trace.event("intencion local con poca confianza, consultando al LLM", margin=round(margin, 3))
+
+    assigned = IA.get_tag(text, tags=tags, model=model)
+
+    names = [tag["name"] for tag in tags]
+    recognized = [tag for tag in assigned if tag in names]
+    if len(recognized) == 1:
+        _log_decision(text, recognized[0])
+
+    return assigned
+
+
+# === CLI ===
+
+def main():
+    parser = argparse.ArgumentParser(description="Centroides del clasificador local de intencion.")
+    parser.add_argument("--refrescar", action="store_true", help="Recalcular los centroides sumando las decisiones registradas del LLM")
+    args = parser.parse_args()
+
+    if args.refrescar:
+        state = build_centroids(TAGS)
+    else:
+        state = get_centroids(TAGS)
+
+    examples = _read_examples()
+    decisions = _read_decisions()
+    for name in state["names"]:
+        print(f"{name:<24} ejemplos: {len(examples.get(name, [])):>4}   decisiones del LLM: {len(decisions.get(name, [])):>4}")
+
+
+if __name__ == "__main__":
+    main()
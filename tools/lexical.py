@@ -0,0 +1,250 @@
+# Indice lexico (BM25) para busqueda por terminos exactos ("TP3", "parcial 2", nombres de funciones)
+from __future__ import annotations
+
+import re
+import math
+import unicodedata
+from collections import Counter, defaultdict
+
+from tools.tools import lazy_import
+
+np = lazy_import("numpy")
+
+
+# Palabras muy comunes que no aportan a la busqueda
+STOPWORDS = {
+    "a", "al", "como", "con", "de", "del", "el", "en", "es", "esta", "este", "hay", "la", "las", "lo", "los",
+    "me", "mi", "no", "o", "para", "pero", "por", "que", "se", "si", "sin", "su", "sus", "te", "tu", "un",
+    "una", "uno", "y", "ya", "yo"
+}
+
+TOKEN_PATTERN = re.compile(r"\w+")
+SPLIT_PATTERN = re.compile(r"[^\W\d_]+|\d+")
+
+# Constante de Reciprocal Rank Fusion (multi_search)
+RRF_K = 60
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Divide un texto en terminos normalizados (minusculas, sin tildes, sin stopwords).
+    Los terminos que mezclan letras y numeros se indexan completos y tambien por partes,
+    para que "TP3" coincida con "TP 3" y viceversa.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+
+        parts = SPLIT_PATTERN.findall(token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part not in STOPWORDS)
+
+    return tokens
+
+
+class BM25Index:
+    """
+    Indice invertido con puntaje BM25 sobre una lista de documentos {"id", "source", "text"}.
+    Internamente cada documento se identifica por su posicion en la lista, igual que en el EmbeddingStore
+    construido a partir de los mismos registros, asi los puntajes se pueden combinar.
+    El "id" del registro (ej. "<module_id>:<n>" de un fragmento) se devuelve en los resultados.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: list[str] = []
+        self.sources: list[str] = []
+        self.texts: list[str] = []
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self.postings: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @classmethod
+    def from_records(cls, records: list[dict], **kwargs) -> "BM25Index":
+        index = cls(**kwargs)
+        index.build(records)
+        return index
+
+    def build(self, records: list[dict]):
+        """
+        Construye el indice invertido: termino -> (ids de documentos, frecuencia del termino en cada uno).
+        """
+        postings = defaultdict(lambda: ([], []))
+        lengths = []
+
+        for doc_id, record in enumerate(records):
+            tokens = tokenize(record["text"])
+            lengths.append(len(tokens))
+
+            for term, frequency in Counter(tokens).items():
+                doc_ids, frequencies = postings[term]
+                doc_ids.append(doc_id)
+                frequencies.append(frequency)
+
+        self.ids = [str(record.get("id", doc_id)) for doc_id, record in enumerate(records)]
+        self.sources = [record.get("source", "desconocido") for record in records]
+        self.texts = [record["text"] for record in records]
+        self.doc_lengths = np.array(lengths, dtype=np.float32)
+        self.postings = {
+            term: (np.array(doc_ids, dtype=np.int32), np.array(frequencies, dtype=np.float32))
+            for term, (doc_ids, frequencies) in postings.items()
+        }
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        Devuelve el puntaje BM25 de cada documento para la consulta (0 si no comparte terminos).
+        """
+        scores = np.zeros(len(self), dtype=np.float32)
+        if len(self) == 0:
+            return scores
+
+        average_length = max(float(self.doc_lengths.mean()), 1.0)
+        total_docs = len(self)
+
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+
+            doc_ids, frequencies = self.postings[term]
+            idf = math.log(1 + (total_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_ids] / average_length)
+            scores[doc_ids] += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+
+        return scores
+
+    def scores_many(self, queries: list[str]) -> np.ndarray:
+        """
+        Puntajes BM25 de varias consultas: matriz (documentos x consultas).
+        """
+        scores = np.zeros((len(self), len(queries)), dtype=np.float32)
+        for column, query in enumerate(queries):
+            scores[:, column] = self.scores(query)
+        return scores
+
+    def search(self, query: str, top_n: int = 1) -> list[dict]:
+        """
+        Busqueda solo lexica. Devuelve el mismo formato que IA.find_similar_content (con "bm25_score").
+        """
+        return _top_results(self.scores(query), self, top_n, "bm25_score", drop_zero=True)
+
+
+def hybrid_search(query: str, query_embedding, lexical_index: BM25Index, embedding_store=None, top_n: int = 1, alpha: float = 0.5) -> list[dict]:
+    """
+    Combina los puntajes lexicos (BM25) y vectoriales (coseno) de los mismos documentos.
+
+    Parámetros:
+        query (str): Texto de la consulta.
+        query_embedding: Embedding de la consulta. Si es None (o no hay embedding_store) se usa solo BM25,
+                         util cuando la API de embeddings esta lenta o caida.
+        lexical_index (BM25Index): Indice lexico de los documentos.
+        embedding_store (IA.EmbeddingStore): Embeddings de los mismos documentos, en el mismo orden.
+        top_n (int): Cantidad de documentos a devolver.
+        alpha (float): Peso del puntaje vectorial (0 = solo lexico, 1 = solo vectorial).
+
+    Retorna:
+        list[dict]: Documentos ordenados por puntaje combinado ("hybrid_score").
+    """
+    lexical = lexical_index.scores(query)
+
+    if query_embedding is None or embedding_store is None or len(embedding_store) == 0:
+        return _top_results(lexical, lexical_index, top_n, "bm25_score", drop_zero=True)
+
+    if len(embedding_store) != len(lexical_index):
+        raise ValueError("El indice lexico y el de embeddings no tienen los mismos documentos.")
+
+    vector = embedding_store.scores(query_embedding)
+
+    # Llevar BM25 a [0, 1] para que sea comparable con el coseno
+    if lexical.max() > 0:
+        lexical = lexical / lexical.max()
+
+    combined = alpha * vector + (1 - alpha) * lexical
+    return _top_results(combined, lexical_index, top_n, "hybrid_score")
+
+
+def multi_search(queries: list[str], query_embeddings, lexical_index: BM25Index, embedding_store=None, top_n: int = 1, alpha: float = 0.5, weights: list[float] | None = None, k: int = RRF_K) -> list[dict]:
+    """
+    Busca varias consultas a la vez (ej. la pregunta y la conversacion) y devuelve una sola lista ordenada.
+
+    Los puntajes de todas las consultas se calculan juntos (una multiplicacion de matrices para los
+    embeddings) y cada consulta se combina como en hybrid_search. Los rankings se fusionan con
+    Reciprocal Rank Fusion: puntaje = suma de weight / (k + posicion) en cada consulta.
+    Como se fusiona por documento, cada fragmento aparece una sola vez.
+
+    Parámetros:
+        queries (list[str]): Textos de las consultas.
+        query_embeddings: Embeddings de las consultas (mismo orden). Si es None (o no hay embedding_store) se usa solo BM25.
+        lexical_index (BM25Index): Indice lexico de los documentos.
+        embedding_store (IA.EmbeddingStore): Embeddings de los mismos documentos, en el mismo orden.
+        top_n (int): Cantidad de documentos a devolver.
+        alpha (float): Peso del puntaje vectorial dentro de cada consulta.
+        weights (list[float]): Peso de cada consulta en la fusion (default: 1 para todas).
+        k (int): Constante de RRF; valores altos suavizan la diferencia entre posiciones.
+
+    Retorna:
+        list[dict]: Documentos ordenados por "fused_score", con su "id".
+    """
+    if not queries or len(lexical_index) == 0:
+        return []
+
+    lexical = lexical_index.scores_many(queries)
+
+    if query_embeddings is None or embedding_store is None or len(embedding_store) == 0:
+        combined = lexical
+        # Sin coincidencias lexicas un documento no es relevante para esa consulta
+        eligible = lexical > 0
+    else:
+        if len(embedding_store) != len(lexical_index):
+            raise ValueError("El indice lexico y el de embeddings no tienen los mismos documentos.")
+
+        # Con muchos documentos el coseno sale del indice aproximado (candidatos de cada consulta, ver tools.ann)
+        vector = embedding_store.scores_many(query_embeddings, top_k=top_n)
+
+        # Llevar BM25 a [0, 1] (por consulta) para que sea comparable con el coseno
+        maximum = lexical.max(axis=0)
+        lexical = lexical / np.where(maximum > 0, maximum, 1)
+
+        combined = alpha * vector + (1 - alpha) * lexical
+        eligible = np.ones_like(combined, dtype=bool)
+
+    # Posicion (0 = mejor) de cada documento en el ranking de cada consulta
+    order = np.argsort(-combined, axis=0)
+    positions = np.empty_like(order)
+    positions[order, np.arange(len(queries))] = np.arange(len(combined))[:, None]
+
+    weights = np.array(weights if weights is not None else [1.0] * len(queries), dtype=np.float32)
+    fused = ((weights / (k + 1 + positions)) * eligible).sum(axis=1)
+
+    return _top_results(fused, lexical_index, top_n, "fused_score", drop_zero=True)
+
+
+def _top_results(scores: np.ndarray, index: BM25Index, top_n: int, score_name: str, drop_zero: bool = False) -> list[dict]:
+    if len(scores) == 0:
+        return []
+
+    top_n = max(1, min(top_n, len(scores)))
+    best = np.argpartition(-scores, top_n - 1)[:top_n]
+    best = best[np.argsort(-scores[best])]
+
+    # Sin coincidencias lexicas un documento no es relevante
+    if drop_zero:
+        best = best[scores[best] > 0]
+
+    return [
+        {
+            "rank": rank,
+            score_name: float(scores[idx]),
+            "id": index.ids[idx],
+            "source": index.sources[idx],
+            "text": index.texts[idx]
+        }
+        for rank, idx in enumerate(best, start=1)
+    ]
@@ -1,23 +1,100 @@
 import requests
+from dataclasses import dataclass
 
 # Para archivos
-from tools.tools import extract_text_from_pdf_bytes
+from tools.tools import extract_pages_from_pdf_bytes
 
-# Variables de entorno
-import os
-from dotenv import load_dotenv
+# Trazas por respuesta
+import tools.trace as trace
 
+# Limpieza del texto de mensajes y PDF (menos tokens)
+import tools.normalize as normalize
 
-# === CONFIGURACIÓN ===
-current_dir = os.path.dirname(os.path.abspath(__file__))
-dotenv_path = os.path.join(current_dir, '.env')
-load_dotenv(dotenv_path)
+# Descargas simultaneas del mismo archivo se hacen una sola vez
+from tools.singleflight import SingleFlight
 
-MOODLE_URL = os.getenv("MOODLE_URL") 
-TOKEN = os.getenv("TOKEN")
-ENDPOINT = f"{MOODLE_URL}/webservice/rest/server.php"
+# Sitios Moodle (URL, token y conexiones). Cada llamada usa el sitio de la tarea actual
+import tools.sites as sites
 
+# Timeouts derivados del plazo de la respuesta
+import tools.deadline as deadline
 
+# Usuarios por pagina al pedir los inscriptos de un curso
+ROSTER_PAGE_SIZE = 500
+
+# Orden de mod_forum_get_forum_discussions: ultima actividad primero
+DISCUSSIONS_BY_LAST_POST = 1
+
+
+# === REGISTROS ===
+# Solo los campos que realmente usamos de cada respuesta de Moodle
+
+@dataclass(slots=True, frozen=True)
+class User:
+    id: int
+    username: str
+    fullname: str
+    email: str
+
+
+@dataclass(slots=True, frozen=True)
+class CourseUser:
+    id: int
+    fullname: str
+    roles: tuple[str, ...]      # shortnames de los roles en el curso (student, teacher, editingteacher, etc.)
+
+
+@dataclass(slots=True, frozen=True)
+class CourseFile:
+    section_name: str
+    module_id: int              # cmid
+    module_name: str
+    filename: str
+    fileurl: str
+    mimetype: str
+    timemodified: int
+    contenthash: str = ""       # sha1 del contenido del archivo (igual en todas las copias del mismo archivo)
+
+
+def _request(wsfunction: str, params: dict | None = None, method: str = "GET") -> requests.Response:
+    """
+    Llama a una funcion del web service REST de Moodle (formato JSON) del sitio actual (sites.current_site).
+    El timeout sale del plazo de la respuesta; las lecturas (GET) se duplican si tardan mas de lo normal (deadline.hedged).
+    """
+    site = sites.current()
+    params = {
+        "wstoken": site.token,
+        "wsfunction": wsfunction,
+        "moodlewsrestformat": "json",
+        **(params or {})
+    }
+
+    def send() -> requests.Response:
+        with site.limit:
+            if method == "POST":
+                return site.session.post(site.endpoint, data=params, timeout=deadline.timeout(deadline.MOODLE_READ_TIMEOUT))
+            return site.session.get(site.endpoint, params=params, timeout=deadline.timeout(deadline.MOODLE_READ_TIMEOUT))
+
+    with trace.span(f"moodle.{wsfunction}", site=site.id) as info:
+        response = send() if method == "POST" else deadline.hedged(send)
+
+        info["status"] = response.status_code
+        info["bytes"] = len(response.content)
+
+    return response
+
+
+def _options(options: dict) -> dict:
+    """
+    Convierte {"nombre": valor} al formato options[i][name] / options[i][value] que esperan las wsfunctions.
+    """
+    params = {}
+    for i, (name, value) in enumerate(options.items()):
+        if isinstance(value, bool):
+            value = int(value)
+        params[f"options[{i}][name]"] = name
+        params[f"options[{i}][value]"] = value
+    return params
 
 
 def get_self_id() -> dict:
@@ -29,14 +106,8 @@ def get_self_id() -> dict:
         -username  -> nombre del usuario
     entre otros    
     """
-    
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "core_webservice_get_site_info",
-        "moodlewsrestformat": "json"
-    }
 
-    response = requests.get(ENDPOINT, params=params)
+    response = _request("core_webservice_get_site_info")
 
     if response.status_code == 200:
         info = response.json()
@@ -62,15 +133,8 @@ def get_user_courses(user_id: int) -> list[dict]:
     entre otros
     """
 
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "core_enrol_get_users_courses",
-        "moodlewsrestformat": "json",
-        "userid": user_id
-    }
-
     # === LLAMADA A MOODLE ===
-    response = requests.get(ENDPOINT, params=params)
+    response = _request("core_enrol_get_users_courses", {"userid": user_id})
     cursos = response.json()
 
     return cursos
@@ -88,17 +152,11 @@ def get_course_forums(course_id: int) -> list[dict]:
     entre otros
     """
 
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "mod_forum_get_forums_by_courses",
-        "moodlewsrestformat": "json",
-        "courseids[0]": course_id
-    }
-    response = requests.get(ENDPOINT, params=params)
+    response = _request("mod_forum_get_forums_by_courses", {"courseids[0]": course_id})
     return response.json()
 
 
-def get_forum_content(forum_id: int) -> list[dict]:
+def get_forum_content(forum_id: int, sort_order: int = -1, page: int = -1, per_page: int = 0) -> dict:
     """
     Devuelve una lista del contenido del foro\n
     Para esto, es requerido que el 'servicio Externo' de Moodle tenga la funcion 'mod_forum_get_forum_discussions'\n
@@ -115,15 +173,12 @@ def get_forum_content(forum_id: int) -> list[dict]:
             -numreplies             -> Numero de respuestas/mensajes hijos de la conversacion
 
         -warnings    -> lista de advertencias dentro del foro
+
+    Opcionalmente se puede ordenar (sort_order, ej. DISCUSSIONS_BY_LAST_POST) y paginar (page desde 0, per_page).
     """
 
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "mod_forum_get_forum_discussions",
-        "moodlewsrestformat": "json",
-        "forumid": forum_id
-    }
-    response = requests.get(ENDPOINT, params=params)
+    params = {"forumid": forum_id, "sortorder": sort_order, "page": page, "perpage": per_page}
+    response = _request("mod_forum_get_forum_discussions", params)
     return response.json()
 
 
@@ -145,14 +200,7 @@ def get_discussion_posts(discussion_id: int) -> dict:
         -ratinginfo         -> diccionariorio con las Calificaciones de la discusion
         -warnings           -> Alertas
     """
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "mod_forum_get_discussion_posts",
-        "moodlewsrestformat": "json",
-        "discussionid": discussion_id
-    }
-
-    response = requests.get(ENDPOINT, params=params)
+    response = _request("mod_forum_get_discussion_posts", {"discussionid": discussion_id})
     if response.status_code == 200:
         # return response.json().get("posts", [])
         response = response.json()
@@ -190,30 +238,36 @@ def organize_posts_by_hierarchy(response: dict) -> dict:
     return response
 
 
-def get_conversations(post: dict, course_id: str = None) -> list[dict]:
+def get_conversations(post: dict, course_id: str = None, roster: dict[int, CourseUser] | None = None) -> list[dict]:
     """
     Obtiene las conversaciones a modo de diccionario, cargando los textos de los mensajes, asociandolos a los post padres y registrando quien envio cada mensaje (nombre de usuario, rol en el curso, etc.)\n
+    Si ya se tiene la lista de inscriptos del curso ('roster', ver get_course_users) no se vuelve a pedir.\n
     estuctura del diccionario:
         -discussion     -> id del la discusion
         -id_user        -> usuario que envio la ultima respuesta de la conversacion
         -content        -> lista de Mensajes 
             -id_post    -> id del post/mensaje
             -id_user    -> id del usuario que mando el mensaje
-            -user_roles   -> rol del usuario que mando el mensaje
+            -user_roles -> shortnames de los roles del usuario que mando el mensaje (ej. ['student'])
             -user_name  -> nombre del usuario que mando el mensaje
             -text       -> texto del mensaje
     """
 
     conversations = []
+    raw_texts, texts = [], []
 
     def recorrer_rama(nodo, camino_actual = []):
-        # Añadir el mensaje actual al camino
+        # Añadir el mensaje actual al camino (el texto sin el HTML de Moodle, ver tools/normalize.py)
+        text = normalize.post_to_text(nodo["message"])
+        raw_texts.append(nodo["message"])
+        texts.append(text)
+
         camino_actual.append({
             "id_post": nodo["id"],
             "id_user": nodo["author"]["id"],
             "user_name": nodo["author"]["fullname"],
             "user_roles": [],
-            "text": nodo["message"]
+            "text": text
         })
 
         # Si no tiene más replies, es el final de una conversación
@@ -228,89 +282,121 @@ def get_conversations(post: dict, course_id: str = None) -> list[dict]:
                 recorrer_rama(hijo, camino_actual.copy())
 
     recorrer_rama(post)
+    normalize.report("posts", "\n".join(raw_texts), "\n".join(texts), posts=len(texts), discussion=post.get("discussionid"))
 
     if course_id:
-        for i in range (len(conversations)):
-            for j in range (len(conversations[i]['content'])):
-                user_id = conversations[i]['content'][j]['id_user']
-                conversations[i]['content'][j]['user_roles'] = get_user_course_data(
-                    course_id, 
-                    user_id
-                )['roles']
+        # Una sola consulta por curso, en lugar de pedir la lista de inscriptos por cada mensaje
+        if roster is None:
+            roster = get_course_users(course_id)
+
+        for conversation in conversations:
+            for message in conversation['content']:
+                user = roster.get(message['id_user'])
+                message['user_roles'] = list(user.roles) if user else []
 
 
     return conversations
 
 
-def get_user_data(user_id: int):
+def get_users_by_ids(user_ids: list[int]) -> list[User]:
+    """
+    Devuelve los datos de varios usuarios en una sola llamada.
+    Para esto, es requerido que el 'servicio Externo' de Moodle tenga la funcion 'core_user_get_users_by_field'\n
+    Los usuarios que no existen simplemente no aparecen en la lista.
+    """
+    params = {"field": "id"}
+    for i, user_id in enumerate(user_ids):
+        params[f"values[{i}]"] = user_id
+
+    response = _request("core_user_get_users_by_field", params)
+
+    if response.status_code != 200:
+        raise Exception(f"Error al obtener datos de usuarios:\n{response.status_code}\n{response.text}")
+
+    data = response.json()
+    if not isinstance(data, list):
+        raise ValueError(data.get("exception", data))
+
+    return [
+        User(id=user["id"], username=user.get("username", ""), fullname=user.get("fullname", ""), email=user.get("email", ""))
+        for user in data
+    ]
+
+
+def get_user_data(user_id: int) -> User:
     """
     Devuelve Los datos de un Usuario segun su id.
     Para esto, es requerido que el 'servicio Externo' de Moodle tenga la funcion 'core_user_get_users_by_field'\n
-    Los datos del usuario vienen dados en formato de diccionario, y contiene datos como:\n
+    Los datos del usuario vienen dados como un registro User con:\n
         -id         -> id de usuario
         -username   -> nombre de usuario
-        -firstname  -> nombre
-        -lastname   -> apellido
         -fullname   -> nombre completo
         -email      -> email
     """
 
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "core_user_get_users_by_field",
-        "moodlewsrestformat": "json",
-        "field": "id",
-        "values[0]": user_id
-    }
+    users = get_users_by_ids([user_id])
+    if users:
+        return users[0]  # Devolver el primer (y único) usuario
 
-    response = requests.get(ENDPOINT, params=params)
-    
-    if response.status_code == 200:
-        data = response.json()
-        if isinstance(data, list) and len(data) > 0:
-            return data[0]  # Devolver el primer (y único) usuario
-        else:
-            raise ValueError(f"No se encontró el usuario con ID {user_id}")
-    else:
-        raise Exception(f"Error al obtener datos del usuario:\n{response.status_code}\n{response.text}")
+    raise ValueError(f"No se encontró el usuario con ID {user_id}")
 
 
-def get_user_course_data(course_id: int, user_id: int) -> dict:
+def get_course_users(course_id: int, only_active: bool = True, page_size: int = ROSTER_PAGE_SIZE) -> dict[int, CourseUser]:
     """
-    Devuelve Los datos de un Usuario dentro de un curso.
+    Devuelve los usuarios inscriptos en un curso, indexados por id.
     Para esto, es requerido que el 'servicio Externo' de Moodle tenga la funcion 'core_enrol_get_enrolled_users'\n
-    Los datos del usuario dentro del curso vienen dados en formato de diccionario, y contiene datos como:\n
-        -id             -> id de usuario
-        -username       -> nombre de usuario
-        -firstname      -> nombre
-        -lastname       -> apellido
-        -fullname       -> nombre completo
-        -email          -> email
-        -roles          -> lista de roles. Cada rol es un diccionario
-            -roleid     -> id del rol
-            -shortname  -> nombre corto del rol
+    Solo se piden los campos id, fullname y roles (opcion 'userfields'), de a paginas de page_size usuarios,
+    en lugar de todos los campos de perfil de todos los inscriptos.
     """
 
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "core_enrol_get_enrolled_users",
-        "moodlewsrestformat": "json",
-        "courseid": course_id
-    }
+    users = {}
+    limit_from = 0
 
-    response = requests.get(ENDPOINT, params=params)
-    
-    if response.status_code != 200:
-        raise Exception(f"Error al obtener usuarios del curso {course_id}:\n{response.status_code}\n{response.text}")
+    while True:
+        params = {"courseid": course_id}
+        params.update(_options({
+            "userfields": "id,fullname,roles",
+            "onlyactive": only_active,
+            "limitfrom": limit_from,
+            "limitnumber": page_size
+        }))
+
+        response = _request("core_enrol_get_enrolled_users", params)
+
+        if response.status_code != 200:
+            raise Exception(f"Error al obtener usuarios del curso {course_id}:\n{response.status_code}\n{response.text}")
 
-    users = response.json()
+        page = response.json()
 
-    if 'exception' in users:
-        raise ValueError(users['exception'])
+        if 'exception' in page:
+            raise ValueError(page['exception'])
 
-    for user in users:
-        if user["id"] == user_id:
-            return user
+        for user in page:
+            users[user["id"]] = CourseUser(
+                id=user["id"],
+                fullname=user.get("fullname", ""),
+                roles=tuple(rol["shortname"] for rol in user.get("roles", []))
+            )
+
+        if len(page) < page_size:
+            return users
+
+        limit_from += page_size
+
+
+def get_user_course_data(course_id: int, user_id: int) -> CourseUser:
+    """
+    Devuelve Los datos de un Usuario dentro de un curso.
+    Para esto, es requerido que el 'servicio Externo' de Moodle tenga la funcion 'core_enrol_get_enrolled_users'\n
+    Los datos del usuario dentro del curso vienen dados como un registro CourseUser con:\n
+        -id             -> id de usuario
+        -fullname       -> nombre completo
+        -roles          -> shortnames de los roles del usuario en el curso
+    """
+
+    user = get_course_users(course_id).get(user_id)
+    if user:
+        return user
 
     raise ValueError(f"Usuario con ID {user_id} no encontrado en el curso {course_id}")
 
@@ -327,16 +413,13 @@ def reply_to_post(parent_post_id: int, message: str, subject: str = "Respuesta a
     - subject: asunto/título de la respuesta
     """
     params = {
-        "wstoken": TOKEN,
-        "wsfunction": "mod_forum_add_discussion_post",
-        "moodlewsrestformat": "json",
         "postid": parent_post_id,
         "subject": subject,
         "message": message,
         "messageformat": 1  # 1 = HTML, 0 = texto plano
     }
 
-    response = requests.post(ENDPOINT, data=params)
+    response = _request("mod_forum_add_discussion_post", params, method="POST")
     
     if response.status_code != 200:
         raise Exception(f"❌ Error al responder al post {parent_post_id}:\n{response.status_code}\n{response.text}")
@@ -354,19 +437,25 @@ def reply_to_post(parent_post_id: int, message: str, subject: str = "Respuesta a
         raise ValueError(f"❌ Moodle no devolvió ID de respuesta: {result}")
 
 
-def get_course_contents(course_id: int) -> list[dict]:
+def get_course_contents(course_id: int, modname: str | None = None, exclude_contents: bool = False, include_stealth_modules: bool = True) -> list[dict]:
     """
     Devuelve las secciones del curso, con los recursos (archivos, etiquetas, enlaces, etc.) en cada una.
     Requiere 'core_course_get_contents' habilitada.
+    Opciones (se filtran del lado del servidor, para no transferir lo que no se usa):
+        -modname                 -> solo los modulos de ese tipo (ej. "resource")
+        -exclude_contents        -> no incluir los archivos/contenidos de cada modulo (solo la estructura)
+        -include_stealth_modules -> incluir modulos disponibles pero no mostrados en la pagina del curso
     """
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "core_course_get_contents",
-        "moodlewsrestformat": "json",
-        "courseid": course_id
-    }
+    options = {"includestealthmodules": include_stealth_modules}
+    if modname:
+        options["modname"] = modname
+    if exclude_contents:
+        options["excludecontents"] = True
+
+    params = {"courseid": course_id}
+    params.update(_options(options))
 
-    response = requests.get(ENDPOINT, params=params)
+    response = _request("core_course_get_contents", params)
 
     if response.status_code != 200:
         raise Exception(f"❌ Error al obtener contenidos del curso {course_id}:\n{response.status_code}\n{response.text}")
@@ -374,6 +463,35 @@ def get_course_contents(course_id: int) -> list[dict]:
     return response.json()
 
 
+def get_course_files(course_id: int, modname: str = "resource", mimetype: str | None = "application/pdf") -> list[CourseFile]:
+    """
+    Devuelve los archivos de los modulos de tipo 'modname' del curso (por defecto, los PDF de los recursos).
+    Requiere 'core_course_get_contents' habilitada.
+    """
+    files = []
+
+    for section in get_course_contents(course_id, modname=modname):
+        for module in section.get("modules", []):
+            for content in module.get("contents", []):
+                if content.get("type") != "file":
+                    continue
+                if mimetype and content.get("mimetype") != mimetype:
+                    continue
+
+                files.append(CourseFile(
+                    section_name=section["name"],
+                    module_id=module["id"],
+                    module_name=module["name"],
+                    filename=content.get("filename", ""),
+                    fileurl=content["fileurl"],
+                    mimetype=content.get("mimetype", ""),
+                    timemodified=content.get("timemodified", 0),
+                    contenthash=content.get("contenthash", "")
+                ))
+
+    return files
+
+
 def get_course_assignaments(course_id: int) -> list[dict]:
     """
     Obtiene todas las tareas (assignments) de un curso específico en Moodle, incluyendo los archivos cargados por el docente.
@@ -402,14 +520,7 @@ def get_course_assignaments(course_id: int) -> list[dict]:
         Es necesario que el token proporcionado tenga permisos para acceder a la función 'mod_assign_get_assignments'.
     """
 
-    params = {
-        "wstoken": TOKEN,
-        "wsfunction": "mod_assign_get_assignments",
-        "moodlewsrestformat": "json",
-        "courseids[0]": course_id
-    }
-
-    response = requests.get(ENDPOINT, params=params)
+    response = _request("mod_assign_get_assignments", {"courseids[0]": course_id})
     response.raise_for_status()
 
     data = response.json()
@@ -423,22 +534,42 @@ def get_course_assignaments(course_id: int) -> list[dict]:
     return assignments
 
 
+_download_flights = SingleFlight("descarga de archivo")
+
+
 def download_file(fileurl: str, file_type: str):
     """
-    Descarga un archivo del moodle
+    Descarga un archivo del moodle (si otra tarea ya esta descargando el mismo archivo, espera ese resultado)
     """
+    site = sites.current()
+    return _download_flights.do((site.id, fileurl, file_type), lambda: _download_file(site, fileurl, file_type))
+
+
+def _download_file(site: sites.Site, fileurl: str, file_type: str):
     if "token=" not in fileurl:
         if "?" in fileurl:
-            fileurl += f"&token={TOKEN}"
+            fileurl += f"&token={site.token}"
         else:
-            fileurl += f"?token={TOKEN}"
+            fileurl += f"?token={site.token}"
+
+    headers = {"Authorization": f"Bearer {site.token}"}
+
+    def send() -> requests.Response:
+        with site.limit:
+            return site.session.get(fileurl, headers=headers, timeout=deadline.timeout(deadline.MOODLE_READ_TIMEOUT))
 
-    headers = {"Authorization": f"Bearer {TOKEN}"}
-    response = requests.get(fileurl, headers=headers)
+    with trace.span("moodle.download", site=site.id, mimetype=file_type) as info:
+        response = deadline.hedged(send, deadline.DOWNLOAD_HEDGE_AFTER_SECONDS)
+        info["status"] = response.status_code
+        info["bytes"] = len(response.content)
     
     if response.status_code == 200:
         if file_type == "application/pdf":
-            text = extract_text_from_pdf_bytes(response.content)
+            with trace.span("pdf.parse", bytes=len(response.content)) as info:
+                pages = extract_pages_from_pdf_bytes(response.content)
+                # Sin encabezados/pies repetidos ni palabras cortadas (ver tools/normalize.py)
+                text = normalize.pdf_to_text(pages, source=fileurl.split("?")[0].rsplit("/", 1)[-1])
+                info["chars"] = len(text)
         return text
     else:
         raise Exception(f"❌ Error al descargar archivo:\n{response.status_code}\n{response.text}")
@@ -0,0 +1,160 @@
+# Normalizacion de textos antes de vectorizarlos o mandarlos en el prompt
+#
+# Todo lo que llega al LLM se paga en tokens. Los mensajes del foro vienen en HTML de Moodle
+# (etiquetas, estilos, entidades) y el texto de los PDF trae palabras cortadas con guion al final
+# de la linea, espacios de mas y encabezados/pies de pagina repetidos en cada pagina.
+#   - post_to_text: HTML de un mensaje del foro -> texto plano (ver moodle.get_conversations)
+#   - pdf_to_text:  paginas de un PDF -> texto sin encabezados/pies repetidos, sin cortes de palabra
+# Se aplica al obtener el texto, asi llega normalizado tanto a los embeddings como al prompt.
+# Cada documento (PDF o discusion) deja un evento en la traza con los tokens antes y despues.
+import re
+import unicodedata
+from html import unescape
+from html.parser import HTMLParser
+
+import tools.IA as IA
+import tools.trace as trace
+
+
+# Cambia si cambia la normalizacion (se vuelve a extraer el texto de los archivos, ver course_index)
+NORMALIZATION_VERSION = 1
+
+# Lineas del principio y del final de cada pagina donde se buscan encabezados y pies
+HEADER_FOOTER_LINES = 3
+
+# Una linea se considera encabezado/pie si se repite en al menos esta fraccion de las paginas
+HEADER_FOOTER_MIN_FRACTION = 0.6
+HEADER_FOOTER_MIN_PAGES = 3
+
+BLOCK_TAGS = {
+    "p", "div", "br", "li", "tr", "ul", "ol", "table", "blockquote", "pre", "section", "article",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr"
+}
+SKIPPED_TAGS = {"script", "style", "head"}
+
+HYPHENATION_PATTERN = re.compile(r"(\w)-[ \t]*\n[ \t]*([a-záéíóúüñ])")
+SPACES_PATTERN = re.compile(r"[ \t\f\v\u00a0\u2000-\u200b\u202f\u205f\u3000]+")
+BLANK_LINES_PATTERN = re.compile(r"\n{3,}")
+PAGE_NUMBER_PATTERN = re.compile(r"^(p[aá]g(ina)?\.?\s*)?\d+(\s*(de|/|of)\s*\d+)?$", re.IGNORECASE)
+
+
+class _TextExtractor(HTMLParser):
+    """Junta el texto de un HTML, con saltos de linea en los bloques y '- ' en los items de listas."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: list[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag: str, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n- " if tag == "li" else "\n")
+        elif tag == "img":
+            alt = dict(attrs).get("alt")
+            if alt:
+                self.parts.append(f" [imagen: {alt}] ")
+
+    def handle_endtag(self, tag: str):
+        if tag in SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in BLOCK_TAGS and tag != "li":
+            self.parts.append("\n")
+
+    def handle_data(self, data: str):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """Texto plano de un fragmento HTML (sin etiquetas, con las entidades resueltas)."""
+    if "<" not in html:
+        return unescape(html)
+
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return "".join(extractor.parts)
+
+
+def clean_text(text: str) -> str:
+    """
+    Une palabras cortadas con guion al final de la linea, colapsa espacios y lineas vacias repetidas.
+    """
+    text = unicodedata.normalize("NFC", text).replace("\u00ad", "").replace("\r\n", "\n").replace("\r", "\n")
+    text = HYPHENATION_PATTERN.sub(r"\1\2", text)
+    lines = [SPACES_PATTERN.sub(" ", line).strip() for line in text.split("\n")]
+    return BLANK_LINES_PATTERN.sub("\n\n", "\n".join(lines)).strip()
+
+
+def _line_key(line: str) -> str:
+    # Los numeros de pagina cambian en cada pagina: "Pagina 3 de 10" y "Pagina 4 de 10" son la misma linea
+    line = line.strip().lower()
+    return "#pagina#" if PAGE_NUMBER_PATTERN.match(line) else line
+
+
+def strip_headers_footers(pages: list[str]) -> list[str]:
+    """
+    Quita de cada pagina las lineas de encabezado/pie: las que aparecen entre las primeras o ultimas
+    HEADER_FOOTER_LINES lineas de la mayoria de las paginas, y los numeros de pagina.
+    """
+    if len(pages) < HEADER_FOOTER_MIN_PAGES:
+        return pages
+
+    page_lines = [[line for line in page.split("\n") if line.strip()] for page in pages]
+
+    counts: dict[str, int] = {}
+    for lines in page_lines:
+        edges = {_line_key(line) for line in lines[:HEADER_FOOTER_LINES] + lines[-HEADER_FOOTER_LINES:]}
+        for key in edges:
+            counts[key] = counts.get(key, 0) + 1
+
+    threshold = max(HEADER_FOOTER_MIN_PAGES, HEADER_FOOTER_MIN_FRACTION * len(pages))
+    repeated = {key for key, count in counts.items() if count >= threshold}
+    if not repeated:
+        return pages
+
+    cleaned = []
+    for lines in page_lines:
+        top, bottom = HEADER_FOOTER_LINES, len(lines) - HEADER_FOOTER_LINES
+        cleaned.append("\n".join(
+            line for i, line in enumerate(lines)
+            if not ((i < top or i >= bottom) and _line_key(line) in repeated)
+        ))
+    return cleaned
+
+
+def report(kind: str, before: str, after: str, model: str = "gpt-4.1", **attributes) -> int:
+    """
+    Deja en la traza (o en la salida, fuera de una respuesta, ej. ingest.py) los tokens del documento
+    antes y despues de normalizarlo. Devuelve los tokens ahorrados.
+    """
+    tokens_before = IA.count_tokens(before, model)
+    tokens_after = IA.count_tokens(after, model)
+    saved = tokens_before - tokens_after
+
+    if trace.active():
+        trace.event("texto normalizado", kind=kind, tokens_before=tokens_before, tokens_after=tokens_after, saved=saved, **attributes)
+    else:
+        source = attributes.get("source") or kind
+        print(f"Normalizado {source}: {tokens_before} -> {tokens_after} tokens ({saved} menos)")
+    return saved
+
+
+def pdf_to_text(pages: list[str], source: str | None = None) -> str:
+    """
+    Texto de un PDF a partir del texto de cada pagina: sin encabezados/pies repetidos,
+    sin palabras cortadas entre lineas y sin espacios de mas.
+    """
+    raw = "\n".join(pages)
+    pages = strip_headers_footers([clean_text(page) for page in pages])
+    text = clean_text("\n\n".join(page for page in pages if page))
+    report("pdf", raw, text, pages=len(pages), source=source)
+    return text
+
+
+def post_to_text(html: str) -> str:
+    """Texto plano de un mensaje del foro (HTML de Moodle)."""
+    return clean_text(html_to_text(html))
+
@@ -0,0 +1,205 @@
+# Profiling bajo demanda de respond_discussion
+#
+# Se activa sin reiniciar los workers:
+#   - POST /admin/profile con el header X-Admin-Token (= ADMIN_TOKEN del .env) y {"runs": N, "course_id": opcional}
+#   - o al iniciar, con PROFILE_NEXT_RUNS=N y/o PROFILE_COURSE_ID=id en el .env
+#
+# La orden se guarda en files/state/profiling.json, que todos los workers consultan al empezar cada respuesta.
+# Cada ejecucion perfilada genera files/profiles/<fecha>_curso<id>_discusion<id>.folded, en formato
+# "stack colapsado" (compatible con flamegraph.pl, speedscope, etc.). Cada pila empieza con el hilo
+# donde se tomo: el event loop o los hilos de asyncio.to_thread (parseo de PDF, indice, embeddings, LLM).
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import threading
+import contextlib
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTROL_PATH = os.path.join(BASE_DIR, "files", "state", "profiling.json")
+PROFILES_DIR = os.path.join(BASE_DIR, "files", "profiles")
+
+# Intervalo entre muestras (segundos). 5 ms mantiene el costo bajo
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+
+# Ejecucion perfilada de la respuesta actual. Se copia con el contexto a los hilos de asyncio.to_thread
+_active_profiler: contextvars.ContextVar["SamplingProfiler | None"] = contextvars.ContextVar("active_profiler", default=None)
+
+EXECUTOR_FILE = os.path.join("concurrent", "futures", "thread.py")
+THREADING_FILE = "threading.py"
+
+
+def _thread_context(frame) -> contextvars.Context | None:
+    """
+    Contexto con el que corre un hilo lanzado con functools.partial(contexto.run, func, ...):
+        -ThreadPoolExecutor (asyncio.to_thread, deadline.hedged): queda en el _WorkItem del frame de _WorkItem.run
+        -threading.Thread (single-flight): queda en el _target del frame de Thread.run
+    """
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == "run" and code.co_filename.endswith(EXECUTOR_FILE):
+            call = getattr(frame.f_locals.get("self"), "fn", None)
+        elif code.co_name == "run" and os.path.basename(code.co_filename) == THREADING_FILE:
+            call = getattr(frame.f_locals.get("self"), "_target", None)
+        else:
+            frame = frame.f_back
+            continue
+
+        context = getattr(getattr(call, "func", None), "__self__", None)
+        return context if isinstance(context, contextvars.Context) else None
+    return None
+
+
+class SamplingProfiler:
+    """
+    Profiler por muestreo: un hilo aparte toma cada 'interval' segundos las pilas de los hilos
+    (sys._current_frames) y cuenta cuantas veces aparece cada pila. No instrumenta el codigo,
+    asi que el costo sobre la respuesta es minimo.
+    Solo se cuentan las pilas de esta ejecucion:
+        -en el event loop, cuando la pila pasa por 'root' (el frame de respond_discussion);
+         las demas respuestas que corren en el mismo loop no se mezclan
+        -en los hilos de asyncio.to_thread, deadline.hedged y single-flight, cuando corren con el contexto de esta ejecucion
+    """
+
+    def __init__(self, root, interval: float = SAMPLE_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _belongs(self, frame) -> bool:
+        context = _thread_context(frame)
+        if context is not None:
+            return context.get(_active_profiler) is self
+
+        while frame is not None:
+            if frame is self.root:
+                return True
+            frame = frame.f_back
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self._thread.ident or not self._belongs(frame):
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                # Los hilos de un mismo pool se agrupan (asyncio_0, asyncio_1... -> asyncio)
+                stack.append(f"hilo {re.sub(r'_[0-9]+$', '', names.get(thread_id, '?'))}")
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write_folded(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def _control_file():
+    """
+    Abre files/state/profiling.json con lock exclusivo (lo comparten todos los workers).
+    Entrega el dict de control; lo que se modifique se guarda al salir.
+    """
+    os.makedirs(os.path.dirname(CONTROL_PATH), exist_ok=True)
+    with open(CONTROL_PATH, "a+") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.seek(0)
+            content = file.read()
+            control = json.loads(content) if content.strip() else {}
+            original = dict(control)
+
+            yield control
+
+            if control != original:
+                file.seek(0)
+                file.truncate()
+                json.dump(control, file)
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def request_profiling(runs: int, course_id: int | None = None):
+    """
+    Pide perfilar las proximas 'runs' ejecuciones (de cualquier curso, o solo de course_id).
+    """
+    with _control_file() as control:
+        control["remaining"] = runs
+        control["course_id"] = course_id
+
+
+def _consume_run(course_id: int | None) -> bool:
+    # Chequeo barato: si no hay archivo de control no hay nada pedido
+    if not os.path.exists(CONTROL_PATH):
+        return False
+
+    with _control_file() as control:
+        if control.get("remaining", 0) <= 0:
+            return False
+        if control.get("course_id") is not None and control["course_id"] != course_id:
+            return False
+
+        control["remaining"] -= 1
+        return True
+
+
+def init_from_env():
+    """
+    Toma PROFILE_NEXT_RUNS / PROFILE_COURSE_ID del entorno al iniciar el servicio.
+    """
+    runs = int(os.getenv("PROFILE_NEXT_RUNS", "0"))
+    course_id = os.getenv("PROFILE_COURSE_ID")
+
+    if runs > 0 or course_id:
+        request_profiling(runs or 1, int(course_id) if course_id else None)
+
+
+@contextmanager
+def maybe_profile(course_id: int | None, discussion_id: int):
+    """
+    Si hay un pedido de profiling pendiente para este curso, perfila el bloque (y lo que lance en
+    asyncio.to_thread) y escribe el resultado al terminar. Si no, no hace nada.
+    """
+    if not _consume_run(course_id):
+        yield None
+        return
+
+    # Frame de quien abre el bloque (respond_discussion), salteando los de contextlib
+    root = sys._getframe(1)
+    while root is not None and root.f_code.co_filename == contextlib.__file__:
+        root = root.f_back
+
+    profiler = SamplingProfiler(root)
+    token = _active_profiler.set(profiler)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active_profiler.reset(token)
+        path = os.path.join(PROFILES_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_curso{course_id}_discusion{discussion_id}.folded")
+        profiler.write_folded(path)
+        print(f"Profiling guardado en {path} ({sum(profiler.samples.values())} muestras)")
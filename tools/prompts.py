@@ -0,0 +1,56 @@
+# Armado de los system prompts
+#
+# OpenAI cachea automaticamente el prefijo de los prompts que se repiten byte a byte.
+# Por eso el prompt se arma siempre en el mismo orden:
+#   1. Template (files/system_prompts)       -> igual para todos los cursos
+#   2. Informacion general del curso          -> igual para todas las preguntas del curso
+#   3. Contenido general (estructura) del curso
+#   4. Contenido variable (recuperado para la pregunta, actividades, etc.) SIEMPRE al final
+import os
+import threading
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATES_DIR = os.path.join(BASE_DIR, "files", "system_prompts")
+
+# nombre -> (mtime, contenido)
+_templates: dict[str, tuple[float, str]] = {}
+_templates_lock = threading.Lock()
+
+
+def load_template(name: str) -> str:
+    """
+    Devuelve el contenido de files/system_prompts/<name>.txt.
+    El archivo se lee una sola vez y se vuelve a leer solo si cambio su fecha de modificacion,
+    asi se pueden editar los prompts sin reiniciar el servicio.
+    """
+    path = os.path.join(TEMPLATES_DIR, f"{name}.txt")
+    mtime = os.stat(path).st_mtime
+
+    with _templates_lock:
+        cached = _templates.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+    with open(path, "r") as file:
+        template = file.read()
+
+    with _templates_lock:
+        _templates[name] = (mtime, template)
+
+    return template
+
+
+def build_course_prefix(template_name: str, general_info: str, course_outline: str) -> str:
+    """
+    Arma la parte fija del prompt de un curso: template + informacion general + estructura del curso.
+    No debe incluir nada que dependa de la pregunta, para que el prefijo sea identico entre respuestas.
+    """
+    return f"{load_template(template_name)}{general_info}{course_outline}"
+
+
+def assemble_system_prompt(prefix: str, sections: list[str]) -> str:
+    """
+    Agrega al prefijo fijo las secciones variables (contenido recuperado, actividades, etc.), en orden.
+    """
+    return prefix + "".join(section for section in sections if section)
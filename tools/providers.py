@@ -0,0 +1,157 @@
+# Proveedores de modelos (chat y embeddings)
+#
+# IA.py ya no tiene las URLs de OpenAI fijas: pide el proveedor de chat y el de embeddings, que se eligen en el .env:
+#   - CHAT_PROVIDER      = openai | local
+#   - EMBEDDING_PROVIDER = openai | local | cpu
+# Proveedores:
+#   - openai: la API de OpenAI (con el limitador de IA.RateLimiter).
+#   - local:  cualquier servidor compatible con la API de OpenAI (vLLM, llama.cpp, Ollama, LM Studio...)
+#             en LOCAL_API_URL. Los modelos se pueden renombrar con LOCAL_CHAT_MODEL / LOCAL_EMBEDDING_MODEL.
+#   - cpu:    modelo de embeddings cargado en el mismo proceso desde CPU_EMBEDDING_MODEL_PATH
+#             (formato sentence-transformers), en lotes sobre un pool de hilos. Sin red: unos pocos ms
+#             por consulta en lugar de un viaje a la API, y funciona sin conexion.
+from __future__ import annotations
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.tools import lazy_import
+
+np = lazy_import("numpy")
+sentence_transformers = lazy_import("sentence_transformers")
+
+
+CHAT_PROVIDER = os.getenv("CHAT_PROVIDER", "openai")
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+
+OPENAI_API_URL = "https://api.openai.com/v1"
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Servidor local compatible con la API de OpenAI (ej. http://localhost:8000/v1)
+LOCAL_API_URL = os.getenv("LOCAL_API_URL", "http://localhost:8000/v1")
+LOCAL_API_KEY = os.getenv("LOCAL_API_KEY", "")
+LOCAL_CHAT_MODEL = os.getenv("LOCAL_CHAT_MODEL")
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL")
+
+# Modelo de embeddings en proceso (CPU)
+CPU_EMBEDDING_MODEL_PATH = os.getenv("CPU_EMBEDDING_MODEL_PATH")
+CPU_EMBEDDING_THREADS = int(os.getenv("CPU_EMBEDDING_THREADS", "2"))
+CPU_EMBEDDING_BATCH_SIZE = int(os.getenv("CPU_EMBEDDING_BATCH_SIZE", "32"))
+
+
+class HTTPProvider:
+    """
+    API compatible con OpenAI (/chat/completions y /embeddings).
+    rate_limited indica si las llamadas pasan por el limitador de OpenAI (IA.RateLimiter).
+    """
+
+    def __init__(self, name: str, base_url: str, api_key: str | None, chat_model: str | None = None, embedding_model: str | None = None, rate_limited: bool = True):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.chat_model = chat_model
+        self.embedding_model = embedding_model
+        self.rate_limited = rate_limited
+
+    @property
+    def chat_url(self) -> str:
+        return f"{self.base_url}/chat/completions"
+
+    @property
+    def embeddings_url(self) -> str:
+        return f"{self.base_url}/embeddings"
+
+    def headers(self) -> dict:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def chat_model_for(self, model: str) -> str:
+        """Nombre del modelo en este proveedor (el servidor local puede tener otro modelo que el pedido)."""
+        return self.chat_model or model
+
+    def embedding_model_for(self, model: str) -> str:
+        return self.embedding_model or model
+
+    def embedding_id(self, model: str) -> str:
+        """Identifica el espacio de los vectores: embeddings de distintos proveedores/modelos no se comparan."""
+        return f"{self.name}:{self.embedding_model_for(model)}"
+
+
+class CPUEmbeddingProvider:
+    """
+    Modelo de embeddings en el mismo proceso (sentence-transformers en CPU). Se carga la primera vez que se usa;
+    los textos se reparten en lotes de CPU_EMBEDDING_BATCH_SIZE entre CPU_EMBEDDING_THREADS hilos.
+    """
+
+    name = "cpu"
+    rate_limited = False
+
+    def __init__(self, path: str, threads: int = CPU_EMBEDDING_THREADS, batch_size: int = CPU_EMBEDDING_BATCH_SIZE):
+        if not path:
+            raise ValueError("EMBEDDING_PROVIDER=cpu requiere CPU_EMBEDDING_MODEL_PATH")
+        self.path = path
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="cpu-embeddings")
+
+    def _load(self):
+        with self._lock:
+            if self._model is None:
+                self._model = sentence_transformers.SentenceTransformer(self.path, device="cpu")
+            return self._model
+
+    @property
+    def dimensions(self) -> int:
+        return int(self._load().get_sentence_embedding_dimension())
+
+    def embed(self, texts: list[str]):
+        """Embeddings normalizados (float32, n x dim) de 'texts', en el mismo orden."""
+        model = self._load()
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+
+        def encode(batch: list[str]):
+            return model.encode(batch, batch_size=len(batch), convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+
+        if len(batches) == 1:
+            return encode(batches[0]).astype(np.float32)
+        return np.vstack(list(self._pool.map(encode, batches))).astype(np.float32)
+
+    def embedding_id(self, model: str) -> str:
+        return f"cpu:{os.path.basename(os.path.normpath(self.path))}"
+
+
+_chat_provider = None
+_embedding_provider = None
+_providers_lock = threading.Lock()
+
+
+def _create(name: str, kind: str):
+    if name == "openai":
+        return HTTPProvider("openai", OPENAI_API_URL, OPENAI_API_KEY)
+    if name == "local":
+        return HTTPProvider("local", LOCAL_API_URL, LOCAL_API_KEY, LOCAL_CHAT_MODEL, LOCAL_EMBEDDING_MODEL, rate_limited=False)
+    if name == "cpu" and kind == "embeddings":
+        return CPUEmbeddingProvider(CPU_EMBEDDING_MODEL_PATH)
+    raise ValueError(f"Proveedor de {kind} no soportado: {name}")
+
+
+def chat() -> HTTPProvider:
+    """Proveedor de chat configurado (CHAT_PROVIDER)."""
+    global _chat_provider
+    with _providers_lock:
+        if _chat_provider is None:
+            _chat_provider = _create(CHAT_PROVIDER, "chat")
+        return _chat_provider
+
+
+def embeddings() -> "HTTPProvider | CPUEmbeddingProvider":
+    """Proveedor de embeddings configurado (EMBEDDING_PROVIDER)."""
+    global _embedding_provider
+    with _providers_lock:
+        if _embedding_provider is None:
+            _embedding_provider = _create(EMBEDDING_PROVIDER, "embeddings")
+        return _embedding_provider
@@ -0,0 +1,115 @@
+# Afinidad de cursos entre nodos
+#
+# Con varios procesos (o varios servidores) cada curso se atiende siempre en el mismo nodo, asi su
+# indice, modelo y caches quedan "calientes" en un solo lugar en vez de repetirse en todos los workers.
+# El nodo de cada curso se elige con rendezvous hashing (HRW): si se agrega o quita un nodo solo se
+# mueven los cursos de ese nodo.
+#
+# Configuracion (ver deploy.py --nodos):
+#   - NODE_URL:       URL de este nodo (ej. http://10.0.0.1:8765)
+#   - CLUSTER_NODES:  URLs de todos los nodos separadas por coma, o files/cluster.json con una lista
+#                     (el archivo se relee si cambia, para sumar o sacar nodos sin reiniciar)
+#   - CLUSTER_TOKEN:  secreto compartido para los eventos reenviados entre nodos
+# Sin NODE_URL o con un solo nodo no se reenvia nada.
+import os
+import json
+import time
+import hashlib
+import threading
+
+import requests
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLUSTER_PATH = os.path.join(BASE_DIR, "files", "cluster.json")
+
+NODE_URL = os.getenv("NODE_URL")
+CLUSTER_NODES = os.getenv("CLUSTER_NODES", "")
+CLUSTER_TOKEN = os.getenv("CLUSTER_TOKEN")
+
+# Un nodo que no responde queda afuera del reparto durante este tiempo (segundos)
+NODE_RETRY_SECONDS = float(os.getenv("NODE_RETRY_SECONDS", "30"))
+
+_nodes: list[str] = []
+_nodes_mtime = None
+_down_until: dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def _load_nodes() -> list[str]:
+    """
+    Nodos configurados: files/cluster.json si existe (se relee cuando cambia), si no CLUSTER_NODES.
+    """
+    global _nodes, _nodes_mtime
+
+    try:
+        mtime = os.path.getmtime(CLUSTER_PATH)
+    except OSError:
+        mtime = None
+
+    with _lock:
+        if mtime is not None and mtime != _nodes_mtime:
+            with open(CLUSTER_PATH, "r") as file:
+                _nodes = [node.rstrip("/") for node in json.load(file)]
+            _nodes_mtime = mtime
+        elif mtime is None:
+            _nodes = [node.strip().rstrip("/") for node in CLUSTER_NODES.split(",") if node.strip()]
+            _nodes_mtime = None
+        return list(_nodes)
+
+
+def _score(node: str, key: str) -> int:
+    return int.from_bytes(hashlib.sha1(f"{node}|{key}".encode()).digest()[:8], "big")
+
+
+def owner_of(key: str, nodes: list[str]) -> str | None:
+    """
+    Nodo duenio de 'key' entre 'nodes' (rendezvous hashing: el de mayor hash(nodo, key)).
+    """
+    if not nodes:
+        return None
+    return max(nodes, key=lambda node: _score(node, key))
+
+
+def owner(site_id: str, course_id: int) -> str | None:
+    """
+    Nodo que atiende el curso, o None si lo atiende este nodo (o si no hay reparto entre nodos).
+    Los nodos marcados como caidos no participan hasta que pase NODE_RETRY_SECONDS.
+    """
+    if not NODE_URL:
+        return None
+
+    now = time.time()
+    nodes = [node for node in _load_nodes() if node == NODE_URL.rstrip("/") or _down_until.get(node, 0) <= now]
+    if len(nodes) <= 1:
+        return None
+
+    node = owner_of(f"{site_id}:{course_id}", nodes)
+    return None if node == NODE_URL.rstrip("/") else node
+
+
+def forward(node: str, site_id: str, data: dict) -> bool:
+    """
+    Reenvia el evento al nodo duenio del curso. Si no responde se lo marca como caido (sus cursos
+    pasan a otros nodos) y se devuelve False para que el evento se procese aca.
+    """
+    try:
+        response = requests.post(
+            f"{node}/internal/webhook/{site_id}",
+            json=data,
+            headers={"X-Cluster-Token": CLUSTER_TOKEN or ""},
+            timeout=(1, 5)
+        )
+        if response.status_code == 200:
+            return True
+        print(f"El nodo {node} rechazo el evento reenviado: {response.status_code}")
+    except requests.exceptions.RequestException as e:
+        print(f"No se pudo reenviar el evento al nodo {node}: {e}")
+
+    with _lock:
+        _down_until[node] = time.time() + NODE_RETRY_SECONDS
+    return False
+
+
+def is_cluster_request(token: str | None) -> bool:
+    return bool(CLUSTER_TOKEN) and token == CLUSTER_TOKEN
@@ -0,0 +1,128 @@
+# Estado por discusion (sesiones) para responder seguimientos de forma incremental
+#
+# Cada mensaje nuevo en una discusion volvia a armar todo desde cero: el historial del chat,
+# los embeddings de la conversacion, la clasificacion de la consulta y la busqueda.
+# La sesion de la discusion guarda lo ya procesado de cada post (mensaje del chat y embedding),
+# la intencion del mensaje inicial y la ultima busqueda; en un seguimiento solo se procesan los posts nuevos.
+#
+# Las sesiones viven en memoria del worker (con varios nodos cada curso se atiende siempre en el
+# mismo, ver tools/routing.py) y se descartan despues de SESSION_TTL sin actividad.
+from __future__ import annotations
+
+import os
+import time
+import threading
+from typing import Callable
+from dataclasses import dataclass, field
+
+import tools.sites as sites
+from tools.tools import lazy_import
+
+np = lazy_import("numpy")
+
+
+# Tiempo sin mensajes despues del cual se descarta la sesion de una discusion (segundos)
+SESSION_TTL = int(os.getenv("SESSION_TTL", "86400"))
+
+# Sesiones que se mantienen como maximo por worker (se descartan las de menor actividad reciente)
+SESSION_MAX = int(os.getenv("SESSION_MAX", "2000"))
+
+# Mensajes que forman el embedding de la conversacion
+CONVERSATION_WINDOW = 5
+
+
+@dataclass(slots=True)
+class DiscussionSession:
+    """
+    Lo ya procesado de una discusion:
+        -interactions -> id_post -> (texto del post, mensaje del chat ya armado {"role", "content"})
+        -embeddings   -> id_post -> (texto del post, embedding normalizado)
+    Si se edita un post (cambia su texto) se vuelve a procesar.
+        -intent       -> (id del post inicial, tags) de la ultima clasificacion
+        -last_search  -> (version del indice, consultas, resultados) de la ultima busqueda
+    """
+    site_id: str
+    discussion_id: int
+    interactions: dict[int, tuple[str, dict]] = field(default_factory=dict)
+    embeddings: dict[int, tuple[str, "np.ndarray"]] = field(default_factory=dict)
+    intent: tuple[int, list[str]] | None = None
+    last_search: tuple[str, list[str], list[dict]] | None = None
+    updated: float = field(default_factory=time.time)
+
+    def chat_history(self, messages: list[dict], build: Callable[[dict], dict]) -> list[dict]:
+        """
+        Historial del chat de la conversacion. Solo se arma ('build') el mensaje de los posts nuevos.
+        """
+        for message in messages:
+            cached = self.interactions.get(message["id_post"])
+            if cached is None or cached[0] != message["text"]:
+                self.interactions[message["id_post"]] = (message["text"], build(message))
+        return [self.interactions[message["id_post"]][1] for message in messages]
+
+    def embedding(self, message: dict):
+        """Embedding del post, o None si no se calculo (o si el post cambio despues)."""
+        cached = self.embeddings.get(message["id_post"])
+        return cached[1] if cached and cached[0] == message["text"] else None
+
+    def missing_embeddings(self, messages: list[dict]) -> list[dict]:
+        """
+        Posts (de 'messages') que hacen falta para la consulta y todavia no tienen embedding:
+        el inicial, el ultimo y los CONVERSATION_WINDOW ultimos.
+        """
+        needed = {message["id_post"]: message for message in [messages[0]] + messages[-CONVERSATION_WINDOW:]}
+        return [message for message in needed.values() if self.embedding(message) is None]
+
+    def add_embeddings(self, messages: list[dict], vectors):
+        for message, vector in zip(messages, vectors):
+            vector = np.asarray(vector, dtype=np.float32)
+            self.embeddings[message["id_post"]] = (message["text"], vector / (np.linalg.norm(vector) or 1))
+
+    def conversation_embedding(self, messages: list[dict]):
+        """
+        Embedding de la conversacion: promedio (normalizado) de los embeddings de los ultimos
+        CONVERSATION_WINDOW posts. None si falta alguno.
+        """
+        window = [self.embedding(message) for message in messages[-CONVERSATION_WINDOW:]]
+        if any(vector is None for vector in window) or len({len(vector) for vector in window}) != 1:
+            return None
+        mean = np.mean(window, axis=0)
+        return mean / (np.linalg.norm(mean) or 1)
+
+    def cached_search(self, version: str, queries: list[str]) -> list[dict] | None:
+        """Resultados de la ultima busqueda si fue con las mismas consultas sobre la misma version del indice."""
+        if self.last_search and self.last_search[0] == version and self.last_search[1] == queries:
+            return self.last_search[2]
+        return None
+
+    def prune(self, messages: list[dict]):
+        """Descarta los posts que ya no estan en la discusion (ej. borrados)."""
+        alive = {message["id_post"] for message in messages}
+        for cache in (self.interactions, self.embeddings):
+            for post_id in [post_id for post_id in cache if post_id not in alive]:
+                del cache[post_id]
+
+
+# (site_id, discussion_id) -> DiscussionSession
+_sessions: dict[tuple[str, int], DiscussionSession] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(discussion_id: int) -> DiscussionSession:
+    """
+    Sesion de la discusion (del sitio actual). Se crea vacia si no existe o si vencio.
+    """
+    key = (sites.current().id, discussion_id)
+    now = time.time()
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None or now - session.updated > SESSION_TTL:
+            session = DiscussionSession(key[0], discussion_id)
+            _sessions[key] = session
+
+            if len(_sessions) > SESSION_MAX:
+                for old_key, _ in sorted(_sessions.items(), key=lambda item: item[1].updated)[:len(_sessions) - SESSION_MAX]:
+                    del _sessions[old_key]
+
+        session.updated = now
+        return session
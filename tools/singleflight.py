@@ -0,0 +1,73 @@
+# Single-flight: una sola ejecucion a la vez por clave
+#
+# Cuando varios alumnos escriben a la vez en el mismo curso, cada respuesta pedia el contenido del
+# curso, descargaba y extraia los mismos archivos y los vectorizaba en paralelo. Con SingleFlight la
+# primera tarea que pide una clave (ej. curso + version del contenido) hace el trabajo y las demas
+# esperan ese mismo resultado (o error). Cuando termina, la clave se libera: el siguiente pedido
+# vuelve a ejecutar (los caches de cada modulo deciden si hace falta trabajo).
+#
+# El trabajo compartido corre en un hilo propio con su propio plazo (deadline.SHARED_DEADLINE_SECONDS), no con el
+# de la tarea que lo lanzo: si esa tarea se queda sin tiempo deja de esperar, pero el trabajo sigue para las demas.
+#
+# Es por proceso: entre nodos, cada curso se atiende en uno solo (ver tools/routing.py).
+import functools
+import threading
+import contextvars
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Hashable, TypeVar
+
+import tools.trace as trace
+import tools.deadline as deadline
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, call: Callable[[], T]) -> T:
+        """
+        Ejecuta 'call' si no hay otra ejecucion en curso para 'key'; si la hay, espera su resultado.
+        Cada tarea (tambien la que lanzo la ejecucion) espera hasta su propio plazo (deadline.DeadlineExceeded).
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if leader:
+            # Con el contexto de quien la lanza (sitio, traza, curso); el plazo se reemplaza en _run
+            context = contextvars.copy_context()
+            # functools.partial(contexto.run, ...) como asyncio.to_thread: el profiler reconoce el hilo (ver tools/profiler.py)
+            target = functools.partial(context.run, self._run, key, call, future)
+            threading.Thread(target=target, name=f"singleflight-{self.name}", daemon=True).start()
+        else:
+            trace.event("esperando una ejecucion en curso", flight=self.name)
+
+        try:
+            left = deadline.remaining()
+            return future.result(timeout=None if left is None else max(left, 0))
+        except FutureTimeout:
+            raise deadline.DeadlineExceeded(f"Se agoto el plazo esperando {self.name}")
+
+    def _run(self, key: Hashable, call: Callable[[], T], future: Future):
+        try:
+            with deadline.extend(deadline.SHARED_DEADLINE_SECONDS):
+                result = call()
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
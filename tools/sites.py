@@ -0,0 +1,91 @@
+# Registro de sitios Moodle
+#
+# Un mismo proceso puede atender varios Moodle (por ejemplo, varios campus). Cada sitio tiene
+# su propia URL, token, pool de conexiones y limite de llamadas simultaneas; los caches
+# (identidad, cursos, indices, watermarks) se separan por sitio.
+#
+# Configuracion:
+#   - Sitio por defecto ("default"): MOODLE_URL y TOKEN del .env (como siempre).
+#   - Sitios adicionales: files/sites.json (o la ruta de MOODLE_SITES_FILE) con una lista de
+#     {"id": "campus_norte", "url": "https://...", "token": "...", "max_concurrency": 8}
+#
+# Los webhooks de cada sitio se reciben en /webhook/<id> (/webhook es el sitio por defecto).
+import os
+import json
+import threading
+from contextvars import ContextVar
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+
+# === CONFIGURACIÓN ===
+current_dir = os.path.dirname(os.path.abspath(__file__))
+dotenv_path = os.path.join(current_dir, '.env')
+load_dotenv(dotenv_path)
+
+BASE_DIR = os.path.dirname(current_dir)
+SITES_PATH = os.getenv("MOODLE_SITES_FILE", os.path.join(BASE_DIR, "files", "sites.json"))
+
+DEFAULT_SITE_ID = "default"
+
+# Llamadas simultaneas a un mismo Moodle, para no saturarlo
+MOODLE_MAX_CONCURRENCY = int(os.getenv("MOODLE_MAX_CONCURRENCY", "8"))
+
+
+class Site:
+    """
+    Un sitio Moodle: URL, token, sesion HTTP (pool de conexiones reutilizables) y limite de concurrencia.
+    """
+
+    def __init__(self, site_id: str, url: str, token: str, max_concurrency: int = MOODLE_MAX_CONCURRENCY):
+        self.id = site_id
+        self.url = url
+        self.token = token
+        self.endpoint = f"{url}/webservice/rest/server.php"
+        self.limit = threading.BoundedSemaphore(max_concurrency)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __repr__(self) -> str:
+        return f"Site({self.id!r}, {self.url!r})"
+
+
+def _load_sites() -> dict[str, Site]:
+    sites = {DEFAULT_SITE_ID: Site(DEFAULT_SITE_ID, os.getenv("MOODLE_URL"), os.getenv("TOKEN"))}
+
+    try:
+        with open(SITES_PATH, "r") as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        return sites
+
+    for site in config:
+        sites[site["id"]] = Site(site["id"], site["url"], site["token"], site.get("max_concurrency", MOODLE_MAX_CONCURRENCY))
+
+    return sites
+
+
+_sites = _load_sites()
+
+# Sitio de la tarea actual (se copia a las tareas y hilos que esta cree)
+current_site: ContextVar[Site] = ContextVar("current_site", default=_sites[DEFAULT_SITE_ID])
+
+
+def get_site(site_id: str) -> Site:
+    """
+    Devuelve el sitio registrado con ese id. KeyError si no existe.
+    """
+    return _sites[site_id]
+
+
+def all_sites() -> list[Site]:
+    return list(_sites.values())
+
+
+def current() -> Site:
+    return current_site.get()
@@ -0,0 +1,161 @@
+# Sincronizacion incremental de foros
+#
+# Si se pierde un webhook (o el servicio estuvo caido) la consulta queda sin responder.
+# Para recuperarlas se guarda por foro el 'timemodified' y el id de la ultima discusion procesada
+# (watermark) y solo se piden las discusiones posteriores. El id desempata las discusiones modificadas
+# en el mismo segundo: si una falla, las del mismo timemodified que faltan se vuelven a pedir.
+import os
+import math
+import json
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+import tools.moodle as moodle
+import tools.sites as sites
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = os.path.join(BASE_DIR, "files", "state")
+WATERMARKS_PATH = os.path.join(STATE_DIR, "forum_watermarks.json")
+LOCK_PATH = os.path.join(STATE_DIR, "forum_sync.lock")
+
+# En la primera sincronizacion de un foro solo se miran las discusiones de este periodo,
+# para no responder toda la historia del foro
+INITIAL_LOOKBACK_HOURS = float(os.getenv("SYNC_INITIAL_LOOKBACK_HOURS", "24"))
+
+DISCUSSIONS_PAGE_SIZE = 50
+
+# Intentos fallidos de una discusion antes de saltearla (el watermark avanza igual, para no trabar el foro)
+SYNC_MAX_FAILURES = int(os.getenv("SYNC_MAX_FAILURES", "3"))
+
+
+class WatermarkStore:
+    """
+    Guarda en un archivo JSON el watermark de cada foro: {forum_id: [timemodified, discussion_id]}.
+    Los foros de sitios distintos del sitio por defecto se guardan como "<sitio>:<forum_id>".
+    Un watermark viejo (solo timemodified) cuenta como todas las discusiones de ese segundo procesadas.
+    """
+
+    def __init__(self, path: str = WATERMARKS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def _key(forum_id: int) -> str:
+        site = sites.current()
+        return str(forum_id) if site.id == sites.DEFAULT_SITE_ID else f"{site.id}:{forum_id}"
+
+    def get(self, forum_id: int) -> tuple[int, float] | None:
+        """(timemodified, discussion_id) de la ultima discusion procesada del foro, o None."""
+        with self._lock:
+            watermark = self._read().get(self._key(forum_id))
+        if watermark is None:
+            return None
+        if isinstance(watermark, list):
+            return (watermark[0], watermark[1])
+        return (watermark, math.inf)
+
+    def set(self, forum_id: int, timemodified: int, discussion_id: int):
+        with self._lock:
+            watermarks = self._read()
+            watermarks[self._key(forum_id)] = [timemodified, discussion_id]
+
+            # Escritura atomica: otro proceso nunca ve el archivo a medio escribir
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(watermarks, file)
+            os.replace(tmp_path, self.path)
+
+
+class FailureCounter:
+    """
+    Cuenta los intentos fallidos de cada discusion (por sitio y timemodified: si la discusion cambia, se vuelve a contar).
+    Es por proceso: alcanza para no reintentar para siempre una discusion que siempre falla.
+    """
+
+    def __init__(self, max_failures: int = SYNC_MAX_FAILURES):
+        self.max_failures = max_failures
+        self._failures: dict[tuple[str, int, int], int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, discussion_id: int, timemodified: int) -> bool:
+        """Registra un fallo. Devuelve True si la discusion ya agoto sus intentos (hay que saltearla)."""
+        key = (sites.current().id, discussion_id, timemodified)
+        with self._lock:
+            self._failures[key] = self._failures.get(key, 0) + 1
+            if self._failures[key] < self.max_failures:
+                return False
+            del self._failures[key]
+            return True
+
+    def clear(self, discussion_id: int, timemodified: int):
+        with self._lock:
+            self._failures.pop((sites.current().id, discussion_id, timemodified), None)
+
+
+def _position(discussion: dict) -> tuple[int, int]:
+    return (discussion["timemodified"], discussion["discussion"])
+
+
+def get_discussions_since(forum_id: int, since: tuple[int, float]) -> list[dict]:
+    """
+    Devuelve las discusiones del foro posteriores al watermark 'since' (timemodified, discussion_id),
+    de la mas vieja a la mas nueva (a igual timemodified, por id).
+    Se piden ordenadas por ultima actividad y se deja de paginar al llegar a una anterior al watermark,
+    asi el trabajo es proporcional a la actividad nueva y no al tamaño del foro.
+    """
+    discussions = []
+    page = 0
+
+    while True:
+        content = moodle.get_forum_content(forum_id, sort_order=moodle.DISCUSSIONS_BY_LAST_POST, page=page, per_page=DISCUSSIONS_PAGE_SIZE)
+        page_discussions = content.get("discussions", [])
+        reached_watermark = False
+
+        for discussion in page_discussions:
+            if _position(discussion) > since:
+                discussions.append(discussion)
+
+            # Las discusiones fijadas aparecen primero sin importar su fecha. Las del mismo segundo que el
+            # watermark pueden venir en cualquier orden: se sigue hasta una estrictamente anterior
+            elif not discussion.get("pinned") and discussion["timemodified"] < since[0]:
+                reached_watermark = True
+
+        if reached_watermark or len(page_discussions) < DISCUSSIONS_PAGE_SIZE:
+            break
+        page += 1
+
+    return sorted(discussions, key=_position)
+
+
+def initial_watermark() -> tuple[int, int]:
+    return (int(time.time() - INITIAL_LOOKBACK_HOURS * 3600), 0)
+
+
+@contextmanager
+def sync_lock():
+    """
+    Evita que varios workers sincronicen al mismo tiempo. Entrega True si se obtuvo el lock, False si otro lo tiene.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(LOCK_PATH, "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
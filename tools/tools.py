@@ -1,11 +1,42 @@
-# PDF
-import fitz             # PyMuPDF
+import importlib
 from io import BytesIO  # Leer binarios
 
+
+class LazyModule:
+    """
+    Modulo que se importa recien la primera vez que se usa uno de sus atributos.
+    Sirve para que importar app.py no cargue librerias pesadas (PyMuPDF, FAISS, NumPy, tiktoken)
+    en workers o requests que nunca las necesitan.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+# PDF
+fitz = lazy_import("fitz")  # PyMuPDF
+
+
+def extract_pages_from_pdf_bytes(pdf_bytes: bytes) -> list[str]:
+    buffer = BytesIO(pdf_bytes)
+    doc = fitz.open(stream=buffer, filetype="pdf")
+    return [page.get_text() for page in doc]
+
+
 def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
     buffer = BytesIO(pdf_bytes)
     doc = fitz.open(stream=buffer, filetype="pdf")
     text = ""
     for page in doc:
         text += page.get_text()
-    return text
\ No newline at end of file
+    return text
@@ -0,0 +1,214 @@
+# Trazas estructuradas por respuesta
+#
+# Cada discusion procesada genera UN registro JSON (una linea) en files/logs/traces.<pid>.jsonl con:
+#   - id de correlacion, curso y discusion
+#   - un span por cada etapa (llamadas a Moodle, descargas, parseo, embeddings, busqueda, LLM)
+#     con su duracion, tamaños, tokens y si hubo cache hit/miss
+#   - los eventos/decisiones del flujo (en lugar de los prints)
+# Cada proceso (worker de uvicorn o nodo) escribe y rota su propio archivo: la rotacion de
+# RotatingFileHandler no es segura con varios procesos escribiendo el mismo archivo.
+#
+# Resumen de las etapas mas lentas:
+#   python -m tools.trace --minutos 60
+import os
+import sys
+import json
+import time
+import uuid
+import glob
+import argparse
+import logging
+import logging.handlers
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGS_DIR = os.path.join(BASE_DIR, "files", "logs")
+TRACES_GLOB = os.path.join(LOGS_DIR, "traces*.jsonl*")
+
+TRACES_MAX_BYTES = 10 * 1024 * 1024
+TRACES_BACKUP_COUNT = 5
+
+_current_trace: ContextVar["Trace | None"] = ContextVar("current_trace", default=None)
+_logger: logging.Logger | None = None
+_logger_pid: int | None = None
+
+
+def traces_path() -> str:
+    """Archivo de trazas de este proceso."""
+    return os.path.join(LOGS_DIR, f"traces.{os.getpid()}.jsonl")
+
+
+def _get_logger() -> logging.Logger:
+    global _logger, _logger_pid
+    # Si el proceso se forkeo despues de crear el logger (workers de uvicorn), se abre el archivo del hijo
+    if _logger is None or _logger_pid != os.getpid():
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(traces_path(), maxBytes=TRACES_MAX_BYTES, backupCount=TRACES_BACKUP_COUNT)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+        _logger = logging.getLogger("asistente.traces")
+        _logger.setLevel(logging.INFO)
+        _logger.propagate = False
+        for old_handler in list(_logger.handlers):
+            _logger.removeHandler(old_handler)
+            old_handler.close()
+        _logger.addHandler(handler)
+        _logger_pid = os.getpid()
+    return _logger
+
+
+class Trace:
+    """
+    Registro de una respuesta: atributos generales, spans por etapa y eventos.
+    """
+
+    def __init__(self, **attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.started = time.time()
+        self.attributes = attributes
+        self.spans: list[dict] = []
+        self.events: list[dict] = []
+
+    def event(self, message: str, **attributes):
+        self.events.append({"t": round(time.time() - self.started, 4), "message": message, **attributes})
+
+    def to_record(self) -> dict:
+        return {
+            "trace_id": self.id,
+            "ts": self.started,
+            "duration": round(time.time() - self.started, 4),
+            **self.attributes,
+            "spans": self.spans,
+            "events": self.events
+        }
+
+
+def current() -> Trace | None:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(**attributes):
+    """
+    Abre una traza para la respuesta actual (ej. course_id, discussion_id). Todo lo que se ejecute
+    dentro (incluso en asyncio.to_thread) registra sus spans en ella. Al salir se escribe el registro.
+    """
+    trace = Trace(**attributes)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.attributes["error"] = repr(e)
+        raise
+    finally:
+        _current_trace.reset(token)
+        record = trace.to_record()
+        _get_logger().info(json.dumps(record, ensure_ascii=False, default=str))
+        print(f"[traza {trace.id}] {attributes} -> {record['duration']}s, {len(trace.spans)} spans, resultado: {trace.attributes.get('outcome', '-')}")
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Mide una etapa. Entrega un dict donde se pueden agregar atributos (bytes, tokens, cache, etc.).
+    Sin traza activa no registra nada.
+    """
+    started = time.time()
+    data = dict(attributes)
+    try:
+        yield data
+    except BaseException as e:
+        data["error"] = repr(e)
+        raise
+    finally:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append({
+                "name": name,
+                "start": round(started - trace.started, 4),
+                "duration": round(time.time() - started, 4),
+                **data
+            })
+
+
+def event(message: str, **attributes):
+    """
+    Registra un evento/decision en la traza activa.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.event(message, **attributes)
+
+
+def active() -> bool:
+    """True si hay una traza activa (dentro de una respuesta)."""
+    return _current_trace.get() is not None
+
+
+def set_attributes(**attributes):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+# === CLI ===
+
+def _percentile(values: list[float], percentile: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def read_traces(since: float) -> list[dict]:
+    records = []
+    # Los archivos de todos los procesos (y sus rotaciones)
+    for path in glob.glob(TRACES_GLOB):
+        with open(path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("ts", 0) >= since:
+                    records.append(record)
+    return records
+
+
+def summarize(records: list[dict], top: int = 10):
+    stages = {}
+    for record in records:
+        for item in record.get("spans", []):
+            stages.setdefault(item["name"], []).append(item["duration"])
+
+    print(f"Trazas: {len(records)}\n")
+    print(f"{'Etapa':<45} {'N':>6} {'p50':>8} {'p95':>8} {'max':>8} {'total':>9}")
+    print("-" * 88)
+    ranking = sorted(stages.items(), key=lambda item: sum(item[1]), reverse=True)[:top]
+    for name, durations in ranking:
+        print(f"{name:<45} {len(durations):>6} {_percentile(durations, 50):>8.3f} {_percentile(durations, 95):>8.3f} {max(durations):>8.3f} {sum(durations):>9.2f}")
+
+    print("\nRespuestas mas lentas:")
+    for record in sorted(records, key=lambda record: record.get("duration", 0), reverse=True)[:top]:
+        slowest = max(record.get("spans", []), key=lambda item: item["duration"], default=None)
+        slowest_text = f"{slowest['name']} ({slowest['duration']:.2f}s)" if slowest else "-"
+        print(f"  {record['trace_id']}  curso {record.get('course_id')}  discusion {record.get('discussion_id')}  {record['duration']:.2f}s  etapa mas lenta: {slowest_text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumen de las etapas mas lentas de las respuestas.")
+    parser.add_argument("--minutos", type=float, default=60, help="Ventana de tiempo a analizar (default: 60)")
+    parser.add_argument("--top", type=int, default=10, help="Cantidad de etapas/respuestas a mostrar (default: 10)")
+    args = parser.parse_args()
+
+    records = read_traces(time.time() - args.minutos * 60)
+    if not records:
+        print("No hay trazas en la ventana indicada.")
+        sys.exit(0)
+
+    summarize(records, args.top)
+
+
+if __name__ == "__main__":
+    main()
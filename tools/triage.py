@@ -0,0 +1,136 @@
+# Triage de eventos del webhook
+#
+# Decide, solo con los datos del evento y lo que ya se tiene en memoria (identidad del asistente,
+# sus cursos y los roles de los inscriptos), si vale la pena procesarlo. Asi los eventos que no
+# requieren respuesta (mensajes del propio asistente, de docentes, de cursos donde no esta el
+# asistente) se descartan sin ninguna llamada a Moodle ni a OpenAI.
+# Si falta informacion en memoria el evento pasa: el flujo normal lo termina de decidir.
+#
+# Cuantos eventos se descartan (y por que) se acumula en files/state/triage.json, para todos los workers.
+# Cada worker cuenta en memoria y suma sus contadores al archivo cada TRIAGE_FLUSH_SECONDS (en un hilo aparte),
+# asi el webhook no espera locks ni disco.
+import os
+import json
+import time
+import fcntl
+import atexit
+import threading
+from collections import Counter
+
+import tools.warm_state as warm_state
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COUNTERS_PATH = os.path.join(BASE_DIR, "files", "state", "triage.json")
+
+FORUM_EVENTS = ("\\mod_forum\\event\\post_created", "\\mod_forum\\event\\discussion_created")
+TEACHER_ROLES = ("teacher", "editingteacher")
+
+# Motivos de descarte
+IGNORED_EVENT = "evento no atendido"
+OWN_POST = "mensaje del asistente"
+TEACHER_POST = "mensaje de un docente"
+FOREIGN_COURSE = "curso sin el asistente"
+ACCEPTED = "procesado"
+FORWARDED = "reenviado a otro nodo"
+
+# Cada cuanto se guardan en el archivo los contadores en memoria (segundos)
+TRIAGE_FLUSH_SECONDS = float(os.getenv("TRIAGE_FLUSH_SECONDS", "10"))
+
+# (site_id, motivo) -> eventos todavia no guardados en el archivo
+_pending: Counter = Counter()
+_pending_lock = threading.Lock()
+_flusher: threading.Thread | None = None
+
+
+def triage(data: dict) -> str | None:
+    """
+    Devuelve el motivo para descartar el evento, o None si hay que procesarlo.
+    Usa el sitio actual (sites.current_site) para la informacion en memoria. No hace llamadas externas.
+    """
+    if data.get("eventname") not in FORUM_EVENTS:
+        return IGNORED_EVENT
+
+    author_id = int(data["userid"]) if data.get("userid") is not None else None
+    course_id = int(data["courseid"])
+
+    identity = warm_state.cached_identity()
+    if identity is not None and author_id == identity["userid"]:
+        return OWN_POST
+
+    courses = warm_state.cached_courses()
+    if courses is not None and not any(course["id"] == course_id for course in courses):
+        return FOREIGN_COURSE
+
+    roles = warm_state.cached_roles(course_id, author_id)
+    if roles and any(rol in TEACHER_ROLES for rol in roles):
+        return TEACHER_POST
+
+    return None
+
+
+def count(reason: str, site_id: str):
+    """
+    Suma un evento al contador del motivo (por sitio), en memoria. Nunca toca el disco ni afecta al webhook.
+    """
+    global _flusher
+    with _pending_lock:
+        _pending[(site_id, reason)] += 1
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_periodically, name="triage-flush", daemon=True)
+            _flusher.start()
+            atexit.register(flush)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(TRIAGE_FLUSH_SECONDS)
+        flush()
+
+
+def flush():
+    """
+    Suma los contadores en memoria al archivo compartido (con lock, lo comparten todos los workers).
+    Si falla, los eventos quedan en memoria para el proximo intento.
+    """
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(COUNTERS_PATH), exist_ok=True)
+        with open(COUNTERS_PATH, "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.seek(0)
+                content = file.read()
+                counters = json.loads(content) if content.strip() else {}
+
+                for (site_id, reason), amount in pending.items():
+                    site_counters = counters.setdefault(site_id, {})
+                    site_counters[reason] = site_counters.get(reason, 0) + amount
+
+                file.seek(0)
+                file.truncate()
+                json.dump(counters, file)
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error al registrar el triage del webhook: {e}")
+        with _pending_lock:
+            _pending.update(pending)
+
+
+def counters() -> dict:
+    """
+    Contadores de todos los workers (los de este worker se guardan antes de leer; los de los demas
+    pueden tener hasta TRIAGE_FLUSH_SECONDS de atraso).
+    """
+    flush()
+    try:
+        with open(COUNTERS_PATH, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
@@ -0,0 +1,171 @@
+# Registro de uso de tokens (ledger) y presupuestos diarios por curso
+#
+# Cada llamada a OpenAI registra en files/state/usage.db los tokens de prompt, respuesta y cacheados,
+# junto con el curso, la etapa (tag, activity_selection, answer, embeddings) y el modelo.
+#
+# Presupuestos: COURSE_DAILY_TOKEN_BUDGET en el .env (para todos los cursos) y/o files/budgets.json
+# ({"id_curso": tokens_por_dia}, o "sitio:id_curso" para los sitios que no son el de por defecto). Al acercarse al limite se usan caminos mas baratos y al superarlo se deja de responder.
+#
+# Reporte de uso:
+#   python -m tools.usage --dias 7
+import os
+import json
+import time
+import sqlite3
+import argparse
+from datetime import date, timedelta
+from dataclasses import dataclass
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import tools.sites as sites
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USAGE_DB_PATH = os.path.join(BASE_DIR, "files", "state", "usage.db")
+BUDGETS_PATH = os.path.join(BASE_DIR, "files", "budgets.json")
+
+# Presupuesto diario por defecto (tokens). 0 = sin limite
+COURSE_DAILY_TOKEN_BUDGET = int(os.getenv("COURSE_DAILY_TOKEN_BUDGET", "0"))
+
+# A partir de que fraccion del presupuesto se pasa al modo reducido
+BUDGET_DEGRADE_AT = float(os.getenv("BUDGET_DEGRADE_AT", "0.8"))
+
+DEFAULT_MODEL = "gpt-4.1"
+CHEAP_MODEL = os.getenv("CHEAP_MODEL", "gpt-4.1-mini")
+
+# Curso al que se le imputan las llamadas de la tarea actual
+current_course: ContextVar[int | None] = ContextVar("current_course", default=None)
+
+
+@dataclass(slots=True, frozen=True)
+class BudgetPlan:
+    """
+    Como responder segun el consumo del dia del curso.
+        -level               -> "normal" | "reducido" | "agotado"
+        -model               -> modelo para la respuesta
+        -max_searches        -> cuantas busquedas de contenido relacionado se incluyen (pregunta, conversacion)
+        -activity_selection  -> si se usa el LLM para elegir la actividad relacionada
+    """
+    level: str
+    model: str
+    max_searches: int
+    activity_selection: bool
+    used_tokens: int
+    budget: int
+
+
+@contextmanager
+def _database():
+    """
+    Conexion a la base de uso (una por llamada, asi se puede usar desde cualquier hilo o worker).
+    """
+    os.makedirs(os.path.dirname(USAGE_DB_PATH), exist_ok=True)
+    connection = sqlite3.connect(USAGE_DB_PATH, timeout=10)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                ts REAL, day TEXT, course_id INTEGER, stage TEXT, model TEXT,
+                prompt_tokens INTEGER, completion_tokens INTEGER, cached_tokens INTEGER,
+                site TEXT DEFAULT 'default'
+            )
+        """)
+        # Bases creadas antes de soportar varios sitios: todo lo registrado es del sitio por defecto
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(usage)")]
+        if "site" not in columns:
+            connection.execute("ALTER TABLE usage ADD COLUMN site TEXT DEFAULT 'default'")
+        connection.execute("CREATE INDEX IF NOT EXISTS usage_course_day ON usage (course_id, day)")
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def record(model: str, stage: str, prompt_tokens: int = 0, completion_tokens: int = 0, cached_tokens: int = 0, course_id: int | None = None):
+    """
+    Registra el uso de una llamada. Si no se indica el curso se usa el de la tarea actual (current_course);
+    el sitio es siempre el de la tarea actual.
+    Un error al registrar nunca interrumpe la respuesta.
+    """
+    if course_id is None:
+        course_id = current_course.get()
+
+    try:
+        with _database() as connection:
+            connection.execute(
+                "INSERT INTO usage (ts, day, course_id, stage, model, prompt_tokens, completion_tokens, cached_tokens, site) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), date.today().isoformat(), course_id, stage, model, prompt_tokens, completion_tokens, cached_tokens, sites.current().id)
+            )
+    except sqlite3.Error as e:
+        print(f"Error al registrar uso de tokens: {e}")
+
+
+def tokens_today(course_id: int) -> int:
+    with _database() as connection:
+        row = connection.execute(
+            "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM usage WHERE site = ? AND course_id = ? AND day = ?",
+            (sites.current().id, course_id, date.today().isoformat())
+        ).fetchone()
+    return row[0]
+
+
+def get_budget(course_id: int) -> int:
+    """
+    Presupuesto diario del curso: files/budgets.json si lo define, si no COURSE_DAILY_TOKEN_BUDGET.
+    """
+    try:
+        with open(BUDGETS_PATH, "r") as file:
+            budgets = json.load(file)
+    except FileNotFoundError:
+        budgets = {}
+
+    site = sites.current()
+    key = str(course_id) if site.id == sites.DEFAULT_SITE_ID else f"{site.id}:{course_id}"
+    return int(budgets.get(key, COURSE_DAILY_TOKEN_BUDGET))
+
+
+def get_budget_plan(course_id: int) -> BudgetPlan:
+    """
+    Decide como responder segun cuanto consumio el curso hoy:
+        - normal:   modelo completo, busqueda por pregunta y por conversacion, seleccion de actividad con LLM
+        - reducido: modelo mas barato, solo la busqueda por pregunta, sin seleccion de actividad
+        - agotado:  no se responde hasta el dia siguiente
+    """
+    budget = get_budget(course_id)
+    if budget <= 0:
+        return BudgetPlan("normal", DEFAULT_MODEL, 2, True, 0, 0)
+
+    used = tokens_today(course_id)
+
+    if used >= budget:
+        return BudgetPlan("agotado", CHEAP_MODEL, 0, False, used, budget)
+    if used >= budget * BUDGET_DEGRADE_AT:
+        return BudgetPlan("reducido", CHEAP_MODEL, 1, False, used, budget)
+    return BudgetPlan("normal", DEFAULT_MODEL, 2, True, used, budget)
+
+
+# === CLI ===
+
+def main():
+    parser = argparse.ArgumentParser(description="Reporte de uso de tokens por curso, etapa y modelo.")
+    parser.add_argument("--dias", type=int, default=1, help="Cantidad de dias a incluir (default: 1, solo hoy)")
+    args = parser.parse_args()
+
+    since = (date.today() - timedelta(days=args.dias - 1)).isoformat()
+    with _database() as connection:
+        rows = connection.execute("""
+            SELECT site, course_id, stage, model, COUNT(*), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens)
+            FROM usage WHERE day >= ?
+            GROUP BY site, course_id, stage, model
+            ORDER BY SUM(prompt_tokens + completion_tokens) DESC
+        """, (since,)).fetchall()
+
+    print(f"{'Sitio':<14} {'Curso':<8} {'Etapa':<20} {'Modelo':<24} {'Llamadas':>9} {'Prompt':>12} {'Cacheados':>12} {'Respuesta':>12}")
+    print("-" * 118)
+    for site, course_id, stage, model, calls, prompt, cached, completion in rows:
+        print(f"{site:<14} {str(course_id):<8} {stage:<20} {model:<24} {calls:>9} {prompt:>12} {cached:>12} {completion:>12}")
+
+
+if __name__ == "__main__":
+    main()
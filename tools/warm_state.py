@@ -0,0 +1,175 @@
+# Estado "tibio" de los workers
+#
+# Un worker recien iniciado no deberia tener que volver a pedir a Moodle quien es el asistente,
+# en que cursos esta, ni reconstruir los indices de los cursos. Todo eso se guarda en
+# files/snapshots/ y se carga al iniciar el worker (ver app.py, evento startup).
+# El estado se guarda por sitio Moodle (ver tools/sites.py).
+import os
+import json
+import time
+import threading
+from importlib import import_module
+
+import tools.moodle as moodle
+import tools.sites as sites
+import tools.IA as IA
+import tools.course_index as course_index
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SNAPSHOTS_DIR = os.path.join(BASE_DIR, "files", "snapshots")
+STATE_PATH = os.path.join(SNAPSHOTS_DIR, "warm_state.json")
+
+# Cada cuanto se vuelve a pedir la lista de cursos del asistente (segundos)
+COURSES_TTL = int(os.getenv("COURSES_TTL", "300"))
+
+# Cada cuanto se vuelve a pedir la lista de inscriptos (y sus roles) de un curso (segundos)
+ROSTER_TTL = int(os.getenv("ROSTER_TTL", "300"))
+
+# site_id -> {"identity", "courses", "courses_updated"}
+_states: dict[str, dict] = {}
+_state_lock = threading.Lock()
+
+# (site_id, course_id) -> (momento de la consulta, {user_id: CourseUser}). Solo en memoria
+_rosters: dict[tuple[str, int], tuple[float, dict[int, moodle.CourseUser]]] = {}
+
+
+def _state() -> dict:
+    """
+    Estado del sitio actual (se crea vacio la primera vez). Llamar con _state_lock tomado.
+    """
+    return _states.setdefault(sites.current().id, {"identity": None, "courses": None, "courses_updated": 0.0})
+
+
+def _save():
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    tmp_path = f"{STATE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(_states, file)
+    os.replace(tmp_path, STATE_PATH)
+
+
+def get_identity() -> dict:
+    """
+    Datos del usuario del asistente en el sitio actual (core_webservice_get_site_info). No cambian mientras el token sea el mismo.
+    """
+    with _state_lock:
+        state = _state()
+        if state["identity"] is not None:
+            return state["identity"]
+
+    identity = moodle.get_self_id()
+
+    with _state_lock:
+        _state()["identity"] = identity
+        _save()
+    return identity
+
+
+def get_courses(user_id: int) -> list[dict]:
+    """
+    Cursos del asistente en el sitio actual, renovados cada COURSES_TTL segundos.
+    """
+    with _state_lock:
+        state = _state()
+        if state["courses"] is not None and time.time() - state["courses_updated"] < COURSES_TTL:
+            return state["courses"]
+
+    courses = moodle.get_user_courses(user_id)
+
+    with _state_lock:
+        state = _state()
+        state["courses"] = courses
+        state["courses_updated"] = time.time()
+        _save()
+    return courses
+
+
+def get_course_roster(course_id: int) -> dict[int, moodle.CourseUser]:
+    """
+    Inscriptos del curso (con sus roles) en el sitio actual, renovados cada ROSTER_TTL segundos.
+    """
+    key = (sites.current().id, course_id)
+    with _state_lock:
+        cached = _rosters.get(key)
+    if cached and time.time() - cached[0] < ROSTER_TTL:
+        return cached[1]
+
+    roster = moodle.get_course_users(course_id)
+
+    with _state_lock:
+        _rosters[key] = (time.time(), roster)
+    return roster
+
+
+# === Consultas sin llamadas a Moodle (para el triage de webhooks) ===
+
+def cached_identity() -> dict | None:
+    with _state_lock:
+        return _state()["identity"]
+
+
+def cached_courses() -> list[dict] | None:
+    """
+    Cursos del asistente si la lista guardada tiene menos de COURSES_TTL segundos (si no, None).
+    """
+    with _state_lock:
+        state = _state()
+        if state["courses"] is not None and time.time() - state["courses_updated"] < COURSES_TTL:
+            return state["courses"]
+    return None
+
+
+def cached_roles(course_id: int, user_id: int) -> tuple[str, ...] | None:
+    """
+    Roles del usuario en el curso segun la ultima lista de inscriptos pedida (None si no se conoce).
+    """
+    with _state_lock:
+        cached = _rosters.get((sites.current().id, course_id))
+    if cached is None or user_id not in cached[1]:
+        return None
+    return cached[1][user_id].roles
+
+
+def load():
+    """
+    Fase de arranque: carga identidad, cursos e indices guardados, y deja listos NumPy, FAISS y
+    los encodings de tiktoken para que la primera respuesta no pague esos costos.
+    """
+    started = time.time()
+
+    try:
+        with open(STATE_PATH, "r") as file:
+            saved = json.load(file)
+        # Formato anterior (un solo sitio): es el estado del sitio por defecto
+        if "identity" in saved:
+            saved = {sites.DEFAULT_SITE_ID: saved}
+        with _state_lock:
+            _states.update(saved)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    indexes = course_index.load_snapshots()
+
+    # Cargar ahora las librerias pesadas y los encodings (tiktoken los lee de files/snapshots/tiktoken)
+    for module in ("numpy", "faiss", "fitz"):
+        import_module(module)
+    IA.count_tokens("", "gpt-4.1")
+    IA.count_tokens("", "text-embedding-3-small")
+
+    # Modelo de embeddings en proceso (EMBEDDING_PROVIDER=cpu): se carga ahora y no en la primera consulta
+    provider = IA.providers.embeddings()
+    if isinstance(provider, IA.providers.CPUEmbeddingProvider):
+        print(f"Modelo de embeddings en CPU cargado: {provider.dimensions} dimensiones")
+
+    print(f"Estado inicial cargado en {time.time() - started:.2f}s: {indexes} indices de cursos")
+
+    # Si cambio EMBEDDING_DIMENSIONS, recortar los embeddings guardados (sin llamadas a la API)
+    migrated = course_index.migrate_all_dimensions()
+    if migrated:
+        print(f"Embeddings migrados a {IA.embedding_dimensions(course_index.EMBEDDING_MODEL)} dimensiones: {migrated} indices de cursos")
+
+    # Indices aproximados de los cursos grandes (ANN_BACKEND), despues de migrar las dimensiones
+    prepared = course_index.prepare_ann_all()
+    if prepared:
+        print(f"Indices aproximados ({IA.ann.ANN_BACKEND}) construidos: {prepared} cursos")